@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+'''
+基于模拟前置的基准测试，结果以JSON输出，便于跨版本对比：
+
+    python benchmark.py --duration 5 --concurrency 32 --workers 2 --output bench.json
+
+ticks：OnRtnDepthMarketData到处理函数的最大持续tick速率
+orders：TraderImpl限价报单到被接受、撤单完成的往返速率与延迟
+http：各HTTP接口在并发客户端下的请求速率与延迟（/market/*访问外部网站，需--with-upstream开启），
+      经限频查询的接口（每秒1次）单独按限频间隔逐个请求，延迟不含限频等待
+startup：服务进程启动到CTP登录完成可以交易的耗时
+codec：期权合约表、全市场tick快照等大负载在现有response.json与各可协商格式下的编码耗时与大小
+'''
+
+import argparse, asyncio, json, os, platform, subprocess, sys, tempfile, time
+import aiohttp
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, REPO_DIR)
+
+#经TraderImpl限频查询的接口及其最小间隔（秒），并发请求只会排队等待限频
+THROTTLED = {"/get_account": 1.0, "/get_orders": 1.0}
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    pick = lambda p: values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))]
+    return {"p50_ms": pick(50) * 1000, "p90_ms": pick(90) * 1000, "p99_ms": pick(99) * 1000,
+            "max_ms": values[-1] * 1000}
+
+def sim_config(args):
+    return {"investor_id": "bench", "broker_id": "9999", "password": "bench",
+            "md_server": "sim://?tick_rate=%s" % args.tick_rate,
+            "trader_server": "sim://?ack_latency=%s&fill_latency=%s&cancel_latency=%s" %
+                    (args.ack_latency, args.ack_latency, args.ack_latency),
+            "app_id": "bench", "auth_code": "bench", "workers": args.workers,
+            "tick_table": "ctp_bench_ticks"}
+
+def new_client(args):
+    import ctp_service
+    config = sim_config(args)
+    return ctp_service.Client(config["md_server"], config["trader_server"], config["broker_id"],
+            config["app_id"], config["auth_code"], config["investor_id"], config["password"])
+
+def bench_ticks(args):
+    import ctp_sim
+    client = new_client(args)
+    client.login()
+    md = client._md
+    codes = [code for code in ctp_sim.EXCHANGE.instruments][:50]
+    fields = [md._simField({"code": code, "price": ctp_sim.EXCHANGE.prices[code],
+            "ask1": (ctp_sim.EXCHANGE.prices[code], 10), "bid1": (ctp_sim.EXCHANGE.prices[code], 10)})
+            for code in codes]
+    received = [0]
+    def handler(tick):
+        received[0] += 1
+    client._handler = handler
+    sent = 0
+    start = time.perf_counter()
+    deadline = start + args.duration
+    while time.perf_counter() < deadline:
+        for field in fields:
+            md.OnRtnDepthMarketData(field)
+        sent += len(fields)
+    ingest_elapsed = time.perf_counter() - start
+    while received[0] < sent and time.perf_counter() - start < args.duration * 10:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    client.logout()
+    return {"instruments": len(fields), "sent": sent, "received": received[0],
+            "callback_ticks_per_sec": sent / ingest_elapsed,
+            "delivered_ticks_per_sec": received[0] / elapsed}
+
+def bench_orders(args):
+    import ctp_sim
+    client = new_client(args)
+    client.login()
+    code = "MA301"
+    tick = ctp_sim.EXCHANGE.instruments[code]["price_tick"]
+    (inserts, cancels, errors) = ([], [], 0)
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        #远离市价的买单会挂单等待，随后撤单
+        price = round(ctp_sim.EXCHANGE.prices[code] * 0.5 / tick) * tick
+        try:
+            t0 = time.perf_counter()
+            order_id = client.orderLimit(code, "long", 1, price)
+            t1 = time.perf_counter()
+            client.deleteOrder(order_id)
+            t2 = time.perf_counter()
+        except Exception:
+            errors += 1
+            continue
+        inserts.append(t1 - t0)
+        cancels.append(t2 - t1)
+    elapsed = time.perf_counter() - start
+    client.logout()
+    return {"round_trips": len(inserts), "errors": errors,
+            "round_trips_per_sec": len(inserts) / elapsed,
+            "insert": percentiles(inserts), "cancel": percentiles(cancels)}
+
+def start_service(args, workdir):
+    config = sim_config(args)
+    config["gateway_address"] = os.path.join(workdir, "gateway.sock")
+    with open(os.path.join(workdir, "config.json"), "w") as fd:
+        json.dump(config, fd)
+    code = "import sys; sys.path.insert(0, %r); import ctp_service; "          \
+            "ctp_service.app.run(host='127.0.0.1', port=%d, workers=%d, access_log=False)" %      \
+            (REPO_DIR, args.port, args.workers)
+    return subprocess.Popen([sys.executable, "-c", code], cwd=workdir,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def stop_service(proc):
+    proc.terminate()
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+async def wait_ready(base_url, timeout):
+    '''
+    轮询/login直到登录成功
+    '''
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(base_url + "/login") as resp:
+                    if "time" in await resp.json(content_type=None):
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.05)
+    return False
+
+async def fetch(url):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as resp:
+            return await resp.json(content_type=None)
+
+async def get_status(session, url):
+    async with session.get(url) as resp:
+        await resp.read()
+        return resp.status
+
+async def load(url, duration, concurrency, interval=0):
+    '''
+    concurrency个客户端循环请求，到期时未完成的请求取消并计入unfinished，不计入延迟。
+    interval大于0时每个客户端两次请求的开始时间至少间隔interval秒
+    '''
+    latencies = []
+    (errors, unfinished) = ([0], [0])
+    deadline = time.perf_counter() + duration
+    async def worker(session):
+        while True:
+            t0 = time.perf_counter()
+            if t0 >= deadline:
+                return
+            try:
+                status = await asyncio.wait_for(get_status(session, url), deadline - t0)
+            except asyncio.TimeoutError:
+                unfinished[0] += 1
+                return
+            except aiohttp.ClientError:
+                errors[0] += 1
+                continue
+            if status != 200:
+                errors[0] += 1
+            else:
+                latencies.append(time.perf_counter() - t0)
+            if interval > 0:
+                await asyncio.sleep(max(t0 + interval - time.perf_counter(), 0))
+    start = time.perf_counter()
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return dict({"requests": len(latencies), "errors": errors[0], "unfinished": unfinished[0],
+            "requests_per_sec": len(latencies) / elapsed}, **percentiles(latencies))
+
+def bench_http(args):
+    base_url = "http://127.0.0.1:%d/trade/ctp" % args.port
+    paths = ["/get_account", "/get_orders", "/get_instruments_option", "/get_tick?codes=MA301", "/get_tick"]
+    if args.with_upstream:
+        paths += ["/market/news", "/market/event", "/market/realtime_hq?code=CNH",
+                "/market/realtime_snap", "/market/realtime_dayline"]
+    workdir = tempfile.mkdtemp(prefix="ctp_bench_")
+    proc = start_service(args, workdir)
+    try:
+        if not asyncio.run(wait_ready(base_url, 60)):
+            raise RuntimeError("服务启动超时")
+        asyncio.run(fetch(base_url + "/subscribe?codes=MA301"))
+        results = {}
+        for path in paths:
+            interval = THROTTLED.get(path)
+            if interval is None:
+                results[path] = asyncio.run(load(base_url + path, args.duration, args.concurrency))
+            else:
+                #限频接口的吞吐由限频决定，单个客户端按间隔请求，先等过此前查询的限频间隔，延迟不含排队等待限频的时间
+                time.sleep(interval)
+                result = asyncio.run(load(base_url + path, max(args.duration, 3 * interval), 1, interval * 1.05))
+                results[path] = dict(result, throttle_requests_per_sec=1 / interval)
+        return {"workers": args.workers, "concurrency": args.concurrency, "endpoints": results}
+    finally:
+        stop_service(proc)
+
+def bench_startup(args):
+    workdir = tempfile.mkdtemp(prefix="ctp_bench_")
+    start = time.perf_counter()
+    proc = start_service(args, workdir)
+    try:
+        ready = asyncio.run(wait_ready("http://127.0.0.1:%d/trade/ctp" % args.port, 60))
+        return {"ready": ready, "startup_to_ready_sec": time.perf_counter() - start if ready else None}
+    finally:
+        stop_service(proc)
+
+def time_encoder(encode, data, duration):
+    count = 0
+    start = time.perf_counter()
+    while True:
+        body = encode(data)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return (body, elapsed / count)
+
+def bench_codec(args):
+    import ctp_sim, ctp_codec
+    from sanic import response
+    client = new_client(args)
+    client.login()
+    md = client._md
+    ticks = {}
+    client._handler = lambda tick: ticks.__setitem__(tick["code"], tick)
+    prices = dict(ctp_sim.EXCHANGE.prices)
+    for (code, price) in prices.items():
+        md.OnRtnDepthMarketData(md._simField({"code": code, "price": price,
+                "ask1": (price, 10), "bid1": (price, 10), "ask2": (price, 5), "bid2": (price, 5)}))
+    deadline = time.perf_counter() + 10
+    while len(ticks) < len(prices) and time.perf_counter() < deadline:
+        time.sleep(0.001)
+    payloads = {"instruments_option": client.get_instruments_option(), "tick_snapshot": ticks}
+    client.logout()
+    #现有实现：Sanic的response.json
+    encoders = {"response.json": lambda data: response.json(data, ensure_ascii=False).body}
+    for media in ctp_codec.available():
+        encoders[media] = lambda data, formats=(media, ): ctp_codec.encode(data, formats)
+    duration = max(args.duration / 10, 0.2)
+    results = {}
+    for (name, data) in payloads.items():
+        result = {}
+        (_, baseline) = time_encoder(encoders["response.json"], data, duration)
+        for (media, encode) in encoders.items():
+            (body, elapsed) = time_encoder(encode, data, duration)
+            if isinstance(body, tuple):
+                if body[1] != media:
+                    continue
+                body = body[0]
+            result[media] = {"bytes": len(body), "encode_ms": elapsed * 1000, "speedup": baseline / elapsed}
+        results[name] = result
+    #/get_tick的JSON响应直接拼接行情表中网关已编码的tick
+    encoded = {code: ctp_codec.dumps(tick) for (code, tick) in ticks.items()}
+    (body, elapsed) = time_encoder(lambda data: ctp_codec.join_object(data.items()), encoded, duration)
+    results["tick_snapshot"]["pre_encoded_json"] = {"bytes": len(body), "encode_ms": elapsed * 1000,
+            "speedup": results["tick_snapshot"]["response.json"]["encode_ms"] / 1000 / elapsed}
+    return {"instruments_option": sum(len(options) for options in payloads["instruments_option"].values()),
+            "tick_snapshot": len(ticks), "orjson": ctp_codec.orjson is not None, "payloads": results}
+
+BENCHMARKS = {"ticks": bench_ticks, "orders": bench_orders, "startup": bench_startup, "http": bench_http,
+        "codec": bench_codec}
+
+def main():
+    parser = argparse.ArgumentParser(description="CTP服务基准测试（模拟前置）")
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--duration", type=float, default=5, help="每项测试的持续时间（秒）")
+    parser.add_argument("--concurrency", type=int, default=32, help="HTTP并发客户端数")
+    parser.add_argument("--workers", type=int, default=1, help="Sanic worker数量")
+    parser.add_argument("--port", type=int, default=7100)
+    parser.add_argument("--tick-rate", type=float, default=10,
+            help="模拟行情每个合约每秒tick数，0为不限速（模拟行情线程会占满CPU，影响其它测试）")
+    parser.add_argument("--ack-latency", type=float, default=0, help="模拟前置确认、成交、撤单延迟（秒）")
+    parser.add_argument("--with-upstream", action="store_true", help="包含访问外部网站的/market/*接口")
+    parser.add_argument("--output", help="结果JSON文件，缺省输出到标准输出")
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    import ctp_service
+    ctp_service.init_logger()
+    ctp_service.logger.setLevel("WARNING")
+    os.chdir(tempfile.mkdtemp(prefix="ctp_bench_"))
+
+    results = {"time": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+            "platform": platform.platform(), "cpus": os.cpu_count(), "args": vars(args)}
+    for name in args.only:
+        results[name] = BENCHMARKS[name](args)
+    text = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
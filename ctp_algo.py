@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+
+'''
+执行算法：母单在网关进程内拆分为子单执行，由tick与报单、成交回报驱动，不经过HTTP轮询与限频查询。
+
+- twap：duration秒内分slices片，第k片结束前累计委托量达到总量的k/slices，挂在本方最优价；到时未成交的部分改挂对手价
+- iceberg：每次只显示display手，成交后补足，价格为price或本方最优价
+- chase：全部数量挂在本方最优价，盘口移动后撤单重挂
+
+各算法均可用offset指定相对基准价加价（买）或减价（卖）的最小变动价位数，limit为价格上限（买）或下限（卖）。
+子单以非阻塞方式报单、撤单，执行线程不等待回报。
+'''
+
+import itertools, math, threading, time, queue, logging
+from ctp_journal import order_key
+
+logger = logging.getLogger()
+
+class Algo:
+    '''
+    母单状态机：每一步比较期望的子单价格与累计委托量，撤销价格不符的子单并补足委托量，
+    子单价格按最小变动价位对齐、不超过涨跌停与limit，数量按合约的限价单最大、最小下单量拆分
+    '''
+    kind = None
+
+    def __init__(self, algo_id, code, direction, volume, instrument, params):
+        if direction not in ("long", "short"):
+            raise ValueError("错误的买卖方向<%s>" % direction)
+        if volume != int(volume) or volume == 0:
+            raise ValueError("交易数量<%s>必须是非零整数" % volume)
+        self.id = algo_id
+        self.code = code
+        self.direction = direction
+        self.volume = int(volume)
+        self.total = abs(self.volume)
+        self.params = params
+        #开多、平空为买，开空、平多为卖
+        self.is_buy = (direction == "long") == (volume > 0)
+        self.price_tick = instrument["price_tick"]
+        self.max_volume = instrument.get("max_limit_volume") or self.total
+        self.min_volume = instrument.get("min_limit_volume") or 1
+        if self.total < self.min_volume:
+            raise ValueError("交易数量<%s>小于最小下单量<%s>" % (volume, self.min_volume))
+        self.offset = int(params.get("offset", 0))
+        self.limit = params.get("limit")
+        if self.limit is not None:
+            self.limit = self.align(float(self.limit), not self.is_buy)
+        self.status = "running"
+        self.message = None
+        self.released = False
+        self.children = {}
+        self.traded_volume = 0
+        self.turnover = 0.0
+        self.snapshot = None
+        self.tick = None
+        self.start_time = None
+        self.create_time = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def align(self, price, up):
+        '''
+        按最小变动价位向上或向下对齐
+        '''
+        steps = price / self.price_tick
+        steps = math.ceil(steps - 1e-9) if up else math.floor(steps + 1e-9)
+        return round(steps * self.price_tick, 8)
+
+    @property
+    def filled(self):
+        return sum(child["traded"] for child in self.children.values())
+
+    @property
+    def working(self):
+        return sum(child["volume"] - child["traded"] for child in self.children.values() if child["active"])
+
+    def touch(self, tick, aggressive):
+        '''
+        本方（aggressive为真时对手方）最优价加offset个最小变动价位，无报价时返回None
+        '''
+        (bid, ask) = (tick["bid1"][0], tick["ask1"][0])
+        base = (ask if aggressive else bid) if self.is_buy else (bid if aggressive else ask)
+        if base is None:
+            return None
+        return base + (self.offset if self.is_buy else -self.offset) * self.price_tick
+
+    def cap(self, price):
+        if price is None:
+            return None
+        tick = self.tick
+        if self.is_buy:
+            if self.limit is not None:
+                price = min(price, self.limit)
+            if tick and tick["upper_limit"]:
+                price = min(price, tick["upper_limit"])
+        else:
+            if self.limit is not None:
+                price = max(price, self.limit)
+            if tick and tick["lower_limit"]:
+                price = max(price, tick["lower_limit"])
+        return self.align(price, not self.is_buy)
+
+    def target(self, now):
+        '''
+        当前应累计委托（已成交加挂单）的数量
+        '''
+        return self.total
+
+    def price(self, now):
+        '''
+        当前期望的子单价格
+        '''
+        return None
+
+    def step(self, trader, now):
+        if self.status != "running" or self.tick is None:
+            return
+        if self.start_time is None:
+            self.start_time = now
+        price = self.cap(self.price(now))
+        if price is None:
+            return
+        for (key, child) in list(self.children.items()):
+            if child["active"] and not child["canceling"] and child["price"] != price:
+                self.cancelChild(trader, key)
+        if any(child["canceling"] for child in self.children.values() if child["active"]):
+            #等待撤单回报后再按新价格补单，避免超量
+            return
+        remaining = self.total - self.filled
+        if remaining < self.min_volume and not self.working:
+            #剩余数量不足最小下单量，无法再报单
+            self.status = "canceled"
+            self.message = "剩余%d手小于最小下单量%d手" % (remaining, self.min_volume)
+            return
+        need = min(self.target(now), self.total) - self.filled - self.working
+        while need >= self.min_volume:
+            volume = min(need, self.max_volume)
+            key = trader.insertOrder(self.code, self.direction, volume if self.volume > 0 else -volume, price)
+            self.children[key] = {"price": price, "volume": volume, "traded": 0, "active": True,
+                    "canceling": False, "order_id": None}
+            need -= volume
+
+    def cancelChild(self, trader, key):
+        child = self.children[key]
+        child["canceling"] = True
+        try:
+            trader.cancelOrder(key, self.code)
+        except Exception as e:
+            #撤单请求未发出，下一步重试
+            child["canceling"] = False
+            logger.debug("撤销子单<%s>失败：%s" % (key, e))
+
+    def onCancelError(self, key, message):
+        '''
+        撤单被拒绝时子单可能已成交，以报单回报为准；仍在挂单的子单在下一步重新撤单
+        '''
+        child = self.children.get(key)
+        if child is not None:
+            child["canceling"] = False
+            logger.debug("撤销子单<%s>失败：%s" % (key, message))
+
+    def onOrder(self, key, volume_traded, active, rejected=None):
+        child = self.children.get(key)
+        if child is None:
+            return
+        child["traded"] = max(child["traded"], volume_traded)
+        if not active:
+            child["active"] = False
+        if rejected is not None and self.status == "running":
+            #拒单多为资金、持仓或限价问题，重复报单也会被拒绝
+            self.status = "error"
+            self.message = rejected
+        if self.status == "running" and self.filled >= self.total:
+            self.status = "done"
+
+    def onTrade(self, key, price, volume):
+        if key in self.children:
+            self.traded_volume += volume
+            self.turnover += price * volume
+
+    def cancel(self, trader, status="canceled", message=None):
+        if self.status == "running":
+            self.status = status
+            self.message = message
+        for (key, child) in list(self.children.items()):
+            if child["active"] and not child["canceling"]:
+                self.cancelChild(trader, key)
+
+    def info(self):
+        '''
+        在执行线程中调用，其它线程读取snapshot
+        '''
+        return {"id": self.id, "kind": self.kind, "code": self.code, "direction": self.direction,
+                "volume": self.volume, "params": self.params, "status": self.status, "message": self.message,
+                "filled": self.filled, "working": self.working, "children": len(self.children),
+                "avg_price": round(self.turnover / self.traded_volume, 8) if self.traded_volume else None,
+                "create_time": self.create_time}
+
+class Twap(Algo):
+    kind = "twap"
+
+    def __init__(self, *args):
+        Algo.__init__(self, *args)
+        self.duration = float(self.params.get("duration", 60))
+        self.slices = int(self.params.get("slices", 10))
+        if self.duration <= 0 or self.slices <= 0:
+            raise ValueError("duration与slices必须大于0")
+
+    def target(self, now):
+        elapsed = now - self.start_time
+        index = min(int(elapsed / self.duration * self.slices) + 1, self.slices)
+        return math.ceil(self.total * index / self.slices)
+
+    def price(self, now):
+        return self.touch(self.tick, now - self.start_time >= self.duration)
+
+class Iceberg(Algo):
+    kind = "iceberg"
+
+    def __init__(self, *args):
+        Algo.__init__(self, *args)
+        self.display = int(self.params.get("display", 1))
+        if self.display <= 0:
+            raise ValueError("display必须大于0")
+        self.fixed = self.params.get("price")
+
+    def target(self, now):
+        return self.filled + self.display
+
+    def price(self, now):
+        if self.fixed is not None:
+            return float(self.fixed)
+        return self.touch(self.tick, False)
+
+class Chase(Algo):
+    kind = "chase"
+
+    def price(self, now):
+        return self.touch(self.tick, False)
+
+ALGOS = {"twap": Twap, "iceberg": Iceberg, "chase": Chase}
+
+class ExecutionEngine:
+    '''
+    执行引擎：全部母单在同一个执行线程中按事件顺序推进，tick与报单回报只在CTP回调线程中入队。
+    trader提供非阻塞的insertOrder、cancelOrder与getInstrument，子单以FrontID:SessionID:OrderRef标识，
+    成交回报经报单回报中的OrderSysID对应到子单。finished(algo)在母单结束后调用
+    '''
+    def __init__(self, trader, finished=None, interval=0.1):
+        self._trader = trader
+        self._finished = finished
+        self._interval = interval
+        self._algos = {}
+        self._codes = {}
+        self._orders = {}
+        self._sys_ids = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self._events = queue.SimpleQueue()
+        threading.Thread(target=self._run, name="algo_execution", daemon=True).start()
+
+    def create(self, kind, code, direction, volume, params):
+        cls = ALGOS.get(kind)
+        if cls is None:
+            raise ValueError("错误的执行算法<%s>" % kind)
+        algo = cls("A%d" % next(self._seq), code, direction, volume, self._trader.getInstrument(code), params)
+        algo.snapshot = algo.info()
+        with self._lock:
+            self._algos[algo.id] = algo
+            self._codes[code] = self._codes.get(code, 0) + 1
+        self._events.put(("start", algo.id))
+        return algo.snapshot
+
+    def cancel(self, algo_id):
+        algo = self._algos.get(algo_id)
+        if algo is None:
+            raise ValueError("母单<%s>不存在" % algo_id)
+        if algo.status != "running":
+            raise ValueError("母单<%s>已结束" % algo_id)
+        self._events.put(("cancel", algo_id))
+        return algo.snapshot
+
+    def algos(self, active=False):
+        '''
+        母单状态取执行线程最近一次发布的快照，不与执行线程并发访问子单
+        '''
+        with self._lock:
+            algos = list(self._algos.values())
+        return [algo.snapshot for algo in algos if not active or algo.snapshot["status"] == "running"]
+
+    def get(self, algo_id):
+        algo = self._algos.get(algo_id)
+        if algo is None:
+            raise ValueError("母单<%s>不存在" % algo_id)
+        return algo.snapshot
+
+    def running(self, code):
+        return self._codes.get(code, 0) > 0
+
+    def onTick(self, tick):
+        '''
+        CTP回调线程中调用：没有运行中母单的合约只做一次字典查找
+        '''
+        if self._codes.get(tick["code"]):
+            self._events.put(("tick", tick))
+
+    def onOrderEvent(self, event, field, session, message=None):
+        '''
+        TraderImpl监听函数：只转发运行中母单所在合约的报单、成交回报与非阻塞报单、撤单的错误
+        '''
+        if event == "request" or not self._codes.get(field.InstrumentID):
+            return
+        if event == "order":
+            if not field.OrderRef.strip():
+                return
+            key = order_key(field.FrontID, field.SessionID, field.OrderRef)
+            order_id = "%s@%s" % (field.OrderSysID, field.InstrumentID) if field.OrderSysID else None
+            #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5, THOST_FTDC_OSS_InsertRejected = 4
+            rejected = field.OrderSubmitStatus == '4'
+            active = field.OrderStatus not in ('0', '5') and not rejected
+            self._events.put(("order", key, order_id, field.VolumeTraded, active,
+                    field.StatusMsg if rejected else None))
+        elif event == "trade":
+            self._events.put(("trade", "%s@%s" % (field.OrderSysID, field.InstrumentID), field.Price, field.Volume))
+        elif event == "insert_error":
+            key = order_key(session[0], session[1], field.OrderRef)
+            self._events.put(("order", key, None, 0, False, message))
+        elif event == "action_error":
+            self._events.put(("action_error", order_key(field.FrontID, field.SessionID, field.OrderRef), message))
+
+    def _run(self):
+        last_timer = time.monotonic()
+        while True:
+            try:
+                event = self._events.get(timeout=self._interval)
+            except queue.Empty:
+                event = None
+            now = time.monotonic()
+            if event is not None:
+                self._handle(event, now)
+            if now - last_timer >= self._interval:
+                last_timer = now
+                for algo in list(self._algos.values()):
+                    if algo.status == "running":
+                        self._step(algo, now)
+
+    def _handle(self, event, now):
+        kind = event[0]
+        if kind == "tick":
+            tick = event[1]
+            for algo in list(self._algos.values()):
+                if algo.code == tick["code"] and algo.status == "running":
+                    algo.tick = tick
+                    self._step(algo, now)
+        elif kind == "order":
+            (_, key, order_id, volume_traded, active, rejected) = event
+            algo = self._orders.get(key) or self._owner(key)
+            if algo is not None:
+                if order_id is not None:
+                    self._sys_ids[order_id] = key
+                    algo.children[key]["order_id"] = order_id
+                algo.onOrder(key, volume_traded, active, rejected)
+                if rejected is not None:
+                    logger.error("母单<%s>的子单被拒绝：%s" % (algo.id, rejected))
+                    algo.cancel(self._trader)
+                self._check(algo)
+                self._step(algo, now)
+        elif kind == "trade":
+            key = self._sys_ids.get(event[1])
+            algo = self._orders.get(key) if key is not None else None
+            if algo is not None:
+                algo.onTrade(key, event[2], event[3])
+                self._check(algo)
+                algo.snapshot = algo.info()
+        elif kind == "action_error":
+            algo = self._orders.get(event[1]) or self._owner(event[1])
+            if algo is not None:
+                algo.onCancelError(event[1], event[2])
+        elif kind == "start":
+            algo = self._algos[event[1]]
+            logger.info("已启动%s母单<%s>：%s %s %d" % (algo.kind, algo.id, algo.code, algo.direction, algo.volume))
+        elif kind == "cancel":
+            algo = self._algos[event[1]]
+            algo.cancel(self._trader)
+            self._check(algo)
+            algo.snapshot = algo.info()
+
+    def _owner(self, key):
+        for algo in self._algos.values():
+            if key in algo.children:
+                self._orders[key] = algo
+                return algo
+        return None
+
+    def _step(self, algo, now):
+        try:
+            algo.step(self._trader, now)
+        except Exception as e:
+            logger.error("母单<%s>报单失败：%s" % (algo.id, e))
+            algo.cancel(self._trader, "error", str(e))
+        self._check(algo)
+        algo.snapshot = algo.info()
+
+    def _check(self, algo):
+        '''
+        母单结束、子单全部完结且成交回报全部到达后释放合约。
+        CTP先推送全部成交的报单回报再推送成交回报，释放过早会丢失最后的成交与均价
+        '''
+        if algo.status == "running" or algo.working or algo.released or algo.traded_volume < algo.filled:
+            return
+        algo.released = True
+        logger.info("%s母单<%s>已结束（%s），成交%d手" % (algo.kind, algo.id, algo.status, algo.filled))
+        with self._lock:
+            self._codes[algo.code] -= 1
+            if not self._codes[algo.code]:
+                del self._codes[algo.code]
+        for (key, child) in algo.children.items():
+            self._orders.pop(key, None)
+            self._sys_ids.pop(child["order_id"], None)
+        if self._finished is not None:
+            self._finished(algo)
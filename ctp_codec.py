@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+'''
+HTTP响应编码：按Accept头在JSON、MessagePack与列式格式（Arrow IPC流、NumPy .npy结构化数组）之间协商。
+orjson、msgpack、pyarrow均为可选依赖，未安装时JSON退回标准库json，其余格式不参与协商。
+'''
+
+import json, io, threading, functools
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow, pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+NUMPY = "application/x-numpy"
+
+_ALIASES = {"application/x-msgpack": MSGPACK, "application/vnd.msgpack": MSGPACK,
+        "*/*": JSON, "application/*": JSON}
+
+def available():
+    '''
+    当前环境可用的响应格式
+    '''
+    formats = [JSON, NUMPY]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    if pyarrow is not None:
+        formats.append(ARROW)
+    return formats
+
+def dumps(data):
+    '''
+    编码为UTF-8 JSON字节，安装了orjson时使用orjson
+    '''
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+def join_object(items):
+    '''
+    由已编码的值拼接JSON对象，items为(键, JSON字节)，值不再解码重编码
+    '''
+    return b"{" + b",".join(dumps(key) + b":" + value for (key, value) in items) + b"}"
+
+@functools.lru_cache(maxsize=64)
+def negotiate(accept):
+    '''
+    按Accept头的q值从高到低列出可用格式，最后总是附上JSON作为缺省
+    '''
+    formats = available()
+    candidates = []
+    for (i, item) in enumerate((accept or "").split(",")):
+        (media, *params) = item.split(";")
+        media = media.strip().lower()
+        media = _ALIASES.get(media, media)
+        quality = 1.0
+        for param in params:
+            (name, _, value) = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if media in formats and quality > 0:
+            candidates.append((-quality, i, media))
+    result = [media for (_, _, media) in sorted(candidates)]
+    if JSON not in result:
+        result.append(JSON)
+    return tuple(result)
+
+def _rows(data):
+    '''
+    数组形状的数据展开为(外层键, 行)：字典的列表，或字典的字典、字典的列表的字典，否则返回None
+    '''
+    if isinstance(data, list):
+        items = [(None, row) for row in data]
+    elif isinstance(data, dict) and data:
+        items = []
+        for (key, value) in data.items():
+            if isinstance(value, list):
+                items.extend((key, row) for row in value)
+            else:
+                items.append((key, value))
+    else:
+        return None
+    if not items or not all(isinstance(row, dict) for (_, row) in items):
+        return None
+    return items
+
+def _column(values):
+    kinds = {type(value) for value in values if value is not None}
+    if kinds == {bool}:
+        return np.array([bool(value) for value in values])
+    if kinds and kinds <= {int} and None not in values:
+        return np.array(values, dtype=np.int64)
+    if kinds and kinds <= {int, float}:
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    return np.array(["" if value is None else str(value) for value in values], dtype=str)
+
+def _expand(name, values, table):
+    #按列整体展开嵌套字典与元组，而不是逐行展开
+    present = [value for value in values if value is not None]
+    if present and all(isinstance(value, dict) for value in present):
+        for key in dict.fromkeys(key for value in present for key in value):
+            _expand("%s_%s" % (name, key), [None if value is None else value.get(key) for value in values], table)
+    elif present and all(isinstance(value, (tuple, list)) for value in present):
+        for i in range(max(len(value) for value in present)):
+            _expand("%s_%d" % (name, i), [value[i] if value is not None and i < len(value) else None
+                    for value in values], table)
+    else:
+        table[name] = _column(values)
+
+def columns(data):
+    '''
+    数组形状的数据转换为列，外层键为key列：嵌套字典与元组展开为"名称_子键"、"名称_序号"列，
+    整数列为int64，含空值的数值列为float64（空值为NaN），其余为字符串。不是数组形状时返回None
+    '''
+    items = _rows(data)
+    if items is None:
+        return None
+    table = {}
+    if items[0][0] is not None:
+        table["key"] = _column([key for (key, _) in items])
+    rows = [row for (_, row) in items]
+    for name in dict.fromkeys(name for row in rows for name in row):
+        _expand(str(name), [row.get(name) for row in rows], table)
+    return table
+
+def _encode_numpy(table):
+    array = np.empty(len(next(iter(table.values()))), dtype=[(name, column.dtype) for (name, column) in table.items()])
+    for (name, column) in table.items():
+        array[name] = column
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+def _encode_arrow(table):
+    batch = pyarrow.record_batch(list(table.values()), names=list(table))
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, batch.schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+def encode(data, formats):
+    '''
+    按协商结果依次尝试编码，列式格式只用于数组形状的数据，返回(字节, 格式)
+    '''
+    table = False
+    for media in formats:
+        if media == JSON:
+            return (dumps(data), JSON)
+        if media == MSGPACK:
+            return (msgpack.packb(data, use_bin_type=True), MSGPACK)
+        if table is False:
+            table = columns(data)
+        if table is None:
+            continue
+        if media == NUMPY:
+            return (_encode_numpy(table), NUMPY)
+        if media == ARROW:
+            return (_encode_arrow(table), ARROW)
+    return (dumps(data), JSON)
+
+class EncodedCache:
+    '''
+    预编码响应缓存：按(键, 协商结果)保存数据版本与编码结果，版本未变时直接返回已编码的字节，
+    超过size项时淘汰最久未用的
+    '''
+    def __init__(self, size=64):
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def find(self, key, version, formats):
+        '''
+        版本一致时返回已编码的(字节, 格式)，否则返回None；version为None表示数据不可缓存
+        '''
+        if version is None:
+            return None
+        key = (key, formats)
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[0] == version:
+                self._items.move_to_end(key)
+                return item[1]
+        return None
+
+    def put(self, key, version, formats, data):
+        '''
+        编码并保存数据，返回(字节, 格式)
+        '''
+        result = encode(data, formats)
+        if version is not None:
+            key = (key, formats)
+            with self._lock:
+                self._items[key] = (version, result)
+                self._items.move_to_end(key)
+                while len(self._items) > self._size:
+                    self._items.popitem(last=False)
+        return result
+
+    def get(self, key, version, formats, load):
+        '''
+        load为取数函数，仅在缓存缺失或版本变化时调用
+        '''
+        result = self.find(key, version, formats)
+        if result is None:
+            result = self.put(key, version, formats, load())
+        return result
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+
+import json, struct, threading, os, logging, functools, queue, asyncio
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from multiprocessing.connection import Listener, Client as Connect
+from ctp_codec import dumps
+from ctp_latency import TRACER
+
+logger = logging.getLogger()
+
+class TickTable:
+    '''
+    共享内存最新行情表：网关进程单写，各Sanic worker多读。
+    头部为(状态, 槽位数, 槽位大小, 已分配槽位数)，每个槽位为(序号, 数据长度, 合约代码)加JSON数据，
+    写入时序号先变为奇数、写完再变为偶数，读取方据此判断数据是否完整（seqlock）。
+    '''
+    HEADER = struct.Struct("<IIII")
+    SLOT_HEADER = struct.Struct("<QH32s")
+    SEQ = struct.Struct("<Q")
+    LENGTH = struct.Struct("<H")
+
+    def __init__(self, name, capacity=4096, slot_size=2048, create=False):
+        self._name = name
+        self._capacity = capacity
+        self._slot_size = slot_size
+        self._shm = None
+        self._index = {}
+        self._lock = threading.Lock()
+        if create:
+            self._create()
+
+    def _create(self):
+        try:
+            old = shared_memory.SharedMemory(name=self._name)
+            old.close()
+            old.unlink()
+        except FileNotFoundError:
+            pass
+        size = self.HEADER.size + self._capacity * self._slot_size
+        self._shm = shared_memory.SharedMemory(name=self._name, create=True, size=size)
+        self.HEADER.pack_into(self._shm.buf, 0, 1, self._capacity, self._slot_size, 0)
+        logger.info("已创建共享内存行情表<%s>，共%d个槽位..." % (self._name, self._capacity))
+
+    def _attach(self):
+        if self._shm is not None:
+            if self.HEADER.unpack_from(self._shm.buf, 0)[0] == 1:
+                return True
+            #网关进程已重建行情表，重新挂载
+            self._shm.close()
+            self._shm = None
+            self._index = {}
+        try:
+            shm = shared_memory.SharedMemory(name=self._name)
+        except FileNotFoundError:
+            return False
+        #只读挂载，避免本进程退出时resource_tracker删除共享内存
+        resource_tracker.unregister(shm._name, "shared_memory")
+        (state, self._capacity, self._slot_size, _) = self.HEADER.unpack_from(shm.buf, 0)
+        self._shm = shm
+        return state == 1
+
+    def _offset(self, slot):
+        return self.HEADER.size + slot * self._slot_size
+
+    def _allocate(self, code):
+        count = self.HEADER.unpack_from(self._shm.buf, 0)[3]
+        if count >= self._capacity:
+            return None
+        self.SLOT_HEADER.pack_into(self._shm.buf, self._offset(count), 0, 0, code.encode())
+        struct.pack_into("<I", self._shm.buf, 12, count + 1)
+        self._index[code] = count
+        return count
+
+    def _lookup(self, code):
+        slot = self._index.get(code)
+        if slot is not None:
+            return slot
+        count = self.HEADER.unpack_from(self._shm.buf, 0)[3]
+        for slot in range(len(self._index), count):
+            (_, _, name) = self.SLOT_HEADER.unpack_from(self._shm.buf, self._offset(slot))
+            self._index[name.rstrip(b"\0").decode()] = slot
+        return self._index.get(code)
+
+    def put(self, code, tick):
+        '''
+        写入合约的最新tick（仅网关进程调用）
+        '''
+        data = dumps(tick)
+        if len(data) > self._slot_size - self.SLOT_HEADER.size:
+            logger.warning("合约<%s>的tick超过槽位大小，已丢弃..." % code)
+            return False
+        with self._lock:
+            slot = self._index.get(code)
+            if slot is None:
+                slot = self._allocate(code)
+                if slot is None:
+                    return False
+            buf = self._shm.buf
+            offset = self._offset(slot)
+            seq = self.SEQ.unpack_from(buf, offset)[0]
+            self.SEQ.pack_into(buf, offset, seq + 1)
+            self.LENGTH.pack_into(buf, offset + 8, len(data))
+            start = offset + self.SLOT_HEADER.size
+            buf[start: start + len(data)] = data
+            self.SEQ.pack_into(buf, offset, seq + 2)
+        return True
+
+    def get(self, code):
+        '''
+        读取合约的最新tick，不存在时返回None
+        '''
+        data = self.getRaw(code)
+        return None if data is None else json.loads(data)
+
+    def getRaw(self, code):
+        '''
+        读取合约最新tick的JSON字节，不存在时返回None
+        '''
+        if not self._attach():
+            return None
+        slot = self._lookup(code)
+        if slot is None:
+            return None
+        buf = self._shm.buf
+        offset = self._offset(slot)
+        start = offset + self.SLOT_HEADER.size
+        for _ in range(1000):
+            seq = self.SEQ.unpack_from(buf, offset)[0]
+            if seq & 1:
+                continue
+            length = self.LENGTH.unpack_from(buf, offset + 8)[0]
+            data = bytes(buf[start: start + length])
+            if self.SEQ.unpack_from(buf, offset)[0] == seq:
+                break
+        else:
+            return None
+        if length == 0:
+            return None
+        return data
+
+    def codes(self):
+        '''
+        已写入行情表的全部合约代码
+        '''
+        if not self._attach():
+            return []
+        self._lookup("")
+        return list(self._index)
+
+    def snapshot(self, codes=None):
+        '''
+        批量读取最新tick，codes为None时返回全部合约
+        '''
+        return {code: json.loads(data) for (code, data) in self.snapshotRaw(codes).items()}
+
+    def snapshotRaw(self, codes=None):
+        '''
+        批量读取最新tick的JSON字节，可直接拼接为响应而不必解码重编码
+        '''
+        if codes is None:
+            codes = self.codes()
+        data = {}
+        for code in codes:
+            tick = self.getRaw(code)
+            if tick is not None:
+                data[code] = tick
+        return data
+
+    def close(self, unlink=False):
+        if self._shm is None:
+            return
+        if unlink:
+            struct.pack_into("<I", self._shm.buf, 0, 0)
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+        self._shm = None
+
+class TickRing:
+    '''
+    单生产者单消费者的共享内存tick环形队列：网关进程写入，策略进程读取。
+    头部为(写序号, 读序号, 槽位数, 槽位大小)，每个槽位为(数据长度)加JSON数据；
+    写方写完数据后才推进写序号，读方读完数据后才推进读序号，双方只写各自的序号，无需加锁。
+    队列满时丢弃新tick，不阻塞网关进程。
+    '''
+    HEADER = struct.Struct("<QQII")
+    SEQ = struct.Struct("<Q")
+    LENGTH = struct.Struct("<I")
+
+    def __init__(self, name, capacity=1024, slot_size=2048, create=False):
+        self.name = name
+        self.dropped = 0
+        if create:
+            try:
+                old = shared_memory.SharedMemory(name=name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+            size = self.HEADER.size + capacity * slot_size
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.HEADER.pack_into(self._shm.buf, 0, 0, 0, capacity, slot_size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+            (_, _, capacity, slot_size) = self.HEADER.unpack_from(self._shm.buf, 0)
+        self._capacity = capacity
+        self._slot_size = slot_size
+
+    def _offset(self, seq):
+        return self.HEADER.size + (seq % self._capacity) * self._slot_size
+
+    def put(self, data):
+        '''
+        写入一条JSON编码的tick（仅生产者调用），队列已满或超过槽位大小时丢弃并返回False
+        '''
+        buf = self._shm.buf
+        write = self.SEQ.unpack_from(buf, 0)[0]
+        read = self.SEQ.unpack_from(buf, 8)[0]
+        if write - read >= self._capacity or len(data) > self._slot_size - self.LENGTH.size:
+            self.dropped += 1
+            return False
+        offset = self._offset(write)
+        self.LENGTH.pack_into(buf, offset, len(data))
+        start = offset + self.LENGTH.size
+        buf[start: start + len(data)] = data
+        self.SEQ.pack_into(buf, 0, write + 1)
+        return True
+
+    def get(self):
+        '''
+        取出下一条tick数据（仅消费者调用），队列为空时返回None
+        '''
+        buf = self._shm.buf
+        read = self.SEQ.unpack_from(buf, 8)[0]
+        if read == self.SEQ.unpack_from(buf, 0)[0]:
+            return None
+        offset = self._offset(read)
+        length = self.LENGTH.unpack_from(buf, offset)[0]
+        start = offset + self.LENGTH.size
+        data = bytes(buf[start: start + length])
+        self.SEQ.pack_into(buf, 8, read + 1)
+        return data
+
+    def pending(self):
+        buf = self._shm.buf
+        return self.SEQ.unpack_from(buf, 0)[0] - self.SEQ.unpack_from(buf, 8)[0]
+
+    def reset(self):
+        '''
+        丢弃未读取的tick，仅在没有消费者时调用（如策略进程重启前）
+        '''
+        self.SEQ.pack_into(self._shm.buf, 8, self.SEQ.unpack_from(self._shm.buf, 0)[0])
+
+    def close(self, unlink=False):
+        if self._shm is None:
+            return
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+        self._shm = None
+
+_EXCEPTIONS = {"ValueError": ValueError, "TimeoutError": TimeoutError,
+        "RuntimeError": RuntimeError, "KeyError": KeyError, "TypeError": TypeError}
+
+def serve(target, address, authkey, ready=None):
+    '''
+    网关IPC服务：每个连接一个线程，请求为(方法名, args, kwargs)或附带延迟追踪上下文的(方法名, args, kwargs, trace)，
+    只开放target的公有方法。ready在开始监听后调用
+    '''
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, authkey=authkey)
+    logger.info("网关已监听<%s>..." % (address, ))
+    if ready is not None:
+        ready()
+
+    def handle(conn):
+        while True:
+            try:
+                request = conn.recv()
+            except (EOFError, OSError):
+                break
+            (method, args, kwargs) = request[:3]
+            TRACER.resume(request[3] if len(request) > 3 else None)
+            try:
+                if method.startswith("_"):
+                    raise ValueError("不允许调用私有方法<%s>" % method)
+                result = ("ok", getattr(target, method)(*args, **kwargs))
+            except Exception as e:
+                result = ("error", (type(e).__name__, str(e)))
+            finally:
+                TRACER.resume(None)
+            try:
+                conn.send(result)
+            except Exception as e:
+                conn.send(("error", (type(e).__name__, str(e))))
+        conn.close()
+
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning("网关连接认证失败：%s" % e)
+                continue
+            threading.Thread(target=handle, args=(conn, ), daemon=True).start()
+    finally:
+        listener.close()
+
+class GatewayClient:
+    '''
+    网关代理：将方法调用转发给网关进程中的Client
+    '''
+    def __init__(self, address, authkey):
+        self._address = address
+        self._authkey = authkey
+        self._conn = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def setTrace(self, code=None, handler_ns=None):
+        '''
+        策略进程处理tick期间设置延迟追踪上下文，之后的调用附带该上下文；不带参数时清除
+        '''
+        self._local.trace = (code, handler_ns) if handler_ns is not None else None
+
+    def _send(self, request):
+        for retry in (False, True):
+            try:
+                if self._conn is None:
+                    self._conn = Connect(self._address, authkey=self._authkey)
+                self._conn.send(request)
+                return
+            except OSError as e:
+                #网关重启后旧连接失效，重连一次；请求未送达网关，重发不会重复下单
+                self._conn = None
+                if retry:
+                    raise ConnectionError("连接网关失败：%s" % e)
+
+    def call(self, method, *args, **kwargs):
+        with self._lock:
+            trace = getattr(self._local, "trace", None)
+            self._send((method, args, kwargs) if trace is None else (method, args, kwargs, trace))
+            try:
+                (status, result) = self._conn.recv()
+            except (EOFError, OSError) as e:
+                self._conn = None
+                raise ConnectionError("网关连接中断：%s" % e)
+        if status == "error":
+            raise _EXCEPTIONS.get(result[0], RuntimeError)(result[1])
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+class AsyncGatewayClient:
+    '''
+    Sanic worker使用的异步网关代理：方法调用返回协程，在线程池中经连接池转发给网关进程，
+    网关对每个连接使用独立线程，限频查询、登录等慢调用只占用一个连接，不阻塞事件循环与其它请求
+    '''
+    def __init__(self, address, authkey, size=8):
+        self._pool = queue.SimpleQueue()
+        for _ in range(size):
+            self._pool.put(GatewayClient(address, authkey))
+        self._size = size
+        #线程数与连接数相同，取连接时不会等待
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="gateway_call")
+
+    def _call(self, method, args, kwargs):
+        client = self._pool.get()
+        try:
+            return client.call(method, *args, **kwargs)
+        finally:
+            self._pool.put(client)
+
+    async def call(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, method, args, kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        for _ in range(self._size):
+            self._pool.get().close()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+import time, math, threading, logging
+import numpy as np
+
+logger = logging.getLogger()
+
+# 股指期权以同月股指期货作为标的价格
+_INDEX_FUTURES = {"IO": "IF", "MO": "IM", "HO": "IH"}
+
+def _pdf(x):
+    return np.exp(-0.5 * x * x) / math.sqrt(2 * math.pi)
+
+def _cdf(x):
+    #Abramowitz & Stegun 26.2.17，误差小于7.5e-8
+    t = 1 / (1 + 0.2316419 * np.abs(x))
+    poly = t * (0.319381530 + t * (-0.356563782 + t * (1.781477937 + t * (-1.821255978 + t * 1.330274429))))
+    p = 1 - _pdf(x) * poly
+    return np.where(x >= 0, p, 1 - p)
+
+def black76(forward, strike, years, vol, is_call, discount):
+    '''
+    Black-76期权价格（期货期权按欧式近似），返回(价格, d1, d2)
+    '''
+    sqrt_t = np.sqrt(years)
+    d1 = (np.log(forward / strike) + 0.5 * vol * vol * years) / (vol * sqrt_t)
+    d2 = d1 - vol * sqrt_t
+    call = discount * (forward * _cdf(d1) - strike * _cdf(d2))
+    put = discount * (strike * _cdf(-d2) - forward * _cdf(-d1))
+    return (np.where(is_call, call, put), d1, d2)
+
+def implied_vol(price, forward, strike, years, is_call, discount, iterations=50, tolerance=1e-8):
+    '''
+    整条期权链一次性求隐含波动率：带区间保护的牛顿法，越界时退化为二分，全部收敛后提前结束
+    '''
+    intrinsic = discount * np.where(is_call, np.maximum(forward - strike, 0), np.maximum(strike - forward, 0))
+    upper = discount * np.where(is_call, forward, strike)
+    valid = np.isfinite(price) & np.isfinite(forward) & (years > 0) & (price > intrinsic) & (price < upper)
+    result = np.full(len(strike), np.nan)
+    index = np.nonzero(valid)[0]
+    if len(index) == 0:
+        return result
+    (price, forward, strike, years, is_call, discount) =                            \
+            (price[index], forward[index], strike[index], years[index], is_call[index], discount[index])
+    (lo, hi, vol) = (np.full(len(index), 1e-4), np.full(len(index), 5.0), np.full(len(index), 0.3))
+    for _ in range(iterations):
+        (model, d1, _) = black76(forward, strike, years, vol, is_call, discount)
+        diff = model - price
+        if np.all(np.abs(diff) < tolerance * np.maximum(price, 1)):
+            break
+        vega = discount * forward * _pdf(d1) * np.sqrt(years)
+        hi = np.where(diff > 0, vol, hi)
+        lo = np.where(diff <= 0, vol, lo)
+        newton = vol - diff / vega
+        vol = np.where((newton > lo) & (newton < hi), newton, (lo + hi) / 2)
+    result[index] = vol
+    return result
+
+class OptionChain:
+    '''
+    同一标的的期权链，以NumPy数组保存行权价、类型、到期日与最新价
+    '''
+    def __init__(self, underlying, options):
+        options = sorted(options, key=lambda x: (x["strike_price"] or 0, x["option_type"] or ""))
+        self.underlying = underlying
+        prefix = underlying[:2]
+        self.underlying_code = _INDEX_FUTURES[prefix] + underlying[2:] if prefix in _INDEX_FUTURES else underlying
+        self.codes = [option["symbol"] for option in options]
+        self.index = {code: i for (i, code) in enumerate(self.codes)}
+        self.strikes = np.array([option["strike_price"] or np.nan for option in options], dtype=float)
+        self.is_call = np.array([option["option_type"] == "call" for option in options])
+        self.expire = np.array([_expireTime(option["expire_date"]) for option in options], dtype=float)
+        self.prices = np.full(len(options), np.nan)
+        self.underlying_price = np.nan
+        self.dirty = False
+        self.computed_at = 0
+        self.result = None
+
+    def compute(self, rate):
+        #先取价格快照再计算，计算期间到达的tick重新标记为待重算
+        self.dirty = False
+        prices = self.prices.copy()
+        years = np.maximum(self.expire - time.time(), 0) / (365 * 86400)
+        discount = np.exp(-rate * years)
+        forward = np.full(len(self.codes), self.underlying_price)
+        with np.errstate(all="ignore"):
+            vol = implied_vol(prices, forward, self.strikes, years, self.is_call, discount)
+            (_, d1, _) = black76(forward, self.strikes, years, vol, self.is_call, discount)
+            sqrt_t = np.sqrt(years)
+            density = discount * _pdf(d1)
+            delta = discount * np.where(self.is_call, _cdf(d1), _cdf(d1) - 1)
+            gamma = density / (forward * vol * sqrt_t)
+            #vega为波动率变动1个百分点，theta为每自然日
+            vega = forward * density * sqrt_t / 100
+            theta = (-forward * density * vol / (2 * sqrt_t) + rate * prices) / 365
+        self.computed_at = time.time()
+        self.result = {"iv": vol, "delta": delta, "gamma": gamma, "vega": vega, "theta": theta}
+
+def _expireTime(expire_date):
+    if not expire_date:
+        return np.nan
+    #按到期日15:00收盘计算剩余时间
+    return time.mktime(time.strptime(expire_date + " 15:00:00", "%Y-%m-%d %H:%M:%S"))
+
+def _clean(value):
+    value = float(value)
+    return None if math.isnan(value) or math.isinf(value) else value
+
+def _tickPrice(tick):
+    (ask, bid) = (tick["ask1"][0], tick["bid1"][0])
+    if ask is not None and bid is not None and ask >= bid > 0:
+        return (ask + bid) / 2
+    return tick["price"]
+
+class OptionAnalytics:
+    '''
+    期权链实时隐含波动率与希腊字母：收到期权或标的tick时只更新价格，由独立的分析线程重算，
+    每条链至多每interval秒整体重算一次，间隔内的变动在间隔到达时补算
+    '''
+    def __init__(self, instruments_option, interval=0.5, rate=0.0):
+        self._interval = interval
+        self._rate = rate
+        self._chains = {}
+        self._by_option = {}
+        self._by_underlying = {}
+        self._greeks = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._closed = False
+        for (underlying, options) in instruments_option.items():
+            chain = OptionChain(underlying, options)
+            self._chains[underlying] = chain
+            for code in chain.codes:
+                self._by_option[code] = chain
+            self._by_underlying.setdefault(chain.underlying_code, []).append(chain)
+        threading.Thread(target=self._run, name="option_analytics", daemon=True).start()
+
+    def onTick(self, tick):
+        '''
+        分发线程中调用：只更新价格并把链标记为待重算，不在分发线程中求解隐含波动率
+        '''
+        code = tick["code"]
+        chains = self._by_underlying.get(code, ())
+        chain = self._by_option.get(code)
+        if chain is None and not chains:
+            return
+        price = _tickPrice(tick)
+        price = np.nan if price is None else price
+        if chain is not None:
+            chain.prices[chain.index[code]] = price
+            chains = [chain]
+        else:
+            for chain in chains:
+                chain.underlying_price = price
+        with self._cond:
+            for chain in chains:
+                chain.dirty = True
+                if chain not in self._pending:
+                    self._pending.add(chain)
+                    self._cond.notify()
+
+    def _run(self):
+        '''
+        分析线程：待重算的链距上次重算满interval秒后整体重算
+        '''
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.time()
+                    due = [chain for chain in self._pending if now - chain.computed_at >= self._interval]
+                    if due:
+                        self._pending.difference_update(due)
+                        break
+                    self._cond.wait(min((chain.computed_at + self._interval - now for chain in self._pending),
+                            default=None))
+            for chain in due:
+                try:
+                    self._refresh(chain)
+                except Exception as e:
+                    logger.exception("期权链<%s>计算异常：%s" % (chain.underlying, e))
+
+    def _refresh(self, chain):
+        with self._lock:
+            if not chain.dirty and chain.result is not None:
+                return
+            chain.compute(self._rate)
+            result = chain.result
+            for (i, code) in enumerate(chain.codes):
+                self._greeks[code] = {name: _clean(values[i]) for (name, values) in result.items()}
+
+    def close(self):
+        '''
+        停止分析线程
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def annotate(self, tick):
+        '''
+        CTP回调线程中调用：为期权tick附上最近一次计算的希腊字母
+        '''
+        greeks = self._greeks.get(tick["code"])
+        if greeks is not None:
+            tick["greeks"] = greeks
+
+    def underlyings(self):
+        return list(self._chains)
+
+    def underlying(self, code):
+        '''
+        期权的标的价格所用的合约代码，股指期权为同月股指期货；不是期权时返回None
+        '''
+        chain = self._by_option.get(code)
+        return None if chain is None else chain.underlying_code
+
+    def greeks(self, underlying):
+        '''
+        整条期权链的最新隐含波动率与希腊字母，尚未计算过时立即计算
+        '''
+        chain = self._chains.get(underlying)
+        if chain is None:
+            raise ValueError("标的<%s>没有期权" % underlying)
+        if chain.result is None:
+            self._refresh(chain)
+        options = []
+        for (i, code) in enumerate(chain.codes):
+            option = {"code": code, "strike_price": _clean(chain.strikes[i]),
+                    "option_type": "call" if chain.is_call[i] else "put", "price": _clean(chain.prices[i])}
+            option.update(self._greeks.get(code, {}))
+            options.append(option)
+        return {"underlying": underlying, "underlying_code": chain.underlying_code,
+                "underlying_price": _clean(chain.underlying_price),
+                "time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(chain.computed_at)) if chain.computed_at else None,
+                "options": options}
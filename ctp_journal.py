@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+import json, os, re, threading, time, logging
+
+logger = logging.getLogger()
+
+class JournalState:
+    '''
+    由日志重建的交易状态：当前交易日、已分配的最大OrderRef、当日报单、成交与持仓。
+    重复应用同一条记录结果不变，快照之后的日志可以安全重放
+    '''
+    def __init__(self):
+        self.trading_day = None
+        self.order_ref = 0
+        self.orders = {}
+        self.trades = {}
+        self.positions = {}
+        self.positions_day = None
+
+    def apply(self, record):
+        kind = record["type"]
+        if kind == "day":
+            if record["trading_day"] != self.trading_day:
+                (self.orders, self.trades) = ({}, {})
+                self.order_ref = 0
+            self.trading_day = record["trading_day"]
+        elif kind == "positions":
+            #查询得到的持仓为绝对值，覆盖此前由成交推算的持仓；查询时已有的成交计入基准，续传时不再重复计入
+            self.positions = dict(record["positions"])
+            self.positions_day = self.trading_day
+            for key in record.get("trades", ()):
+                self.trades.setdefault(key, {})
+        elif kind == "request":
+            self.order_ref = max(self.order_ref, record["ref"])
+            self.orders.setdefault(record["key"], {"order_id": None, "code": record["code"],
+                    "direction": record["direction"], "price": record["price"], "volume": record["volume"],
+                    "volume_traded": 0, "is_active": True, "status": None, "message": None})
+        elif kind == "order":
+            order = self.orders.setdefault(record["key"], {})
+            order.update((k, v) for (k, v) in record.items() if k not in ("type", "key"))
+        elif kind == "trade":
+            if record["key"] in self.trades:
+                return
+            self.trades[record["key"]] = {k: v for (k, v) in record.items() if k not in ("type", "key")}
+            position = "%s@%s" % (record["code"], record["position"])
+            self.positions[position] = self.positions.get(position, 0) + record["delta"]
+
+    def toDict(self):
+        return {"trading_day": self.trading_day, "order_ref": self.order_ref, "orders": self.orders,
+                "trades": self.trades, "positions": self.positions, "positions_day": self.positions_day}
+
+    @classmethod
+    def fromDict(cls, data):
+        state = cls()
+        state.__dict__.update(data)
+        return state
+
+def trade_key(field):
+    '''
+    成交编号：交易所、TradeID与买卖方向，同一笔成交的续传回报与查询结果相同
+    '''
+    return "%s:%s:%s" % (field.ExchangeID, field.TradeID.strip(), field.Direction)
+
+def order_key(front_id, session_id, order_ref):
+    '''
+    报单在交易日内的唯一标识：FrontID、SessionID与OrderRef，报单被交易所接受前即可用于撤单
+    '''
+    return "%s:%s:%s" % (front_id, session_id, int(order_ref) if order_ref.strip() else 0)
+
+class Journal:
+    '''
+    交易预写日志：报单请求（含OrderRef分配）、报单回报、成交回报追加写入JSON Lines，
+    后台线程每interval秒批量fsync；每snapshot_every条记录由后台线程把状态压缩为快照，不阻塞CTP回调线程。
+    压缩时持锁只序列化状态并把日志轮换为journal.<代数>.log，快照写盘后再删除，快照记录已包含的代数。
+    重启时由快照加其后的日志在毫秒级重建状态，只需CTP续传（RESUME）补齐日志之后的回报
+    '''
+    def __init__(self, directory, interval=0.01, snapshot_every=10000):
+        os.makedirs(directory, exist_ok = True)
+        self._directory = directory
+        self._path = os.path.join(directory, "journal.log")
+        self._snapshot_path = os.path.join(directory, "snapshot.json")
+        self._interval = interval
+        self._snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._dirty = False
+        self._records = 0
+        self._compact_due = False
+        self._generation = 0
+        self._load()
+        self._fd = open(self._path, "a", encoding="utf-8")
+        self._stopped = threading.Event()
+        threading.Thread(target=self._flushLoop, name="journal_flush", daemon=True).start()
+
+    def _load(self):
+        start = time.perf_counter()
+        self.state = JournalState()
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, encoding="utf-8") as fd:
+                data = json.load(fd)
+            self._generation = data.pop("generation", 0)
+            self.state = JournalState.fromDict(data)
+        #快照未包含的轮换日志（压缩过程中崩溃）按代数先后重放，再重放当前日志
+        for (generation, path) in self._rotated():
+            if generation <= self._generation:
+                os.remove(path)
+                continue
+            self._replay(path)
+            self._generation = generation
+        if os.path.exists(self._path):
+            self._replay(self._path)
+        logger.info("已从交易日志恢复%d个报单、%d笔成交，耗时%.1f毫秒..." % (len(self.state.orders),
+                len(self.state.trades), (time.perf_counter() - start) * 1000))
+
+    def _rotated(self):
+        '''
+        轮换日志的(代数, 路径)，按代数排序
+        '''
+        return sorted((int(match.group(1)), os.path.join(self._directory, name)) for name in os.listdir(self._directory)
+                for match in [re.fullmatch(r"journal\.(\d+)\.log", name)] if match)
+
+    def _replay(self, path):
+        with open(path, encoding="utf-8") as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #崩溃时最后一行可能未写完整
+                    logger.warning("交易日志末尾记录不完整，已忽略...")
+                    break
+                self.state.apply(record)
+                self._records += 1
+
+    def append(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self.state.apply(record)
+            self._fd.write(line + "\n")
+            self._dirty = True
+            self._records += 1
+            if self._records >= self._snapshot_every:
+                self._compact_due = True
+
+    def _flushLoop(self):
+        while not self._stopped.wait(self._interval):
+            self.sync()
+            if self._compact_due:
+                self.compact()
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                self._fd.flush()
+                os.fsync(self._fd.fileno())
+                self._dirty = False
+
+    def compact(self):
+        '''
+        持锁序列化状态并轮换日志，之后在锁外写入快照（临时文件原子替换）并删除已包含的日志
+        '''
+        with self._compact_lock:
+            with self._lock:
+                self._generation += 1
+                generation = self._generation
+                data = self.state.toDict()
+                data["generation"] = generation
+                snapshot = json.dumps(data, ensure_ascii=False)
+                self._fd.flush()
+                os.fsync(self._fd.fileno())
+                self._fd.close()
+                os.replace(self._path, os.path.join(self._directory, "journal.%d.log" % generation))
+                self._fd = open(self._path, "w", encoding="utf-8")
+                self._dirty = False
+                self._records = 0
+                self._compact_due = False
+            temp_path = self._snapshot_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as fd:
+                fd.write(snapshot)
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(temp_path, self._snapshot_path)
+            for (rotated, path) in self._rotated():
+                if rotated <= generation:
+                    os.remove(path)
+
+    def close(self):
+        self._stopped.set()
+        self.sync()
+        with self._compact_lock, self._lock:
+            self._fd.close()
+
+    def beginDay(self, trading_day):
+        '''
+        登录回调中调用：换日时清空当日报单与成交，由后台线程压缩日志，返回当日已分配的最大OrderRef
+        '''
+        if trading_day != self.state.trading_day:
+            self.append({"type": "day", "trading_day": trading_day})
+            self._compact_due = True
+        return self.state.order_ref
+
+    def needPositions(self):
+        '''
+        当日尚未记录持仓基准时需查询一次持仓
+        '''
+        return self.state.positions_day != self.state.trading_day
+
+    def setPositions(self, positions, trades=()):
+        '''
+        记录持仓基准，positions为TraderImpl.getPositions的结果（上期所、能源中心的今仓、昨仓分两行，按合约与方向合计），
+        trades为查询持仓之前查询到的成交编号，须先于持仓查询，才能保证都已计入持仓
+        '''
+        baseline = {}
+        for p in positions:
+            key = "%s@%s" % (p["code"], p["direction"])
+            baseline[key] = baseline.get(key, 0) + p["volume"]
+        self.append({"type": "positions", "positions": baseline, "trades": list(trades)})
+
+    def onEvent(self, event, field, session, message=None):
+        '''
+        TraderImpl监听函数，在CTP回调线程或报单线程中调用，session为本会话的(FrontID, SessionID)
+        '''
+        if event == "request":
+            (direction, volume) = _direction_volume(field.Direction, field.CombOffsetFlag, field.VolumeTotalOriginal)
+            self.append({"type": "request", "key": order_key(session[0], session[1], field.OrderRef),
+                    "ref": int(field.OrderRef), "code": field.InstrumentID, "direction": direction,
+                    "price": field.LimitPrice, "volume": volume})
+        elif event == "order":
+            (direction, volume) = _direction_volume(field.Direction, field.CombOffsetFlag, field.VolumeTotalOriginal)
+            #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5
+            self.append({"type": "order", "key": order_key(field.FrontID, field.SessionID, field.OrderRef),
+                    "order_id": "%s@%s" % (field.OrderSysID, field.InstrumentID) if field.OrderSysID else None,
+                    "code": field.InstrumentID, "direction": direction, "price": field.LimitPrice,
+                    "volume": volume, "volume_traded": field.VolumeTraded,
+                    "is_active": field.OrderStatus not in ('0', '5') and field.OrderSubmitStatus != '4',
+                    "status": field.OrderStatus, "message": field.StatusMsg})
+        elif event == "insert_error":
+            #柜台拒绝的报单没有报单回报
+            self.append({"type": "order", "key": order_key(session[0], session[1], field.OrderRef),
+                    "is_active": False, "message": message})
+        elif event == "trade":
+            #买开、卖平影响多头持仓，卖开、买平影响空头持仓
+            is_buy = field.Direction == '0'         #THOST_FTDC_D_Buy
+            is_open = field.OffsetFlag == '0'       #THOST_FTDC_OF_Open
+            position = "long" if is_buy == is_open else "short"
+            self.append({"type": "trade", "key": trade_key(field),
+                    "order_id": "%s@%s" % (field.OrderSysID, field.InstrumentID), "code": field.InstrumentID,
+                    "position": position, "delta": field.Volume if is_open else -field.Volume,
+                    "price": field.Price, "time": field.TradeTime})
+
+    def orders(self):
+        '''
+        日志中的当日报单，格式同TraderImpl.getOrders
+        '''
+        with self._lock:
+            return {order["order_id"]: {"code": order["code"], "direction": order["direction"],
+                    "price": order["price"], "volume": order["volume"], "volume_traded": order["volume_traded"],
+                    "is_active": order["is_active"]}
+                    for order in self.state.orders.values() if order.get("order_id")}
+
+    def positions(self):
+        '''
+        持仓基准加当日成交推算的持仓
+        '''
+        with self._lock:
+            positions = []
+            for (key, volume) in self.state.positions.items():
+                if volume:
+                    (code, direction) = key.split("@")
+                    positions.append({"code": code, "direction": direction, "volume": volume})
+            return positions
+
+def _direction_volume(direction, offset_flag, volume):
+    #与TraderImpl.getOrders一致：平仓单的方向为所平持仓的方向，数量为负
+    direction = int(direction)
+    if offset_flag != '0':          #THOST_FTDC_OF_Open
+        (direction, volume) = (1 - direction, -volume)
+    return ("short" if direction else "long", volume)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import threading, time
+from collections import deque
+
+STAGES = ("exchange_to_receive", "receive_to_dequeue", "receive_to_handler", "handler_to_order")
+
+class LatencyTracer:
+    '''
+    tick到报单的分段延迟采样，按合约保存最近window个样本（纳秒）。
+    exchange_to_receive使用本机时钟与交易所UpdateTime比较，需本机时钟为北京时间并已校时；
+    其余各段均为同一进程内的monotonic时间差。
+    '''
+    def __init__(self, window=10000):
+        self._window = window
+        self._samples = {}
+        self._local = threading.local()
+
+    def _stage(self, code, stage):
+        stages = self._samples.get(code)
+        if stages is None:
+            stages = self._samples.setdefault(code,
+                    {name: deque(maxlen=self._window) for name in STAGES})
+        return stages[stage]
+
+    def onReceive(self, code, update_time, update_millisec, recv_wall_ns):
+        '''
+        CTP回调线程收到tick时调用
+        '''
+        if len(update_time) != 8:
+            return
+        exchange_sec = int(update_time[0:2]) * 3600 + int(update_time[3:5]) * 60 +       \
+                int(update_time[6:8]) + update_millisec / 1000
+        local = time.localtime(recv_wall_ns // 1000000000)
+        local_sec = local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec +        \
+                (recv_wall_ns % 1000000000) / 1e9
+        delta = local_sec - exchange_sec
+        #跨越午夜时修正
+        if delta < -43200:
+            delta += 86400
+        elif delta > 43200:
+            delta -= 86400
+        self._stage(code, "exchange_to_receive").append(int(delta * 1e9))
+
+    def beginHandler(self, tick, dequeue_ns):
+        '''
+        分发线程取出tick、即将调用处理函数时调用，记录当前线程正在处理的tick
+        '''
+        code = tick["code"]
+        handler_ns = time.monotonic_ns()
+        self._stage(code, "receive_to_dequeue").append(dequeue_ns - tick["recv_ns"])
+        self._stage(code, "receive_to_handler").append(handler_ns - tick["recv_ns"])
+        self._local.current = (code, handler_ns)
+        return handler_ns
+
+    def endHandler(self):
+        self._local.current = None
+
+    def resume(self, trace):
+        '''
+        网关IPC服务线程中调用：trace为策略进程处理tick时的(合约, 交给策略的时刻)，
+        据此把经IPC发起的报单记入handler_to_order。monotonic时钟在同一主机的各进程间一致
+        '''
+        self._local.current = tuple(trace) if trace else None
+
+    def onOrder(self):
+        '''
+        ReqOrderInsert前调用：若报单由tick处理函数在分发线程中发起，记录处理函数入口到报单的延迟
+        '''
+        current = getattr(self._local, "current", None)
+        if current is None:
+            return
+        (code, handler_ns) = current
+        self._stage(code, "handler_to_order").append(time.monotonic_ns() - handler_ns)
+
+    def report(self, code=None, percentiles=(50, 90, 99)):
+        '''
+        各合约各分段延迟的分位数，单位为微秒
+        '''
+        codes = list(self._samples) if code is None else [code]
+        data = {}
+        for code in codes:
+            stages = self._samples.get(code)
+            if stages is None:
+                continue
+            data[code] = {}
+            for (stage, samples) in stages.items():
+                values = sorted(samples)
+                if not values:
+                    continue
+                stat = {"count": len(values), "max": values[-1] / 1000}
+                for p in percentiles:
+                    stat["p%d" % p] = values[min(len(values) - 1, round(p / 100 * (len(values) - 1)))] / 1000
+                data[code][stage] = stat
+        return data
+
+TRACER = LatencyTracer()
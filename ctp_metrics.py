@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import threading, time, bisect, math
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class _Sharded:
+    '''
+    按线程分片的计数数组：每个线程只写自己的分片，热路径上无锁，汇总时再相加
+    '''
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0] * self._size
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+    def _sum(self):
+        with self._lock:
+            shards = list(self._shards)
+        return [sum(values) for values in zip(*shards)] if shards else [0] * self._size
+
+class _CounterChild(_Sharded):
+    def __init__(self):
+        _Sharded.__init__(self, 1)
+
+    def inc(self, amount=1):
+        self._shard()[0] += amount
+
+    def _samples(self, name, labels):
+        return [(name + "_total", labels, self._sum()[0])]
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def _samples(self, name, labels):
+        return [(name, labels, self._value)]
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+class _HistogramChild(_Sharded):
+    def __init__(self, buckets):
+        #各分桶计数，加上超出最大分桶的计数、sum与count
+        _Sharded.__init__(self, len(buckets) + 3)
+        self._buckets = buckets
+
+    def observe(self, value):
+        shard = self._shard()
+        shard[bisect.bisect_left(self._buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def _samples(self, name, labels):
+        values = self._sum()
+        samples = []
+        cumulative = 0
+        for (bound, count) in zip(self._buckets, values):
+            cumulative += count
+            samples.append((name + "_bucket", dict(labels, le=_format(bound)), cumulative))
+        samples.append((name + "_bucket", dict(labels, le="+Inf"), values[-1]))
+        samples.append((name + "_sum", labels, values[-2]))
+        samples.append((name + "_count", labels, values[-1]))
+        return samples
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not labelnames:
+            self._default = self._children[()] = self._newChild()
+        (registry or REGISTRY).register(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            assert(len(values) == len(self._labelnames))
+            with self._lock:
+                child = self._children.setdefault(values, self._newChild())
+        return child
+
+    def collect(self):
+        samples = []
+        for (values, child) in list(self._children.items()):
+            samples.extend(child._samples(self.name, dict(zip(self._labelnames, values))))
+        return (self.name, self.kind, self.documentation, samples)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _newChild(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _newChild(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self._buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, documentation, labelnames, registry)
+
+    def _newChild(self):
+        return _HistogramChild(self._buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def collect(self):
+        '''
+        全部指标的(名称, 类型, 说明, 样本列表)，可跨进程传递后合并输出
+        '''
+        return [metric.collect() for metric in self._metrics]
+
+def _format(value):
+    if isinstance(value, float) and math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render(*families_list):
+    '''
+    按Prometheus文本格式输出，多个来源的同名指标合并到同一个指标族
+    '''
+    merged = {}
+    for families in families_list:
+        for (name, kind, documentation, samples) in families:
+            if name not in merged:
+                merged[name] = (kind, documentation, [])
+            merged[name][2].extend(samples)
+    lines = []
+    for (name, (kind, documentation, samples)) in merged.items():
+        lines.append("# HELP %s %s" % (name, documentation))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for (sample_name, labels, value) in samples:
+            if labels:
+                label_text = ",".join('%s="%s"' % (k, _escape(v)) for (k, v) in labels.items())
+                lines.append("%s{%s} %s" % (sample_name, label_text, _format(value)))
+            else:
+                lines.append("%s %s" % (sample_name, _format(value)))
+    return "\n".join(lines) + "\n"
+
+def with_label(families, key, value):
+    '''
+    为全部样本追加标签，用于区分不同worker进程上报的指标
+    '''
+    return [(name, kind, documentation, [(sample_name, dict(labels, **{key: value}), v)
+            for (sample_name, labels, v) in samples])
+            for (name, kind, documentation, samples) in families]
+
+REGISTRY = Registry()
+HTTP_REGISTRY = Registry()
+
+# CTP网关进程指标
+TICKS = Counter("ctp_ticks", "按合约统计的tick数量", ["code"])
+TICK_DISPATCH = Histogram("ctp_tick_dispatch_seconds", "OnRtnDepthMarketData回调到调用处理函数的耗时")
+TICK_CALLBACK = Histogram("ctp_tick_callback_seconds", "OnRtnDepthMarketData在CTP回调线程上的总耗时")
+TICK_HANDLER = Histogram("ctp_tick_handler_seconds", "分发线程中tick处理函数的耗时")
+ORDER_INSERT = Histogram("ctp_order_insert_seconds", "报单录入到被接受（或成交/拒绝）的耗时", ["type", "result"])
+ORDER_CANCEL = Histogram("ctp_order_cancel_seconds", "撤单请求到撤单完成的耗时", ["result"])
+QUERY = Histogram("ctp_query_seconds", "CTP查询请求耗时（不含限频等待）", ["query"])
+FRONT_CONNECTED = Gauge("ctp_front_connected", "前置连接状态，1为已连接", ["front"])
+HEARTBEAT_WARNINGS = Counter("ctp_heartbeat_warnings", "心跳超时警告次数", ["front"])
+RSP_ERRORS = Counter("ctp_rsp_errors", "OnRspError错误应答次数", ["front"])
+STRATEGY_DROPPED = Counter("ctp_strategy_dropped", "策略tick队列已满丢弃的tick数", ["strategy"])
+TRIGGER_FIRE = Histogram("ctp_trigger_fire_seconds", "条件单触发到报单完成的耗时", ["result"])
+
+# Sanic worker进程指标
+HTTP_REQUESTS = Histogram("http_request_seconds", "HTTP请求处理耗时", ["path", "status"],
+        registry=HTTP_REGISTRY)
+UPSTREAM = Histogram("upstream_request_seconds", "外部行情资讯接口代理耗时", ["host"],
+        registry=HTTP_REGISTRY)
@@ -1,27 +1,37 @@
 # -*- coding: utf-8 -*-
 
-import json, datetime, time, logging, os, threading, re, aiohttp
+import json, datetime, time, logging, os, threading, re, aiohttp, multiprocessing, signal, sys, asyncio, queue
+from urllib.parse import urlsplit
 from sanic import Sanic, Blueprint, response
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.background import BackgroundScheduler
 from collections import defaultdict
 import ctpwrapper as CTP
 import ctpwrapper.ApiStructure as CTPStruct
+from ctp_gateway import TickTable, AsyncGatewayClient, serve
+import ctp_sim
+from ctp_latency import TRACER
+from ctp_greeks import OptionAnalytics
+from ctp_strategy import StrategyHost
+from ctp_synthetic import SyntheticEngine, parse_legs
+from ctp_subscription import SubscriptionRegistry, select
+from ctp_journal import Journal, trade_key, order_key
+from ctp_trigger import TriggerEngine
+from ctp_algo import ExecutionEngine
+from ctp_codec import negotiate, encode, join_object, EncodedCache, JSON
+from ctp_metrics import REGISTRY, HTTP_REGISTRY, render, with_label, TICKS, TICK_DISPATCH, TICK_CALLBACK,   \
+        TICK_HANDLER, ORDER_INSERT, ORDER_CANCEL, QUERY, FRONT_CONNECTED, HEARTBEAT_WARNINGS, RSP_ERRORS, HTTP_REQUESTS, UPSTREAM
 
 api = Blueprint('trade_ctp', url_prefix='/trade/ctp')
 
-# 通用工具
-@api.listener('before_server_start')
-async def before_server_start(app, loop):
-    '''全局共享session'''
-    global session, MAX_TIMEOUT, DATA_DIR, FILTER, logger, ctp_client, scheduler, base_url
-    jar = aiohttp.CookieJar(unsafe=True)
-    session = aiohttp.ClientSession(cookie_jar=jar, connector=aiohttp.TCPConnector(ssl=False))
-    base_url = 'http://127.0.0.1:7000/trade/ctp'
+MAX_TIMEOUT = 10
+#单次SubscribeMarketData的合约数上限，大批量订阅分批发送
+SUBSCRIBE_CHUNK = 500
+DATA_DIR = "ctp_client_data/"
+FILTER = lambda x: None if x > 1.797e+308 else x
+logger = logging.getLogger()
 
-    MAX_TIMEOUT = 10
-    DATA_DIR = "ctp_client_data/"
-
-    logger = logging.getLogger()
+# 通用工具
+def init_logger():
     handler = logging.StreamHandler()
     formatter = logging.Formatter(
             '%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
@@ -29,57 +39,160 @@ async def before_server_start(app, loop):
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
 
-    FILTER = lambda x: None if x > 1.797e+308 else x
-    
+def load_config():
     json_file = open("config.json")
     config = json.load(json_file)
     json_file.close()
-
-    user_id = config["investor_id"]
-    broker_id = config["broker_id"]
-    password = config["password"]
-    td_front = config["trader_server"]
-    md_front = config["md_server"]
-    app_id = config["app_id"]
-    auth_code = config["auth_code"]
-    
-    ctp_client = Client(md_front, td_front, broker_id, app_id, auth_code, user_id, password)
-
-    scheduler = AsyncIOScheduler()
- 
+    config.setdefault("workers", 1)
+    config.setdefault("gateway_address", DATA_DIR + "gateway.sock")
+    config.setdefault("gateway_authkey", "ctp_gateway")
+    config.setdefault("gateway_connections", 8)
+    config.setdefault("tick_table", "ctp_service_ticks")
+    config.setdefault("tick_slots", 4096)
+    config.setdefault("greeks_interval", 0.5)
+    config.setdefault("risk_free_rate", 0.0)
+    config.setdefault("strategies", [])
+    config.setdefault("strategy_ring_slots", 1024)
+    config.setdefault("synthetics", [])
+    config.setdefault("journal", True)
+    config.setdefault("journal_interval", 0.01)
+    config.setdefault("pre_trade_check", False)
+    config.setdefault("funds_refresh", 60)
+    return config
+
+def run_gateway(config):
+    '''
+    网关进程：唯一持有CTP行情、交易会话，负责定时登录登出，
+    将tick写入共享内存行情表，并通过本地IPC为各Sanic worker提供交易接口
+    '''
+    init_logger()
+    os.makedirs(DATA_DIR, exist_ok = True)
+    journal = Journal(DATA_DIR + "journal/", config["journal_interval"]) if config["journal"] else None
+    tick_table = TickTable(config["tick_table"], capacity=config["tick_slots"], create=True)
+    strategy_host = None
+    if config["strategies"]:
+        strategy_host = StrategyHost(config["strategies"], config["tick_table"], config["gateway_address"],
+                config["gateway_authkey"].encode(), config["strategy_ring_slots"])
+    client = Client(config["md_server"], config["trader_server"], config["broker_id"],
+            config["app_id"], config["auth_code"], config["investor_id"], config["password"],
+            tick_table=tick_table, greeks_interval=config["greeks_interval"], risk_free_rate=config["risk_free_rate"],
+            strategy_host=strategy_host, synthetics=config["synthetics"], journal=journal,
+            pre_trade_check=config["pre_trade_check"])
+
+    scheduler = BackgroundScheduler()
     now = datetime.datetime.now()
-    scheduler.add_job(login_request, 'cron', id='job_login', day_of_week='mon,tue,wed,thu,fri', hour='8,20', minute=40, second=0)
-    scheduler.add_job(logout_request, 'cron', id='job_logout', day_of_week='mon,tue,wed,thu,fri,sat', hour='15,2', minute=40, second=0)
+    scheduler.add_job(client.login, 'cron', id='job_login', day_of_week='mon,tue,wed,thu,fri', hour='8,20', minute=40, second=0)
+    scheduler.add_job(client.logout, 'cron', id='job_logout', day_of_week='mon,tue,wed,thu,fri,sat', hour='15,2', minute=40, second=0)
+    if config["pre_trade_check"]:
+        scheduler.add_job(client.refreshFunds, 'interval', id='job_funds', seconds=config["funds_refresh"])
 
     if (now.strftime("%H:%M") > '08:40' and now.strftime("%H:%M") < '14:55') or (now.strftime("%H:%M") > '20:40' or now.strftime("%H:%M") < '02:25') and now.weekday() < 6:
-        scheduler.add_job(login_request, trigger='date', next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=10), id="pad_task")
+        scheduler.add_job(client.login, trigger='date', next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=10), id="pad_task")
     scheduler.start()
 
-async def login_request():
-    return await get_json(base_url + '/login')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        #策略进程在网关开始监听后启动，以便其立即通过IPC报单
+        serve(client, config["gateway_address"], config["gateway_authkey"].encode(),
+                ready=strategy_host.start if strategy_host else None)
+    finally:
+        #清理过程中不再响应重复的终止信号
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        scheduler.shutdown(wait=False)
+        client.logout()
+        if strategy_host is not None:
+            strategy_host.stop()
+        if journal is not None:
+            journal.close()
+        tick_table.close(unlink=True)
+
+@api.listener('main_process_start')
+async def main_process_start(app, loop):
+    '''启动唯一的CTP网关进程'''
+    global gateway
+    gateway = multiprocessing.Process(target=run_gateway, args=(load_config(), ), name="ctp_gateway")
+    gateway.start()
+
+@api.listener('main_process_stop')
+async def main_process_stop(app, loop):
+    '''关闭CTP网关进程'''
+    gateway.terminate()
+    gateway.join(MAX_TIMEOUT)
+
+@api.listener('before_server_start')
+async def before_server_start(app, loop):
+    '''全局共享session'''
+    global session, ctp_client, tick_table, response_cache
+    jar = aiohttp.CookieJar(unsafe=True)
+    session = aiohttp.ClientSession(cookie_jar=jar, connector=aiohttp.TCPConnector(ssl=False))
+
+    init_logger()
+    config = load_config()
+    ctp_client = AsyncGatewayClient(config["gateway_address"], config["gateway_authkey"].encode(),
+            config["gateway_connections"])
+    tick_table = TickTable(config["tick_table"])
+    response_cache = EncodedCache()
+    app.add_task(report_metrics())
+
+async def report_metrics():
+    '''定时将本worker的HTTP指标上报给网关进程，由/metrics统一输出'''
+    while True:
+        await asyncio.sleep(5)
+        try:
+            await ctp_client.reportMetrics(os.getpid(), HTTP_REGISTRY.collect())
+        except Exception as e:
+            logger.debug("上报指标失败：%s" % e)
+
+@api.middleware('request')
+async def start_timer(request):
+    request.ctx.start_time = time.perf_counter()
+
+@api.middleware('response')
+async def record_latency(request, resp):
+    HTTP_REQUESTS.labels(request.path, str(resp.status)).observe(time.perf_counter() - request.ctx.start_time)
 
-async def logout_request():
-    return await get_json(base_url + '/logout')
-    
 @api.listener('after_server_stop')
 async def after_server_stop(app, loop):
     '''关闭session'''
-    ctp_client.logout()
+    ctp_client.close()
+    tick_table.close()
     await session.close()
-    scheduler.shutdown()
+
+def reply(request, data):
+    '''
+    按Accept头编码响应：JSON（缺省）、MessagePack，数组形状的数据还可为Arrow或NumPy列式格式
+    '''
+    (body, media) = encode(data, negotiate(request.headers.get("accept")))
+    return response.raw(body, content_type=media, headers={"Vary": "Accept"})
+
+async def reply_cached(request, key, load):
+    '''
+    合约信息只在登录时更新：按网关的合约版本复用已编码的响应，版本未变时不经过IPC取数也不重新编码。
+    load返回取数的协程
+    '''
+    formats = negotiate(request.headers.get("accept"))
+    version = await ctp_client.getInstrumentsVersion()
+    result = response_cache.find(key, version, formats)
+    if result is None:
+        result = response_cache.put(key, version, formats, await load())
+    (body, media) = result
+    return response.raw(body, content_type=media, headers={"Vary": "Accept"})
 
 async def get_json(url, headers={}):
     '''
     get请求json方法
     '''
-    async with session.get(url, headers=headers) as resp:
-        resp_json = await resp.json()
-        return resp_json
+    with UPSTREAM.labels(urlsplit(url).hostname).time():
+        async with session.get(url, headers=headers) as resp:
+            resp_json = await resp.json()
+            return resp_json
 
 class SpiHelper:
     def __init__(self):
         self._event = threading.Event()
         self._error = None
+        #同一会话只有一个完成事件，阻塞请求需串行执行
+        self._lock = threading.RLock()
 
     def resetCompletion(self):
         self._event.clear()
@@ -117,6 +230,7 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
     def __init__(self, front):
         SpiHelper.__init__(self)
         CTP.MdApiPy.__init__(self)
+        self._front_name = "md"
         self._receiver = None
         flow_dir = DATA_DIR + "md_flow/"
         os.makedirs(flow_dir, exist_ok = True)
@@ -126,10 +240,8 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
         self.waitCompletion("登录行情会话")
     
     def OnRspError(self, pRspInfo, nRequestID, bIsLast):
-        print("OnRspError:")
-        print("requestID:", nRequestID)
-        print(pRspInfo)
-        print(bIsLast)
+        RSP_ERRORS.labels(self._front_name).inc()
+        logger.error("OnRspError: requestID=%s, info=%s, is_last=%s" % (nRequestID, pRspInfo, bIsLast))
 
     def __del__(self):
         self.Release()
@@ -137,23 +249,26 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
 
     def shutdown(self):
         self.Release()
+        FRONT_CONNECTED.labels(self._front_name).set(0)
         logger.info("已登出行情服务器...")
 
     def OnFrontConnected(self):
         logger.info("已连接行情服务器...")
+        FRONT_CONNECTED.labels("md").set(1)
         field = CTPStruct.ReqUserLoginField()
         self.checkApiReturnInCallback(self.ReqUserLogin(field, 0))
         self.status = 0
         
     def OnFrontDisconnected(self, nReason):
         logger.info("已断开行情服务器:{}...".format(nReason))
-        print("Md OnFrontDisconnected {0}".format(nReason))
+        FRONT_CONNECTED.labels("md").set(0)
     
     def OnHeartBeatWarning(self, nTimeLapse):
         """心跳超时警告。当长时间未收到报文时，该方法被调用。
         @param nTimeLapse 距离上次接收报文的时间
         """
-        logger.info('Md OnHeartBeatWarning, time = {0}'.format(nTimeLapse))
+        logger.warning("行情服务器心跳超时警告，距上次收到报文%s秒..." % nTimeLapse)
+        HEARTBEAT_WARNINGS.labels("md").inc()
 
     def OnRspUserLogin(self, _, info, req_id, is_last):
         assert(req_id == 0)
@@ -170,22 +285,29 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
         return old_func
 
     def subscribe(self, codes):
-        self.resetCompletion()
-        self.checkApiReturn(self.SubscribeMarketData(codes))
-        self.waitCompletion("订阅行情")
+        for start in range(0, len(codes), SUBSCRIBE_CHUNK):
+            with self._lock:
+                self.resetCompletion()
+                self.checkApiReturn(self.SubscribeMarketData(codes[start: start + SUBSCRIBE_CHUNK]))
+                self.waitCompletion("订阅行情")
+        logger.info("已订阅%d个合约的行情..." % len(codes))
 
     def OnRspSubMarketData(self, field, info, _, is_last):
         if not self.checkRspInfoInCallback(info):
             assert(is_last)
             return
-        logger.info("已订阅<%s>的行情..." % field.InstrumentID)
+        logger.debug("已订阅<%s>的行情..." % field.InstrumentID)
         if is_last:
             self.notifyCompletion()
 
     def OnRtnDepthMarketData(self, field):
+        recv_ns = time.monotonic_ns()
+        start = time.perf_counter()
+        TICKS.labels(field.InstrumentID).inc()
+        TRACER.onReceive(field.InstrumentID, field.UpdateTime, field.UpdateMillisec, time.time_ns())
         if not self._receiver:
             return
-        self._receiver({"trade_time": field.TradingDay[:4] + '-' + field.TradingDay[4:6] + '-' + field.TradingDay[6:] + " " + field.UpdateTime, "update_sec": int(field.UpdateMillisec), 
+        tick = {"trade_time": field.TradingDay[:4] + '-' + field.TradingDay[4:6] + '-' + field.TradingDay[6:] + " " + field.UpdateTime, "update_sec": int(field.UpdateMillisec), 
                 "code": field.InstrumentID, "price": FILTER(field.LastPrice),
                 "open": FILTER(field.OpenPrice), "close": FILTER(field.ClosePrice),
                 "highest": FILTER(field.HighestPrice), "lowest": FILTER(field.LowestPrice),
@@ -205,25 +327,33 @@ class QuoteImpl(SpiHelper, CTP.MdApiPy):
                 "ask4": (FILTER(field.AskPrice4), field.AskVolume4),
                 "bid4": (FILTER(field.BidPrice4), field.BidVolume4),
                 "ask5": (FILTER(field.AskPrice5), field.AskVolume5),
-                "bid5": (FILTER(field.BidPrice5), field.BidVolume5)})
+                "bid5": (FILTER(field.BidPrice5), field.BidVolume5),
+                "recv_ns": recv_ns}
+        TICK_DISPATCH.observe(time.perf_counter() - start)
+        self._receiver(tick)
+        TICK_CALLBACK.observe(time.perf_counter() - start)
 
     def unsubscribe(self, codes):
-        self.resetCompletion()
-        self.checkApiReturn(self.UnSubscribeMarketData(codes))
-        self.waitCompletion("取消订阅行情")
+        for start in range(0, len(codes), SUBSCRIBE_CHUNK):
+            with self._lock:
+                self.resetCompletion()
+                self.checkApiReturn(self.UnSubscribeMarketData(codes[start: start + SUBSCRIBE_CHUNK]))
+                self.waitCompletion("取消订阅行情")
+        logger.info("已取消订阅%d个合约的行情..." % len(codes))
 
     def OnRspUnSubMarketData(self, field, info, _, is_last):
         if not self.checkRspInfoInCallback(info):
             assert(is_last)
             return
-        logger.info("已取消订阅<%s>的行情..." % field.InstrumentID)
+        logger.debug("已取消订阅<%s>的行情..." % field.InstrumentID)
         if is_last:
             self.notifyCompletion()
 
 class TraderImpl(SpiHelper, CTP.TraderApiPy):
-    def __init__(self, front, broker_id, app_id, auth_code, user_id, password):
+    def __init__(self, front, broker_id, app_id, auth_code, user_id, password, journal=None):
         SpiHelper.__init__(self)
         CTP.TraderApiPy.__init__(self)
+        self._front_name = "td"
         self._last_query_time = 0
         self._broker_id = broker_id
         self._app_id = app_id
@@ -234,16 +364,30 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         self._session_id = None
         self._order_action = None
         self._order_ref = 0
+        self._trading_day = None
+        self._journal = journal
+        self._listeners = []
+        self._async_refs = set()
+        #只保护OrderRef分配与报单、撤单请求，不与查询共用，非阻塞报单不会等待限频查询
+        self._insert_lock = threading.Lock()
+        self._wait_ref = None
+        #登录前登记，续传的回报也会写入日志
+        if journal is not None:
+            self.addListener(journal.onEvent)
         flow_dir = DATA_DIR + "td_flow/"
         os.makedirs(flow_dir, exist_ok = True)
         self.Create(flow_dir)
         self.RegisterFront(front)
-        self.SubscribePrivateTopic(2)   #THOST_TERT_QUICK
+        if journal is not None:
+            self.SubscribePrivateTopic(1)   #THOST_TERT_RESUME
+        else:
+            self.SubscribePrivateTopic(2)   #THOST_TERT_QUICK
         self.SubscribePublicTopic(2)    #THOST_TERT_QUICK
         self.Init()
         self.waitCompletion("登录交易会话")
         del self._app_id, self._auth_code, self._password
         self._getInstruments()
+        self._loadRates()
         self.instruments_option = defaultdict(list)
         self.instruments_future = defaultdict(list)
         self._buildInstrumentsDict()
@@ -260,29 +404,30 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
     
     def shutdown(self):
         self.Release()
+        FRONT_CONNECTED.labels(self._front_name).set(0)
         logger.info("已登出交易服务器...")
 
     def OnFrontConnected(self):
         logger.info("已连接交易服务器...")
+        FRONT_CONNECTED.labels("td").set(1)
         field = CTPStruct.ReqAuthenticateField(BrokerID = self._broker_id,
                 AppID = self._app_id, AuthCode = self._auth_code, UserID = self._user_id)
         self.checkApiReturnInCallback(self.ReqAuthenticate(field, 0))
     
     def OnRspError(self, pRspInfo, nRequestID, bIsLast):
-        print("OnRspError:")
-        print("requestID:", nRequestID)
-        print(pRspInfo)
-        print(bIsLast)
+        RSP_ERRORS.labels(self._front_name).inc()
+        logger.error("OnRspError: requestID=%s, info=%s, is_last=%s" % (nRequestID, pRspInfo, bIsLast))
 
     def OnHeartBeatWarning(self, nTimeLapse):
         """心跳超时警告。当长时间未收到报文时，该方法被调用。
         @param nTimeLapse 距离上次接收报文的时间
         """
-        logger.info("OnHeartBeatWarning time: ", nTimeLapse)
+        logger.warning("交易服务器心跳超时警告，距上次收到报文%s秒..." % nTimeLapse)
+        HEARTBEAT_WARNINGS.labels("td").inc()
 
     def OnFrontDisconnected(self, nReason):
         logger.info("已断开交易服务器:{}...".format(nReason))
-        print("OnFrontDisConnected:", nReason)
+        FRONT_CONNECTED.labels("td").set(0)
 
     def OnRspAuthenticate(self, _, info, req_id, is_last):
         assert(req_id == 0)
@@ -301,6 +446,11 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             return
         self._front_id = field.FrontID
         self._session_id = field.SessionID
+        self._trading_day = field.TradingDay
+        #OrderRef在交易日内单调递增，重启后从日志中已分配的最大值继续
+        self._order_ref = int(field.MaxOrderRef.strip() or 0)
+        if self._journal is not None:
+            self._order_ref = max(self._order_ref, self._journal.beginDay(field.TradingDay))
         logger.info("已登录交易会话...")
         field = CTPStruct.SettlementInfoConfirmField(BrokerID = self._broker_id,
                 InvestorID = self._user_id)
@@ -329,18 +479,19 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         self._instruments = {}
         self.resetCompletion()
         self._limitFrequency()
-        self.checkApiReturn(self.ReqQryInstrument(CTPStruct.QryInstrumentField(), 3))
-        last_count = 0
-        while True:
-            try:
-                self.waitCompletion("获取所有合约")
-                break
-            except TimeoutError as e:
-                count = len(self._instruments)
-                if count == last_count:
-                    raise e
-                logger.info("已获取%d个合约..." % count)
-                last_count = count
+        with QUERY.labels("instruments").time():
+            self.checkApiReturn(self.ReqQryInstrument(CTPStruct.QryInstrumentField(), 3))
+            last_count = 0
+            while True:
+                try:
+                    self.waitCompletion("获取所有合约")
+                    break
+                except TimeoutError as e:
+                    count = len(self._instruments)
+                    if count == last_count:
+                        raise e
+                    logger.info("已获取%d个合约..." % count)
+                    last_count = count
         fd = open(file_path, "w")
         fd.write(now_date + "\n")
         json.dump(self._instruments, fd, ensure_ascii=False)
@@ -379,20 +530,23 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                     "long_margin_ratio": FILTER(field.LongMarginRatio),
                     "short_margin_ratio": FILTER(field.ShortMarginRatio),
                     "option_type": option_type, "strike_price": FILTER(field.StrikePrice),
-                    "is_trading": bool(field.IsTrading)}
+                    "is_trading": bool(field.IsTrading), "max_limit_volume": field.MaxLimitOrderVolume,
+                    "min_limit_volume": field.MinLimitOrderVolume, "product": field.ProductID}
         if is_last:
             logger.info("已获取全部共%d个合约..." % len(self._instruments))
             self.notifyCompletion()
 
     def getAccount(self):
-        #THOST_FTDC_BZTP_Future = 1
-        field = CTPStruct.QryTradingAccountField(BrokerID = self._broker_id,
-                InvestorID = self._user_id, CurrencyID = "CNY", BizType = '1')
-        self.resetCompletion()
-        self._limitFrequency()
-        self.checkApiReturn(self.ReqQryTradingAccount(field, 8))
-        self.waitCompletion("获取资金账户")
-        return self._account
+        with self._lock:
+            #THOST_FTDC_BZTP_Future = 1
+            field = CTPStruct.QryTradingAccountField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id, CurrencyID = "CNY", BizType = '1')
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("account").time():
+                self.checkApiReturn(self.ReqQryTradingAccount(field, 8))
+                self.waitCompletion("获取资金账户")
+            return self._account
 
     def OnRspQryTradingAccount(self, field, info, req_id, is_last):
         assert(req_id == 8)
@@ -404,15 +558,151 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         logger.info("已获取资金账户...")
         self.notifyCompletion()
 
+    def _loadRates(self):
+        '''
+        加载当日已查询的保证金率与手续费率，缓存文件首行为交易日。期货与期权的手续费率分开保存，
+        同一品种的期货、期权不会共用费率
+        '''
+        self._rates_path = DATA_DIR + "rates.dat"
+        self._rates = {"margin": {}, "commission": {}, "option_commission": {}}
+        if os.path.exists(self._rates_path):
+            fd = open(self._rates_path)
+            cached_day = fd.readline()
+            if cached_day[: -1] == self._trading_day:
+                self._rates.update(json.load(fd))
+                logger.info("已加载%d个合约的保证金率、%d个期货与%d个期权品种的手续费率..." % (len(self._rates["margin"]),
+                        len(self._rates["commission"]), len(self._rates["option_commission"])))
+            fd.close()
+
+    def _saveRates(self):
+        fd = open(self._rates_path, "w")
+        fd.write(self._trading_day + "\n")
+        json.dump(self._rates, fd, ensure_ascii=False)
+        fd.close()
+
+    def getMarginRate(self, code, query=True):
+        '''
+        期货合约的保证金率，每个交易日每个合约只查询一次。柜台按相对交易所收取（IsRelative）时加上交易所保证金率。
+        query为假时只读缓存，未缓存则报错
+        '''
+        rate = self._rates["margin"].get(code)
+        if rate is not None:
+            return rate
+        if code not in self._instruments:
+            raise ValueError("合约<%s>不存在" % code)
+        instrument = self._instruments[code]
+        if instrument["option_type"] is not None:
+            raise ValueError("期权合约<%s>没有保证金率" % code)
+        if not query:
+            raise ValueError("合约<%s>的保证金率未缓存" % code)
+        with self._lock:
+            rate = self._rates["margin"].get(code)
+            if rate is not None:
+                return rate
+            (self._rate, self._rate_relative) = (None, False)
+            #THOST_FTDC_HF_Speculation
+            field = CTPStruct.QryInstrumentMarginRateField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id, InstrumentID = code, HedgeFlag = '1')
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("margin_rate").time():
+                self.checkApiReturn(self.ReqQryInstrumentMarginRate(field, 9))
+                self.waitCompletion("获取保证金率")
+            if self._rate is None:
+                raise ValueError("未查询到合约<%s>的保证金率" % code)
+            if self._rate_relative:
+                self._rate["long_by_money"] += instrument["long_margin_ratio"] or 0
+                self._rate["short_by_money"] += instrument["short_margin_ratio"] or 0
+            self._rates["margin"][code] = self._rate
+            self._saveRates()
+            return self._rate
+
+    def OnRspQryInstrumentMarginRate(self, field, info, req_id, is_last):
+        assert(req_id == 9)
+        if not self.checkRspInfoInCallback(info):
+            assert(is_last)
+            return
+        if field:
+            self._rate_relative = bool(field.IsRelative)
+            self._rate = {"long_by_money": field.LongMarginRatioByMoney, "long_by_volume": field.LongMarginRatioByVolume,
+                    "short_by_money": field.ShortMarginRatioByMoney, "short_by_volume": field.ShortMarginRatioByVolume}
+        if is_last:
+            logger.info("已获取保证金率...")
+            self.notifyCompletion()
+
+    def getCommissionRate(self, code, query=True):
+        '''
+        合约的手续费率，柜台通常按品种返回，同一品种的期货合约（或期权合约）共用一次查询。
+        期权经ReqQryOptionInstrCommRate查询，保存在option_commission中。query为假时只读缓存，未缓存则报错
+        '''
+        if code not in self._instruments:
+            raise ValueError("合约<%s>不存在" % code)
+        instrument = self._instruments[code]
+        product = instrument.get("product") or re.match(r"[A-Za-z]*", code).group()
+        is_option = instrument["option_type"] is not None
+        commission = self._rates["option_commission" if is_option else "commission"]
+        rate = commission.get(code) or commission.get(product)
+        if rate is not None:
+            return rate
+        if not query:
+            raise ValueError("合约<%s>的手续费率未缓存" % code)
+        with self._lock:
+            rate = commission.get(code) or commission.get(product)
+            if rate is not None:
+                return rate
+            (self._rate, self._rate_key) = (None, None)
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("commission_rate").time():
+                if is_option:
+                    field = CTPStruct.QryOptionInstrCommRateField(BrokerID = self._broker_id,
+                            InvestorID = self._user_id, InstrumentID = code)
+                    self.checkApiReturn(self.ReqQryOptionInstrCommRate(field, 11))
+                else:
+                    field = CTPStruct.QryInstrumentCommissionRateField(BrokerID = self._broker_id,
+                            InvestorID = self._user_id, InstrumentID = code)
+                    self.checkApiReturn(self.ReqQryInstrumentCommissionRate(field, 10))
+                self.waitCompletion("获取手续费率")
+            if self._rate is None:
+                raise ValueError("未查询到合约<%s>的手续费率" % code)
+            #按返回的合约或品种代码保存
+            commission[self._rate_key if self._rate_key in (code, product) else code] = self._rate
+            self._saveRates()
+            return self._rate
+
+    def _gotCommissionRate(self, field, info, is_last):
+        if not self.checkRspInfoInCallback(info):
+            assert(is_last)
+            return
+        if field:
+            self._rate_key = field.InstrumentID
+            self._rate = {"open_by_money": field.OpenRatioByMoney, "open_by_volume": field.OpenRatioByVolume,
+                    "close_by_money": field.CloseRatioByMoney, "close_by_volume": field.CloseRatioByVolume,
+                    "close_today_by_money": field.CloseTodayRatioByMoney,
+                    "close_today_by_volume": field.CloseTodayRatioByVolume}
+        if is_last:
+            logger.info("已获取手续费率...")
+            self.notifyCompletion()
+
+    def OnRspQryInstrumentCommissionRate(self, field, info, req_id, is_last):
+        assert(req_id == 10)
+        self._gotCommissionRate(field, info, is_last)
+
+    def OnRspQryOptionInstrCommRate(self, field, info, req_id, is_last):
+        assert(req_id == 11)
+        self._gotCommissionRate(field, info, is_last)
+
     def getOrders(self):
-        self._orders = {}
-        field = CTPStruct.QryOrderField(BrokerID = self._broker_id,
-                InvestorID = self._user_id)
-        self.resetCompletion()
-        self._limitFrequency()
-        self.checkApiReturn(self.ReqQryOrder(field, 4))
-        self.waitCompletion("获取所有报单")
-        return self._orders
+        with self._lock:
+            self._orders = {}
+            field = CTPStruct.QryOrderField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id)
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("orders").time():
+                self.checkApiReturn(self.ReqQryOrder(field, 4))
+                self.waitCompletion("获取所有报单")
+            return self._orders
 
     def _gotOrder(self, order):
         if len(order.OrderSysID) == 0:
@@ -443,14 +733,16 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             self.notifyCompletion()
 
     def getPositions(self):
-        self._positions = []
-        field = CTPStruct.QryInvestorPositionField(BrokerID = self._broker_id,
-                InvestorID = self._user_id)
-        self.resetCompletion()
-        self._limitFrequency()
-        self.checkApiReturn(self.ReqQryInvestorPosition(field, 5))
-        self.waitCompletion("获取所有持仓")
-        return self._positions
+        with self._lock:
+            self._positions = []
+            field = CTPStruct.QryInvestorPositionField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id)
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("positions").time():
+                self.checkApiReturn(self.ReqQryInvestorPosition(field, 5))
+                self.waitCompletion("获取所有持仓")
+            return self._positions
 
     def _gotPosition(self, position):
         code = position.InstrumentID
@@ -478,15 +770,61 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
             logger.info("已获取所有持仓...")
             self.notifyCompletion()
 
+    def getTrades(self):
+        '''
+        当日全部成交，key与交易日志中的成交编号一致
+        '''
+        with self._lock:
+            self._trades = []
+            field = CTPStruct.QryTradeField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id)
+            self.resetCompletion()
+            self._limitFrequency()
+            with QUERY.labels("trades").time():
+                self.checkApiReturn(self.ReqQryTrade(field, 12))
+                self.waitCompletion("获取所有成交")
+            return self._trades
+
+    def OnRspQryTrade(self, field, info, req_id, is_last):
+        assert(req_id == 12)
+        if not self.checkRspInfoInCallback(info):
+            assert(is_last)
+            return
+        if field:
+            self._trades.append({"key": trade_key(field), "code": field.InstrumentID,
+                    "price": field.Price, "volume": field.Volume, "time": field.TradeTime})
+        if is_last:
+            logger.info("已获取所有成交...")
+            self.notifyCompletion()
+
+    def addListener(self, func):
+        '''
+        登记监听函数func(event, field, session, message)：event为"request"（报单请求，field为InputOrderField）、
+        "order"（报单回报）、"trade"（成交回报），或非阻塞报单、撤单的"insert_error"、"action_error"（message为错误信息），
+        session为本会话的(FrontID, SessionID)
+        '''
+        self._listeners.append(func)
+
+    def _notify(self, event, field, message=None):
+        for listener in self._listeners:
+            try:
+                listener(event, field, (self._front_id, self._session_id), message)
+            except Exception as e:
+                logger.exception("报单监听函数异常：%s" % e)
+
     def OnRtnOrder(self, order):
+        self._notify("order", order)
         if self._order_action:
             if self._order_action(order):
                 self._order_action = None
 
+    def OnRtnTrade(self, trade):
+        self._notify("trade", trade)
+
     def _handleNewOrder(self, order):
         order_ref = None if len(order.OrderRef) == 0 else int(order.OrderRef)
         if (order.FrontID, order.SessionID, order_ref) !=               \
-                (self._front_id, self._session_id, self._order_ref):
+                (self._front_id, self._session_id, self._wait_ref):
             return False
         logging.debug(order)
         if order.OrderStatus == 'a':                #THOST_FTDC_OST_Unknown
@@ -515,7 +853,10 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 return True
         return False
 
-    def _order(self, code, direction, volume, price, min_volume):
+    def _buildOrder(self, code, direction, volume, price, min_volume):
+        '''
+        检查报单参数并分配OrderRef，返回(InputOrderField, 报单类型)，调用方持有_insert_lock
+        '''
         if code not in self._instruments:
             raise ValueError("合约<%s>不存在！" % code)
         exchange = self._instruments[code]["exchange"]
@@ -542,10 +883,12 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 price_type = '1'        #THOST_FTDC_OPT_AnyPrice
             #THOST_FTDC_TC_IOC, THOST_FTDC_VC_AV
             (time_cond, volume_cond) = ('1', '1')
+            order_type = "market"
         #Limit Price Order
         elif min_volume == 0:
             #THOST_FTDC_OPT_LimitPrice, THOST_FTDC_TC_GFD, THOST_FTDC_VC_AV
             (price_type, time_cond, volume_cond) = ('2', '3', '1')
+            order_type = "limit"
         #FAK Order
         else:
             min_volume = abs(min_volume)
@@ -553,8 +896,8 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 raise ValueError("最小成交量<%s>不能超过交易数量<%s>" % (min_volume, volume))
             #THOST_FTDC_OPT_LimitPrice, THOST_FTDC_TC_IOC, THOST_FTDC_VC_MV
             (price_type, time_cond, volume_cond) = ('2', '1', '2')
+            order_type = "fak"
         self._order_ref += 1
-        self._order_action = self._handleNewOrder
         field = CTPStruct.InputOrderField(BrokerID = self._broker_id,
                 InvestorID = self._user_id, ExchangeID = exchange, InstrumentID = code,
                 Direction = direction, CombOffsetFlag = offset_flag,
@@ -565,35 +908,91 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
                 ContingentCondition = '1',      #THOST_FTDC_CC_Immediately
                 ForceCloseReason = '0',         #THOST_FTDC_FCC_NotForceClose
                 OrderRef = "%12d" % self._order_ref)
-        self.resetCompletion()
-        self.checkApiReturn(self.ReqOrderInsert(field, 6))
-        self.waitCompletion("录入报单")
+        return (field, order_type)
+
+    def _order(self, code, direction, volume, price, min_volume):
+        with self._insert_lock:
+            (field, order_type) = self._buildOrder(code, direction, volume, price, min_volume)
+            #非阻塞报单会继续分配OrderRef，等待的是本次报单
+            self._wait_ref = self._order_ref
+            self._order_action = self._handleNewOrder
+            self._notify("request", field)
+            self.resetCompletion()
+            TRACER.onOrder()
+            start = time.perf_counter()
+            ret = self.ReqOrderInsert(field, 6)
+        result = "error"
+        try:
+            self.checkApiReturn(ret)
+            self.waitCompletion("录入报单")
+            result = "ok"
+        finally:
+            ORDER_INSERT.labels(order_type, result).observe(time.perf_counter() - start)
 
     def OnRspOrderInsert(self, field, info, req_id, is_last):
-        assert(req_id == 6)
+        assert(req_id in (6, 13))
         assert(is_last)
         self.OnErrRtnOrderInsert(field, info)
 
-    def OnErrRtnOrderInsert(self, _, info):
+    def OnErrRtnOrderInsert(self, field, info):
+        if field is not None:
+            self._notify("insert_error", field, info.ErrorMsg)
+            #非阻塞报单的错误只交给监听函数，不唤醒正在等待的阻塞请求
+            if self._isAsync(field.OrderRef):
+                return
         success = self.checkRspInfoInCallback(info)
         assert(not success)
 
+    def _isAsync(self, order_ref):
+        return order_ref.strip() != "" and int(order_ref) in self._async_refs
+
+    def insertOrder(self, code, direction, volume, price):
+        '''
+        非阻塞限价单：发出请求即返回报单标识，不等待回报，结果经监听函数的order、trade、insert_error事件通知
+        '''
+        assert(price > 0)
+        with self._insert_lock:
+            (field, order_type) = self._buildOrder(code, direction, volume, price, 0)
+            self._async_refs.add(self._order_ref)
+            self._notify("request", field)
+            TRACER.onOrder()
+            self.checkApiReturn(self.ReqOrderInsert(field, 13))
+            return order_key(self._front_id, self._session_id, field.OrderRef)
+
+    def cancelOrder(self, order_key, code):
+        '''
+        按报单标识非阻塞撤单，撤单失败经监听函数的action_error事件通知
+        '''
+        if code not in self._instruments:
+            raise ValueError("合约<%s>不存在" % code)
+        (front_id, session_id, order_ref) = order_key.split(":")
+        field = CTPStruct.InputOrderActionField(BrokerID = self._broker_id,
+                InvestorID = self._user_id, UserID = self._user_id,
+                ActionFlag = '0',               #THOST_FTDC_AF_Delete
+                ExchangeID = self._instruments[code]["exchange"], InstrumentID = code,
+                FrontID = int(front_id), SessionID = int(session_id), OrderRef = "%12d" % int(order_ref))
+        with self._insert_lock:
+            self.checkApiReturn(self.ReqOrderAction(field, 14))
+
     def orderMarket(self, code, direction, volume):
-        self._order(code, direction, volume, 0, 0)
-        return self._traded_volume
+        with self._lock:
+            self._order(code, direction, volume, 0, 0)
+            return self._traded_volume
 
     def orderFAK(self, code, direction, volume, price, min_volume):
         assert(price > 0)
-        self._order(code, direction, volume, price, 1 if min_volume == 0 else min_volume)
-        return self._traded_volume
+        with self._lock:
+            self._order(code, direction, volume, price, 1 if min_volume == 0 else min_volume)
+            return self._traded_volume
 
     def orderFOK(self, code, direction, volume, price):
         return self.orderFAK(code, direction, volume, price, volume)
 
     def orderLimit(self, code, direction, volume, price):
         assert(price > 0)
-        self._order(code, direction, volume, price, 0)
-        return self._order_id
+        with self._lock:
+            self._order(code, direction, volume, price, 0)
+            return self._order_id
 
     def _handleDeleteOrder(self, order):
         oid = "%s@%s" % (order.OrderSysID, order.InstrumentID)
@@ -611,36 +1010,75 @@ class TraderImpl(SpiHelper, CTP.TraderApiPy):
         return False
 
     def deleteOrder(self, order_id):
-        items = order_id.split("@")
-        if len(items) != 2:
-            raise ValueError("订单号<%s>格式错误" % order_id)
-        (sys_id, code) = items
-        if code not in self._instruments:
-            raise ValueError("订单号<%s>中的合约号<%s>不存在" % (order_id, code))
-        field = CTPStruct.InputOrderActionField(BrokerID = self._broker_id,
-                InvestorID = self._user_id, UserID = self._user_id,
-                ActionFlag = '0',               #THOST_FTDC_AF_Delete
-                ExchangeID = self._instruments[code]["exchange"],
-                InstrumentID = code, OrderSysID = sys_id)
-        self.resetCompletion()
-        self._order_id = order_id
-        self._order_action = self._handleDeleteOrder
-        self.checkApiReturn(self.ReqOrderAction(field, 7))
-        self.waitCompletion("撤销报单")
+        with self._lock:
+            items = order_id.split("@")
+            if len(items) != 2:
+                raise ValueError("订单号<%s>格式错误" % order_id)
+            (sys_id, code) = items
+            if code not in self._instruments:
+                raise ValueError("订单号<%s>中的合约号<%s>不存在" % (order_id, code))
+            field = CTPStruct.InputOrderActionField(BrokerID = self._broker_id,
+                    InvestorID = self._user_id, UserID = self._user_id,
+                    ActionFlag = '0',               #THOST_FTDC_AF_Delete
+                    ExchangeID = self._instruments[code]["exchange"],
+                    InstrumentID = code, OrderSysID = sys_id)
+            self.resetCompletion()
+            self._order_id = order_id
+            self._order_action = self._handleDeleteOrder
+            start = time.perf_counter()
+            result = "error"
+            try:
+                self.checkApiReturn(self.ReqOrderAction(field, 7))
+                self.waitCompletion("撤销报单")
+                result = "ok"
+            finally:
+                ORDER_CANCEL.labels(result).observe(time.perf_counter() - start)
 
     def OnRspOrderAction(self, field, info, req_id, is_last):
-        assert(req_id == 7)
+        assert(req_id in (7, 14))
         assert(is_last)
+        if req_id == 14:
+            self._notify("action_error", field, info.ErrorMsg)
+            return
         self.OnErrRtnOrderAction(field, info)
 
-    def OnErrRtnOrderAction(self, _, info):
+    def OnErrRtnOrderAction(self, field, info):
+        if field is not None and self._isAsync(field.OrderRef):
+            self._notify("action_error", field, info.ErrorMsg)
+            return
         success = self.checkRspInfoInCallback(info)
         assert(not success)
 
 class Client:
-    def __init__(self, md_front, td_front, broker_id, app_id, auth_code, user_id, password):
+    def __init__(self, md_front, td_front, broker_id, app_id, auth_code, user_id, password, tick_table=None,
+            greeks_interval=0.5, risk_free_rate=0.0, strategy_host=None, synthetics=None, journal=None,
+            pre_trade_check=False):
         self._md = None
         self._td = None
+        self._journal = journal
+        self._table = tick_table
+        self._strategies = strategy_host
+        self._synthetics = SyntheticEngine()
+        self._synthetic_configs = list(synthetics or [])
+        self._subscriptions = SubscriptionRegistry()
+        self._subscription_lock = threading.Lock()
+        self._triggers = TriggerEngine(self._fireTrigger)
+        self._trigger_lock = threading.Lock()
+        self._algos = ExecutionEngine(self, lambda algo: self._releaseAlgo(algo.code))
+        self._algo_lock = threading.Lock()
+        self._pre_trade_check = pre_trade_check
+        self._funds = None
+        self._funds_lock = threading.Lock()
+        self._pending_funds = threading.local()
+        self._analytics = None
+        self._instruments_version = None
+        self._greeks_interval = greeks_interval
+        self._risk_free_rate = risk_free_rate
+        self._handler = None
+        self._lock = threading.Lock()
+        self._worker_metrics = {}
+        self._ticks = queue.SimpleQueue()
+        threading.Thread(target=self._dispatch, name="tick_dispatch", daemon=True).start()
         self.md_front = md_front
         self.td_front = td_front
         self.broker_id = broker_id
@@ -653,34 +1091,338 @@ class Client:
         '''
         登录行情、交易
         '''
-        self._td = TraderImpl(self.td_front, self.broker_id, self.app_id, self.auth_code, self.user_id, self.password)
-        self._md = QuoteImpl(self.md_front)
+        with self._lock:
+            if self._td is not None:
+                logger.info("已登录，忽略重复登录...")
+                return
+            trader_cls = ctp_sim.simulate(TraderImpl) if self.td_front.startswith("sim://") else TraderImpl
+            quote_cls = ctp_sim.simulate(QuoteImpl) if self.md_front.startswith("sim://") else QuoteImpl
+            td = trader_cls(self.td_front, self.broker_id, self.app_id, self.auth_code, self.user_id, self.password,
+                    journal=self._journal)
+            try:
+                md = quote_cls(self.md_front)
+            except:
+                td.shutdown()
+                raise
+            if self._journal is not None and self._journal.needPositions():
+                #每个交易日查询一次持仓作为基准，之后由成交回报推算；基准已包含的成交在续传时不再计入。
+                #先查成交再查持仓：两次查询之间的成交计入持仓但不在成交列表中，其回报更新持仓后被基准覆盖，
+                #反过来则会在续传时被跳过
+                try:
+                    trades = [trade["key"] for trade in td.getTrades()]
+                    self._journal.setPositions(td.getPositions(), trades)
+                except Exception as e:
+                    logger.warning("查询持仓基准失败：%s" % e)
+            if self._analytics is not None:
+                self._analytics.close()
+            self._analytics = OptionAnalytics(td.instruments_option, self._greeks_interval, self._risk_free_rate)
+            md.setReceiver(self._onTick)
+            td.addListener(self._onOrderEvent)
+            td.addListener(self._algos.onOrderEvent)
+            (self._td, self._md) = (td, md)
+            self._instruments_version = time.time()
+            if self._strategies is None:
+                self.setReceiver()
+            for config in self._synthetic_configs:
+                if self._synthetics.has(config["name"]):
+                    continue
+                try:
+                    self._synthetics.define(config["name"], config["legs"], td._instruments, config.get("notional", False))
+                    self._subscriptions.add("synthetic:" + config["name"], self._synthetics.legs(config["name"]))
+                except ValueError as e:
+                    logger.error("合成合约<%s>定义错误：%s" % (config["name"], e))
+            if self._strategies is not None:
+                for (name, codes) in self._strategies.subscriptions().items():
+                    missing = [code for code in codes if code not in td._instruments and not self._synthetics.has(code)]
+                    if missing:
+                        logger.warning("策略<%s>的合约不存在：%s" % (name, missing))
+                    self._subscriptions.add("strategy:" + name, self._resolve(
+                            [code for code in codes if code not in missing]))
+            #新的行情会话需重新订阅登记的全部合约
+            codes = self._subscriptions.codes()
+            if codes:
+                md.subscribe(codes)
     
     def logout(self):
         '''
         登出
         '''
-        self._md.shutdown()
-        self._td.shutdown()
+        with self._lock:
+            if self._td is None:
+                return
+            self._md.shutdown()
+            self._td.shutdown()
+            self._md = None
+            self._td = None
+            self._funds = None
+            if self._journal is not None:
+                self._journal.sync()
+
+    def _onTick(self, tick):
+        '''
+        CTP回调线程：期权tick附上最近的希腊字母，写入共享内存行情表后交给分发线程，避免处理函数阻塞CTP线程，
+        再增量计算依赖该合约的合成合约
+        '''
+        analytics = self._analytics
+        if analytics is not None:
+            analytics.annotate(tick)
+        if self._table is not None:
+            self._table.put(tick["code"], tick)
+        #条件单在CTP回调线程中判断，不经过分发队列
+        self._triggers.onTick(tick)
+        self._algos.onTick(tick)
+        self._ticks.put(tick)
+        #依赖该合约的合成合约与真实tick一样写入行情表并分发
+        for synthetic_tick in self._synthetics.onTick(tick):
+            self._onTick(synthetic_tick)
+
+    def _dispatch(self):
+        '''
+        分发线程：按到达顺序调用tick处理函数，期权链只更新价格，重算在期权分析线程中进行
+        '''
+        while True:
+            tick = self._ticks.get()
+            dequeue_ns = time.monotonic_ns()
+            analytics = self._analytics
+            if analytics is not None:
+                try:
+                    analytics.onTick(tick)
+                except Exception as e:
+                    logger.exception("期权分析异常：%s" % e)
+            strategies = self._strategies
+            if strategies is not None:
+                #交给策略进程的时刻作为处理函数入口，随tick传给策略，策略经IPC报单时带回
+                tick["trace_ns"] = TRACER.beginHandler(tick, dequeue_ns)
+                try:
+                    strategies.onTick(tick)
+                except Exception as e:
+                    logger.exception("策略tick分发异常：%s" % e)
+                finally:
+                    TRACER.endHandler()
+            handler = self._handler
+            if not handler:
+                continue
+            TRACER.beginHandler(tick, dequeue_ns)
+            try:
+                with TICK_HANDLER.time():
+                    handler(tick)
+            except Exception as e:
+                logger.exception("tick处理函数异常：%s" % e)
+            finally:
+                TRACER.endHandler()
     
     def setReceiver(self):
         '''
-        tick行情处理函数
+        未配置策略时，在网关进程内以hq_func.parse_hq处理tick（仅导入一次）
         '''
+        if self._handler is not None:
+            return
         try:
             from hq_func import parse_hq
         except:
             parse_hq = lambda x: print(x)
-        return self._md.setReceiver(parse_hq)
+        self._handler = parse_hq
 
-    def subscribe(self, codes):
+    def _resolve(self, codes):
         '''
-        订阅合约代码
+        检查合约代码，合成合约替换为其全部腿
         '''
+        resolved = []
         for code in codes:
-            if code not in self._td._instruments:
+            if self._synthetics.has(code):
+                resolved.extend(self._synthetics.legs(code))
+            elif code not in self._td._instruments:
                 raise ValueError("合约<%s>不存在" % code)
-        self._md.subscribe(codes)
+            else:
+                resolved.append(code)
+        return resolved
+
+    def _select(self, codes, exchange, product, chain, all):
+        if self._td is None:
+            raise ValueError("未登录")
+        selected = self._resolve(codes or [])
+        selected.extend(select(self._td._instruments, self._td.instruments_option, exchange, product, chain, all))
+        return sorted(set(selected))
+
+    def _changeSubscription(self, consumer, add=(), remove=(), counted=False):
+        '''
+        更新订阅登记，只向CTP订阅首次被订阅的合约、退订已无人订阅的合约，counted见SubscriptionRegistry.add
+        '''
+        with self._subscription_lock:
+            added = self._subscriptions.add(consumer, add, counted)
+            removed = self._subscriptions.remove(consumer, remove, counted)
+            md = self._md
+            if md is not None and added:
+                try:
+                    md.subscribe(added)
+                except:
+                    self._subscriptions.remove(consumer, added)
+                    raise
+            if md is not None and removed:
+                md.unsubscribe(removed)
+        return (added, removed)
+
+    def subscribe(self, codes=None, consumer=None, exchange=None, product=None, chain=None, all=False):
+        '''
+        订阅合约代码，或按交易所、品种、期权链标的、全部在交易合约批量订阅；合成合约订阅其全部腿。
+        按订阅方consumer登记，重复订阅不会重复请求CTP。未指定consumer时登记到共用的"default"，
+        每次订阅各计一次引用，不同调用方的退订互不影响
+        '''
+        codes = self._select(codes, exchange, product, chain, all)
+        (added, _) = self._changeSubscription(consumer or "default", add=codes, counted=consumer is None)
+        return {"consumer": consumer or "default", "codes": len(codes), "subscribed": len(added)}
+
+    def unsubscribe(self, codes=None, consumer=None, exchange=None, product=None, chain=None, all=False):
+        '''
+        取消该订阅方的订阅，all为真时取消其全部订阅；仍有其它订阅方的合约不会向CTP退订。
+        未指定consumer时每个合约减少一次"default"的引用
+        '''
+        if all:
+            codes = self._subscriptions.consumers().get(consumer or "default", [])
+            counted = False
+        else:
+            codes = self._select(codes, exchange, product, chain, False)
+            counted = consumer is None
+        (_, removed) = self._changeSubscription(consumer or "default", remove=codes, counted=counted)
+        return {"consumer": consumer or "default", "codes": len(codes), "unsubscribed": len(removed)}
+
+    def getSubscriptions(self):
+        '''
+        各订阅方订阅的合约
+        '''
+        return self._subscriptions.consumers()
+
+    def defineSynthetic(self, name, legs, notional=False):
+        '''
+        定义价差或篮子合约并订阅其腿，notional为真时各腿乘以合约乘数
+        '''
+        definition = self._synthetics.define(name, legs, self._td._instruments, notional)
+        consumer = "synthetic:" + name
+        codes = self._synthetics.legs(name)
+        old = self._subscriptions.consumers().get(consumer, [])
+        self._changeSubscription(consumer, add=codes, remove=set(old).difference(codes))
+        return definition
+
+    def removeSynthetic(self, name):
+        '''
+        删除合成合约，退订已无其它订阅方的腿
+        '''
+        self._synthetics.remove(name)
+        consumer = "synthetic:" + name
+        self._changeSubscription(consumer, remove=self._subscriptions.consumers().get(consumer, []))
+
+    def getSynthetics(self):
+        '''
+        全部合成合约定义
+        '''
+        return self._synthetics.definitions()
+
+    def createTrigger(self, code, direction, volume, condition, trigger_price, order_type="market", price=0,
+            source="last"):
+        '''
+        创建本地条件单：source（last、bid、ask）价格上涨到（condition为ge）或下跌到（le）trigger_price时，
+        按order_type（market、limit、fak）报单，volume为负时平仓。合约有未触发的条件单时以"trigger"为订阅方订阅
+        '''
+        if self._td is None:
+            raise ValueError("未登录")
+        if code not in self._td._instruments:
+            raise ValueError("合约<%s>不存在" % code)
+        #订阅与登记条件单之间不能被已触发的条件单退订
+        with self._trigger_lock:
+            self._changeSubscription("trigger", add=[code])
+            try:
+                return self._triggers.add(code, direction, volume, condition, trigger_price, order_type, price, source)
+            finally:
+                if not self._triggers.triggers(code, active=True):
+                    self._changeSubscription("trigger", remove=[code])
+
+    def _releaseTrigger(self, code):
+        '''
+        合约已没有未触发的条件单时退订
+        '''
+        with self._trigger_lock:
+            if not self._triggers.triggers(code, active=True):
+                self._changeSubscription("trigger", remove=[code])
+
+    def _fireTrigger(self, trigger):
+        '''
+        条件单报单线程中调用，报单后按需退订
+        '''
+        try:
+            td = self._td
+            if td is None:
+                raise ValueError("未登录")
+            (code, direction, volume, price) = (trigger["code"], trigger["direction"], trigger["volume"], trigger["price"])
+            #与其它报单一致做资金检查，市价条件单按触发时的最新价估算
+            if trigger["order_type"] == "market":
+                return self._submit(code, direction, volume, price or None, td.orderMarket, code, direction, volume)
+            elif trigger["order_type"] == "fak":
+                return self._submit(code, direction, volume, price, td.orderFAK, code, direction, volume, price, 0)
+            else:
+                return self._submit(code, direction, volume, price, td.orderLimit, code, direction, volume, price)
+        finally:
+            self._releaseTrigger(trigger["code"])
+
+    def cancelTrigger(self, trigger_id):
+        '''
+        撤销尚未触发的条件单
+        '''
+        trigger = self._triggers.cancel(trigger_id)
+        self._releaseTrigger(trigger["code"])
+        return trigger
+
+    def getTriggers(self, code=None, active=False):
+        '''
+        当日条件单及其状态，active为真时只返回尚未触发的
+        '''
+        return self._triggers.triggers(code, active)
+
+    def createAlgo(self, kind, code, direction, volume, params):
+        '''
+        创建执行算法母单，kind为twap、iceberg或chase，params见ctp_algo。运行期间以"algo"为订阅方订阅该合约
+        '''
+        if self._td is None:
+            raise ValueError("未登录")
+        if code not in self._td._instruments:
+            raise ValueError("合约<%s>不存在" % code)
+        self._prefetchFunds(code)
+        #订阅与登记母单之间不能被结束的母单退订
+        with self._algo_lock:
+            self._changeSubscription("algo", add=[code])
+            try:
+                return self._algos.create(kind, code, direction, volume, params)
+            finally:
+                if not self._algos.running(code):
+                    self._changeSubscription("algo", remove=[code])
+
+    def _releaseAlgo(self, code):
+        '''
+        合约已没有运行中的母单时退订
+        '''
+        with self._algo_lock:
+            if not self._algos.running(code):
+                self._changeSubscription("algo", remove=[code])
+
+    def cancelAlgo(self, algo_id):
+        '''
+        撤销母单：停止拆单并撤销全部挂单中的子单
+        '''
+        return self._algos.cancel(algo_id)
+
+    def getAlgo(self, algo_id):
+        return self._algos.get(algo_id)
+
+    def getAlgos(self, active=False):
+        '''
+        当日母单及其执行进度，active为真时只返回运行中的
+        '''
+        return self._algos.algos(active)
+
+    def getInstrumentsVersion(self):
+        '''
+        合约信息版本，每次登录重新加载合约后改变，未登录时为None
+        '''
+        return self._instruments_version if self._td is not None else None
 
     def get_instruments_option(self, future=None):
         '''
@@ -698,11 +1440,57 @@ class Client:
             return self._td.instruments_future
         return self._td.instruments_future[exchange]
 
-    def unsubscribe(self, codes):
+    def reportMetrics(self, pid, families):
+        '''
+        接收Sanic worker上报的HTTP指标
+        '''
+        self._worker_metrics[pid] = (time.time(), families)
+
+    def metrics(self, pid=None, families=None):
+        '''
+        Prometheus文本格式的全部指标：网关进程的CTP指标加各worker最近上报的HTTP指标
+        '''
+        if pid is not None:
+            self.reportMetrics(pid, families)
+        now = time.time()
+        reports = []
+        for (worker_pid, (report_time, worker_families)) in list(self._worker_metrics.items()):
+            #超过1分钟未上报的worker视为已退出
+            if now - report_time > 60:
+                del self._worker_metrics[worker_pid]
+                continue
+            reports.append(with_label(worker_families, "worker", str(worker_pid)))
+        return render(REGISTRY.collect(), *reports)
+
+    def getLatency(self, code=None):
+        '''
+        tick到报单各分段延迟的分位数（微秒），可指定合约
+        '''
+        return TRACER.report(code)
+
+    def getOptionGreeks(self, underlying):
         '''
-        取消订阅
+        期权链隐含波动率与希腊字母
         '''
-        self._md.unsubscribe(codes)
+        if self._analytics is None:
+            raise ValueError("未登录")
+        return self._analytics.greeks(underlying)
+
+    def getStrategies(self):
+        '''
+        各策略进程状态
+        '''
+        if self._strategies is None:
+            return []
+        return self._strategies.status()
+
+    def reloadStrategy(self, name):
+        '''
+        重启策略进程，不影响行情会话
+        '''
+        if self._strategies is None:
+            raise ValueError("未配置策略")
+        self._strategies.reload(name)
 
     def getInstrument(self, code):
         '''
@@ -714,45 +1502,205 @@ class Client:
 
     def getAccount(self):
         '''
-        获取账号资金情况
+        获取账号资金情况，同时作为报单前资金检查的基准
         '''
-        return self._td.getAccount()
+        account = self._td.getAccount()
+        with self._funds_lock:
+            #orders为各报单的(预占资金, 报单数量)
+            self._funds = {"available": account["available"], "reserved": 0.0, "orders": {}}
+        return account
 
-    def getOrders(self):
+    def refreshFunds(self):
+        '''
+        定时刷新资金检查的基准，清除已成交部分的预占资金
         '''
-        获取当天订单
+        if self._td is not None:
+            self.getAccount()
+
+    def estimate(self, code, volume, price=None, direction="long", query=True):
         '''
+        按缓存的保证金率、手续费率在本地估算报单占用的保证金与手续费，只在交易日内首次用到的合约、品种时查询费率。
+        volume为正表示开仓、为负表示平仓，price缺省时取行情表中的最新价；query为假时费率未缓存则报错
+        '''
+        td = self._td
+        if td is None:
+            raise ValueError("未登录")
+        if direction not in ("long", "short"):
+            raise ValueError("错误的买卖方向<%s>" % direction)
+        if volume != int(volume) or volume == 0:
+            raise ValueError("交易数量<%s>必须是非零整数" % volume)
+        instrument = self.getInstrument(code)
+        if not price:
+            tick = self._table.get(code) if self._table is not None else None
+            price = tick["price"] if tick else None
+            if not price:
+                raise ValueError("合约<%s>没有最新价，需指定价格" % code)
+        count = abs(int(volume))
+        amount = price * instrument["multiple"] * count
+        fee = td.getCommissionRate(code, query)
+        (margin, premium) = (0.0, 0.0)
+        if volume > 0:
+            if instrument["option_type"] is not None and direction == "long":
+                #期权买方支付权利金，不收保证金
+                premium = amount
+            elif instrument["option_type"] is not None:
+                margin = self._optionMargin(instrument, code, price, query) * count
+            else:
+                rate = td.getMarginRate(code, query)
+                margin = amount * rate[direction + "_by_money"] + count * rate[direction + "_by_volume"]
+            commission = commission_today = amount * fee["open_by_money"] + count * fee["open_by_volume"]
+        else:
+            commission = amount * fee["close_by_money"] + count * fee["close_by_volume"]
+            commission_today = amount * fee["close_today_by_money"] + count * fee["close_today_by_volume"]
+        data = {"code": code, "direction": direction, "volume": int(volume), "price": price,
+                "amount": round(amount, 2), "margin": round(margin, 2), "premium": round(premium, 2),
+                "commission": round(commission, 2), "commission_today": round(commission_today, 2),
+                "required": round(margin + premium + commission, 2), "available": None}
+        with self._funds_lock:
+            if self._funds is not None:
+                data["available"] = round(self._funds["available"] - self._funds["reserved"], 2)
+        return data
+
+    def _optionMargin(self, instrument, code, price, query=True):
+        '''
+        期权卖方每手保证金，按交易所公式：权利金 + max(标的保证金 - k×虚值额, 0.5×标的保证金)，
+        股指期权k为1、商品期权k为0.5。标的保证金按标的期货的保证金率（看涨用空头、看跌用多头）与最新价计算
+        '''
+        underlying = self._analytics.underlying(code) if self._analytics is not None else None
+        if underlying is None or underlying not in self._td._instruments:
+            raise ValueError("期权<%s>的标的期货不存在" % code)
+        tick = self._table.get(underlying) if self._table is not None else None
+        underlying_price = tick["price"] if tick else None
+        if not underlying_price:
+            raise ValueError("标的合约<%s>没有最新价" % underlying)
+        rate = self._td.getMarginRate(underlying, query)
+        is_call = instrument["option_type"] == "call"
+        side = "short" if is_call else "long"
+        multiple = instrument["multiple"]
+        underlying_margin = (underlying_price * rate[side + "_by_money"] +
+                rate[side + "_by_volume"] / self._td._instruments[underlying]["multiple"]) * multiple
+        strike = instrument["strike_price"] or 0
+        out_of_money = max(strike - underlying_price if is_call else underlying_price - strike, 0) * multiple
+        k = 1.0 if instrument["exchange"] == "CFFEX" else 0.5
+        return price * multiple + max(underlying_margin - k * out_of_money, 0.5 * underlying_margin)
+
+    def _checkFunds(self, code, direction, volume, price, query=True):
+        '''
+        报单前资金检查：开仓所需的保证金、权利金与手续费不能超过可用资金减去此前报单的预占。
+        预占在报单请求发出时归属该报单，撤单、拒单时释放未成交部分，已成交部分在下次查询资金账户时清零。
+        query为假时只用缓存的资金与费率，不发出查询
+        '''
+        self._pending_funds.amount = None
+        if not self._pre_trade_check or volume <= 0:
+            return
+        if self._funds is None:
+            if not query:
+                raise ValueError("尚未查询资金账户")
+            self.getAccount()
+        required = self.estimate(code, volume, price, direction, query)["required"]
+        with self._funds_lock:
+            available = self._funds["available"] - self._funds["reserved"]
+            if required > available:
+                raise ValueError("可用资金不足：预计占用%.2f，可用%.2f" % (required, available))
+            self._funds["reserved"] += required
+        self._pending_funds.amount = required
+
+    def _submit(self, code, direction, volume, price, func, *args, query=True):
+        '''
+        资金检查后在同一线程中调用func报单，报单请求未发出时释放预占
+        '''
+        self._checkFunds(code, direction, volume, price, query)
+        try:
+            return func(*args)
+        finally:
+            amount = self._pending_funds.amount
+            if amount:
+                self._pending_funds.amount = None
+                with self._funds_lock:
+                    if self._funds is not None:
+                        self._funds["reserved"] -= amount
+
+    def _onOrderEvent(self, event, field, session, message=None):
+        '''
+        TraderImpl监听函数：报单请求发出时登记预占资金，报单撤销、被拒绝或全部成交时释放未成交部分
+        '''
+        if event == "request":
+            amount = getattr(self._pending_funds, "amount", None)
+            if not amount:
+                return
+            self._pending_funds.amount = None
+            with self._funds_lock:
+                if self._funds is not None:
+                    key = order_key(session[0], session[1], field.OrderRef)
+                    self._funds["orders"][key] = (amount, field.VolumeTotalOriginal)
+        elif event == "order":
+            #THOST_FTDC_OST_AllTraded = 0, THOST_FTDC_OST_Canceled = 5, THOST_FTDC_OSS_InsertRejected = 4
+            if field.OrderStatus in ('0', '5') or field.OrderSubmitStatus == '4':
+                self._releaseFunds(order_key(field.FrontID, field.SessionID, field.OrderRef), field.VolumeTraded)
+        elif event == "insert_error":
+            self._releaseFunds(order_key(session[0], session[1], field.OrderRef), 0)
+
+    def _releaseFunds(self, key, volume_traded):
+        with self._funds_lock:
+            if self._funds is None:
+                return
+            entry = self._funds["orders"].pop(key, None)
+            if entry is not None:
+                (amount, volume) = entry
+                self._funds["reserved"] -= amount * (volume - volume_traded) / volume
+
+    def _prefetchFunds(self, code):
+        '''
+        在调用方线程中查询资金账户与合约费率，之后该合约的资金检查只用缓存
+        '''
+        if not self._pre_trade_check:
+            return
+        if self._funds is None:
+            self.getAccount()
+        self._td.getCommissionRate(code)
+        underlying = self._analytics.underlying(code) if self._analytics is not None else None
+        self._td.getMarginRate(underlying or code)
+
+    def getOrders(self, cached=False):
+        '''
+        获取当天订单，cached为真时直接返回交易日志中的状态，不经过限频查询
+        '''
+        if cached and self._journal is not None:
+            return self._journal.orders()
         return self._td.getOrders()
 
-    def getPositions(self):
+    def getPositions(self, cached=False):
         '''
-        获取持仓
+        获取持仓，cached为真时返回持仓基准加当日成交推算的持仓（不含保证金与成本）
         '''
+        if cached and self._journal is not None:
+            return self._journal.positions()
         return self._td.getPositions()
 
     def orderMarket(self, code, direction, volume):
         '''
         市价下单
         '''
-        return self._td.orderMarket(code, direction, volume)
+        return self._submit(code, direction, volume, None, self._td.orderMarket, code, direction, volume)
 
     def orderFAK(self, code, direction, volume, price, min_volume):
         '''
         FAK下单
         '''
-        return self._td.orderFAK(code, direction, volume, price, min_volume)
+        return self._submit(code, direction, volume, price, self._td.orderFAK, code, direction, volume, price,
+                min_volume)
 
     def orderFOK(self, code, direction, volume, price):
         '''
         FOK下单
         '''
-        return self._td.orderFOK(code, direction, volume, price)
+        return self._submit(code, direction, volume, price, self._td.orderFOK, code, direction, volume, price)
 
     def orderLimit(self, code, direction, volume, price):
         '''
         限价单
         '''
-        return self._td.orderLimit(code, direction, volume, price)
+        return self._submit(code, direction, volume, price, self._td.orderLimit, code, direction, volume, price)
 
     def deleteOrder(self, order_id):
         '''
@@ -760,37 +1708,67 @@ class Client:
         '''
         self._td.deleteOrder(order_id)
 
+    def insertOrder(self, code, direction, volume, price):
+        '''
+        非阻塞限价单，返回报单标识（FrontID:SessionID:OrderRef），结果见报单回报。
+        执行线程中调用，资金检查只用缓存，不发出查询
+        '''
+        return self._submit(code, direction, volume, price, self._td.insertOrder, code, direction, volume, price,
+                query=False)
+
+    def cancelOrder(self, order_key, code):
+        '''
+        按报单标识非阻塞撤单
+        '''
+        self._td.cancelOrder(order_key, code)
+
 @api.route('/login', methods=['GET'])    
 async def login(request):
     try:
-        ctp_client.login()
-        return response.json({"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+        await ctp_client.login()
+        return reply(request, {"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/logout', methods=['GET'])    
 async def logout(request):
     try:
-        ctp_client.logout()
-        return response.json({"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+        await ctp_client.logout()
+        return reply(request, {"time": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_account', methods=['GET'])    
 async def get_account(request):
     try:
-        data = ctp_client.getAccount()
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.getAccount()
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
+
+@api.route('/estimate', methods=['GET'])
+async def estimate(request):
+    '''
+    本地估算报单占用的保证金、权利金与手续费。volume为整数，正数开仓、负数平仓，price缺省时取最新价
+    '''
+    code = request.args.get("code")
+    direction = request.args.get("direction", "long")
+    try:
+        volume = int(request.args.get("volume", 1))
+        price = float(request.args.get("price", 0))
+        data = await ctp_client.estimate(code, volume, price, direction)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_postion', methods=['GET'])    
 async def get_postion(request):
+    cached = request.args.get("cached", "0") == "1"
     try:
-        data = ctp_client.getPositions()
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.getPositions(cached)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/order_limit', methods=['GET'])    
 async def order_limit(request):
@@ -803,10 +1781,10 @@ async def order_limit(request):
     price = float(request.args.get("price", "0"))
 
     try:
-        data = ctp_client.orderLimit(code, direction, volume, price)
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.orderLimit(code, direction, volume, price)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/order_market', methods=['GET'])    
 async def order_market(request):
@@ -818,10 +1796,10 @@ async def order_market(request):
     volume = int(request.args.get("volume", 1))
 
     try:
-        data = ctp_client.orderMarket(code, direction, volume)
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.orderMarket(code, direction, volume)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/order_delete', methods=['GET'])    
 async def order_delete(request):
@@ -830,80 +1808,310 @@ async def order_delete(request):
     '''
     order_id = request.args.get("order_id")
     try:
-        data = ctp_client.deleteOrder(order_id)
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.deleteOrder(order_id)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_orders', methods=['GET'])    
 async def get_orders(request):
+    cached = request.args.get("cached", "0") == "1"
     try:
-        data = ctp_client.getPositions()
-        return response.json(data, ensure_ascii=False)
+        data = await ctp_client.getOrders(cached)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_instruments_future', methods=['GET'])    
 async def get_instruments_future(request):
     exchange = request.args.get("exchange", "")
     try:
         if exchange == "":
-            data = ctp_client.get_instruments_future()
+            return await reply_cached(request, "instruments_future", lambda: ctp_client.get_instruments_future())
         else:
-            data = ctp_client.get_instruments_future(exchange)
-        return response.json(data, ensure_ascii=False)
+            return await reply_cached(request, "instruments_future:" + exchange,
+                    lambda: ctp_client.get_instruments_future(exchange))
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_instruments_option', methods=['GET'])    
 async def get_instruments_option(request):
     future = request.args.get("future", "")
     try:
         if future == "":
-            data = ctp_client.get_instruments_option()
+            return await reply_cached(request, "instruments_option", lambda: ctp_client.get_instruments_option())
         else:
-            data = ctp_client.get_instruments_option(future)
-        return response.json(data, ensure_ascii=False)
+            return await reply_cached(request, "instruments_option:" + future,
+                    lambda: ctp_client.get_instruments_option(future))
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/get_instruments_detail', methods=['GET'])    
 async def get_instruments_detail(request):
     code = request.args.get("code", "")
     try:
         if code != "":
-            data = ctp_client.getInstrument()
+            return await reply_cached(request, "instrument:" + code, lambda: ctp_client.getInstrument(code))
         else:
             data = {}
-        return response.json(data, ensure_ascii=False)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 
+@api.route('/get_tick', methods=['GET'])    
+async def get_tick(request):
+    '''
+    从共享内存行情表读取最新tick，不经过网关进程。codes为逗号分隔的合约代码，为空时返回全部已订阅合约。
+    '''
+    codes = request.args.get("codes", "")
+    try:
+        formats = negotiate(request.headers.get("accept"))
+        data = tick_table.snapshotRaw(codes.split(',') if codes != "" else None)
+        if formats[0] == JSON:
+            #行情表中的tick已是网关编码好的JSON，直接拼接
+            return response.raw(join_object(data.items()), content_type=JSON, headers={"Vary": "Accept"})
+        (body, media) = encode({code: json.loads(tick) for (code, tick) in data.items()}, formats)
+        return response.raw(body, content_type=media, headers={"Vary": "Accept"})
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+def _subscription_args(request):
+    '''
+    订阅选择条件：codes为逗号分隔的合约代码，exchange为交易所，product为期货品种，chain为期权链标的，all=1为全部在交易合约。
+    consumer缺省时按订阅次数计数，同一IP或反向代理后的不同客户端不会互相退订
+    '''
+    codes = request.args.get("codes", "")
+    return {"codes": codes.split(',') if codes != "" else None,
+            "consumer": request.args.get("consumer") or None,
+            "exchange": request.args.get("exchange") or None, "product": request.args.get("product") or None,
+            "chain": request.args.get("chain") or None, "all": request.args.get("all", "0") == "1"}
+
 @api.route('/subscribe', methods=['GET'])    
 async def subscribe(request):
-    codes = request.args.get("codes")
+    args = _subscription_args(request)
     try:
-        if codes != "":
-            data = ctp_client.subscribe(codes.split(','))
-            ctp_client.setReceiver()
+        if args["codes"] or args["exchange"] or args["product"] or args["chain"] or args["all"]:
+            data = await ctp_client.subscribe(**args)
         else:
             data = {}
-        return response.json(data, ensure_ascii=False)
+        return reply(request, data)
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        return reply(request, {"error": str(e)})
 
 @api.route('/unsubscribe', methods=['GET'])    
 async def unsubscribe(request):
-    codes = request.args.get("codes")
+    args = _subscription_args(request)
+    try:
+        if args["codes"] or args["exchange"] or args["product"] or args["chain"] or args["all"]:
+            data = await ctp_client.unsubscribe(**args)
+        else:
+            data = {}
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/subscriptions', methods=['GET'])
+async def subscriptions(request):
+    '''
+    各订阅方（consumer，缺省为"http:客户端IP"）订阅的合约
+    '''
+    try:
+        data = await ctp_client.getSubscriptions()
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/option_greeks', methods=['GET'])
+async def option_greeks(request):
+    '''
+    期权链各行权价的隐含波动率、delta、gamma、vega（波动率每1个百分点）、theta（每自然日）
+    '''
+    underlying = request.args.get("underlying", "")
+    try:
+        if underlying != "":
+            data = await ctp_client.getOptionGreeks(underlying)
+        else:
+            data = {}
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/synthetics', methods=['GET'])
+async def synthetics(request):
+    '''
+    全部合成合约定义，最新合成行情通过/get_tick读取
+    '''
+    try:
+        data = await ctp_client.getSynthetics()
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/synthetic_define', methods=['GET'])
+async def synthetic_define(request):
+    '''
+    定义合成合约：legs为"MA301:1,MA305:-1"格式的腿与比例，notional=1时按合约乘数计算名义价值
+    '''
+    name = request.args.get("name", "")
+    legs = request.args.get("legs", "")
+    notional = request.args.get("notional", "0") == "1"
+    try:
+        if name != "" and legs != "":
+            data = await ctp_client.defineSynthetic(name, parse_legs(legs), notional)
+        else:
+            data = {}
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/synthetic_remove', methods=['GET'])
+async def synthetic_remove(request):
+    name = request.args.get("name", "")
+    try:
+        if name != "":
+            data = await ctp_client.removeSynthetic(name)
+        else:
+            data = {}
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/trigger_create', methods=['GET'])
+async def trigger_create(request):
+    '''
+    创建条件单：condition为ge（价格上涨到trigger_price）或le（下跌到trigger_price），
+    order_type为market、limit或fak，后两者需给出price；source为触发价格来源last、bid或ask
+    '''
+    code = request.args.get("code", "")
+    direction = request.args.get("direction", "")
+    volume = request.args.get("volume", "")
+    condition = request.args.get("condition", "")
+    trigger_price = request.args.get("trigger_price", "")
+    order_type = request.args.get("order_type", "market")
+    price = request.args.get("price", "0")
+    source = request.args.get("source", "last")
+    try:
+        data = await ctp_client.createTrigger(code, direction, int(volume), condition, float(trigger_price),
+                order_type, float(price), source)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/triggers', methods=['GET'])
+async def triggers(request):
+    '''
+    当日条件单，可按合约过滤，active=1时只返回尚未触发的
+    '''
+    code = request.args.get("code", "")
+    active = request.args.get("active", "0") == "1"
+    try:
+        data = await ctp_client.getTriggers(code if code != "" else None, active)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/trigger_cancel', methods=['GET'])
+async def trigger_cancel(request):
+    trigger_id = request.args.get("id", "")
+    try:
+        data = await ctp_client.cancelTrigger(trigger_id)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/algo_create', methods=['GET'])
+async def algo_create(request):
+    '''
+    创建执行算法母单：kind为twap（duration、slices）、iceberg（display、price）或chase，
+    可选offset（相对基准价的最小变动价位数）与limit（买入上限或卖出下限）
+    '''
+    kind = request.args.get("kind", "")
+    code = request.args.get("code", "")
+    direction = request.args.get("direction", "long")
+    volume = request.args.get("volume", "")
     try:
-        if codes != "":
-            data = ctp_client.unsubscribe(codes.split(','))
+        params = {name: float(request.args.get(name)) for name in ("duration", "slices", "display", "offset",
+                "limit", "price") if request.args.get(name, "") != ""}
+        data = await ctp_client.createAlgo(kind, code, direction, int(volume), params)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/algos', methods=['GET'])
+async def algos(request):
+    '''
+    当日母单，id不为空时只返回该母单，active=1时只返回运行中的
+    '''
+    algo_id = request.args.get("id", "")
+    active = request.args.get("active", "0") == "1"
+    try:
+        if algo_id != "":
+            data = await ctp_client.getAlgo(algo_id)
+        else:
+            data = await ctp_client.getAlgos(active)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/algo_cancel', methods=['GET'])
+async def algo_cancel(request):
+    algo_id = request.args.get("id", "")
+    try:
+        data = await ctp_client.cancelAlgo(algo_id)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/strategies', methods=['GET'])
+async def strategies(request):
+    '''
+    各策略进程状态：pid、是否存活、队列中待处理与已丢弃的tick数
+    '''
+    try:
+        data = await ctp_client.getStrategies()
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/strategy_reload', methods=['GET'])
+async def strategy_reload(request):
+    '''
+    重新导入并重启指定策略的进程，CTP行情会话不中断
+    '''
+    name = request.args.get("name", "")
+    try:
+        if name != "":
+            data = await ctp_client.reloadStrategy(name)
         else:
             data = {}
-        return response.json(data, ensure_ascii=False)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/latency', methods=['GET'])
+async def latency(request):
+    '''
+    tick到报单延迟分位数（微秒）：交易所到本机接收、接收到分发、接收到处理函数、处理函数到报单。code为空时返回全部合约。
+    '''
+    code = request.args.get("code", "")
+    try:
+        data = await ctp_client.getLatency(code if code != "" else None)
+        return reply(request, data)
+    except Exception as e:
+        return reply(request, {"error": str(e)})
+
+@api.route('/metrics', methods=['GET'])
+async def metrics(request):
+    '''
+    Prometheus指标：CTP回调、报单撤单、查询耗时与前置状态，以及各worker的HTTP与外部接口耗时
+    '''
+    try:
+        text = await ctp_client.metrics(os.getpid(), HTTP_REGISTRY.collect())
     except Exception as e:
-        return response.json({"error": str(e)}, ensure_ascii=False)
+        logger.warning("获取网关指标失败：%s" % e)
+        text = render(with_label(HTTP_REGISTRY.collect(), "worker", str(os.getpid())))
+    return response.text(text, content_type="text/plain; version=0.0.4; charset=utf-8")
 
 @api.route('/market/event', methods=['GET'])
 async def market_event(request):
@@ -922,7 +2130,7 @@ async def market_event(request):
     
     data = await get_json(url, headers=headers)
 
-    return response.json(data, ensure_ascii=False)
+    return reply(request, data)
 
 @api.route('/market/news', methods=['GET'])
 async def market_news(request):
@@ -936,7 +2144,7 @@ async def market_news(request):
     headers = {'x-app-id': 'bVBF4FyRTn5NJF5n', 'user-agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/107.0.0.0 Safari/537.36', 'x-version': '1.0.0', 'accept': 'application/json, text/plain, */*', 'referer': 'https://www.jin10.com/', 'authority': 'flash-api.jin10.com'}
     
     data = await get_json(url, headers=headers)
-    return response.json(data, ensure_ascii=False)
+    return reply(request, data)
 
 
 @api.route('/market/realtime_hq', methods=['GET'])
@@ -950,7 +2158,7 @@ async def market_realtime_hq(request):
 
     data = await get_json(url, headers=headers)
 
-    return response.json(data, ensure_ascii=False)
+    return reply(request, data)
 
 @api.route('/market/realtime_snap', methods=['GET'])
 async def market_realtime_snap(request):
@@ -964,7 +2172,7 @@ async def market_realtime_snap(request):
 
     data = await get_json(url, headers=headers)
 
-    return response.json(data, ensure_ascii=False)
+    return reply(request, data)
 
 @api.route('/market/realtime_dayline', methods=['GET'])
 async def market_realtime_dayline(request):
@@ -983,7 +2191,7 @@ async def market_realtime_dayline(request):
 
     data = await get_json(url, headers=headers)
 
-    return response.json(data, ensure_ascii=False)
+    return reply(request, data)
 
 
 app = Sanic(name=__name__)
@@ -992,4 +2200,4 @@ app.config.REQUEST_TIMEOUT = 6000000
 app.config.KEEP_ALIVE_TIMEOUT = 600000
 app.blueprint(api)
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=7000, workers=1, debug=True, auto_reload=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=7000, workers=load_config()["workers"], debug=True, auto_reload=True)
\ No newline at end of file
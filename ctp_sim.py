@@ -0,0 +1,603 @@
+# -*- coding: utf-8 -*-
+
+import json, re, time, math, heapq, random, threading, itertools, logging
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qsl
+import ctpwrapper as CTP
+
+logger = logging.getLogger()
+
+'''
+模拟CTP前置：前置地址以sim://开头时，QuoteImpl/TraderImpl改为继承SimMdApi/SimTraderApi，
+不连接真实前置即可运行整个服务，用于压测与离线回归。参数以查询串形式给出，例如：
+
+    sim://?tick_rate=10&seed=1
+    sim://?ack_latency=0.005&fill_latency=0.01&reject_rate=0.05&instruments=ctp_client_data/instruments.dat
+
+行情参数：tick_rate（每个合约每秒tick数，0为不限速）、replay（JSON Lines格式的tick录制文件）、seed
+交易参数：ack_latency、fill_latency、cancel_latency（秒）、reject_rate、balance
+公共参数：instruments（合约文件，格式同instruments.dat，缺省使用内置的期货期权合约）
+'''
+
+_DEFAULTS = {"tick_rate": 2.0, "replay": None, "seed": 0, "instruments": None,
+        "ack_latency": 0.005, "fill_latency": 0.01, "cancel_latency": 0.005,
+        "reject_rate": 0.0, "balance": 10000000.0}
+#没有可发出的tick时行情循环的等待时间（秒）
+_IDLE_DELAY = 0.01
+
+class _Field(SimpleNamespace):
+    '''
+    模拟前置回调的数据结构，字段名与ctpwrapper.ApiStructure一致，只填写服务用到的字段
+    '''
+
+_OK = _Field(ErrorID=0, ErrorMsg="")
+
+def _error(error_id, msg):
+    return _Field(ErrorID=error_id, ErrorMsg=msg)
+
+def parseFront(front):
+    '''
+    解析sim://前置地址中的参数
+    '''
+    params = dict(_DEFAULTS)
+    for (key, value) in parse_qsl(urlsplit(front).query):
+        if key not in params:
+            raise ValueError("未知的模拟前置参数<%s>" % key)
+        default = _DEFAULTS[key]
+        params[key] = type(default)(value) if default is not None else value
+    return params
+
+def simulate(cls):
+    '''
+    以模拟前置替换QuoteImpl/TraderImpl所继承的ctpwrapper接口
+    '''
+    base = SimMdApi if issubclass(cls, CTP.MdApiPy) else SimTraderApi
+    return type("Sim" + cls.__name__, (base, cls), {})
+
+def _black76(forward, strike, years, vol, is_call):
+    if years <= 0 or vol <= 0:
+        return max(forward - strike, 0) if is_call else max(strike - forward, 0)
+    d1 = (math.log(forward / strike) + vol * vol * years / 2) / (vol * math.sqrt(years))
+    d2 = d1 - vol * math.sqrt(years)
+    cdf = lambda x: 0.5 * (1 + math.erf(x / math.sqrt(2)))
+    if is_call:
+        return forward * cdf(d1) - strike * cdf(d2)
+    return strike * cdf(-d2) - forward * cdf(-d1)
+
+def _defaultInstruments():
+    '''
+    内置合约：若干期货，以及sc、IO的期权链
+    '''
+    expire = time.strftime("%Y-%m-%d", time.localtime(time.time() + 60 * 86400))
+    instruments = {}
+    def add(code, name, exchange, multiple, price_tick, margin, option_type=None, strike=0.0):
+        instruments[code] = {"name": name, "exchange": exchange, "multiple": multiple,
+                "price_tick": price_tick, "expire_date": expire,
+                "long_margin_ratio": margin, "short_margin_ratio": margin,
+                "option_type": option_type, "strike_price": strike, "is_trading": True}
+    add("MA301", "甲醇301", "CZCE", 10, 1.0, 0.1)
+    add("MA305", "甲醇305", "CZCE", 10, 1.0, 0.1)
+    add("rb2305", "螺纹钢2305", "SHFE", 10, 1.0, 0.12)
+    add("hc2305", "热轧卷板2305", "SHFE", 10, 1.0, 0.12)
+    add("au2306", "黄金2306", "SHFE", 1000, 0.02, 0.1)
+    add("sc2302", "原油2302", "INE", 1000, 0.1, 0.15)
+    add("IF2301", "沪深300指数2301", "CFFEX", 300, 0.2, 0.12)
+    for strike in range(480, 570, 10):
+        add("sc2302C%d" % strike, "sc2302C%d" % strike, "INE", 1000, 0.05, None, "call", float(strike))
+        add("sc2302P%d" % strike, "sc2302P%d" % strike, "INE", 1000, 0.05, None, "put", float(strike))
+    for strike in range(3700, 4350, 50):
+        add("IO2301-C-%d" % strike, "IO2301-C-%d" % strike, "CFFEX", 100, 0.2, None, "call", float(strike))
+        add("IO2301-P-%d" % strike, "IO2301-P-%d" % strike, "CFFEX", 100, 0.2, None, "put", float(strike))
+    return instruments
+
+_START_PRICES = {"MA301": 2583.0, "MA305": 2620.0, "rb2305": 3900.0, "hc2305": 4000.0,
+        "au2306": 410.0, "sc2302": 520.0, "IF2301": 4000.0, "IO2301": 4000.0}
+
+class SimExchange:
+    '''
+    模拟交易所：同一进程内的行情与交易前置共享合约、最新价和挂单
+    '''
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.instruments = None
+        self.prices = {}
+        self._resting = []          #[(trader, order)]
+
+    def load(self, path, seed):
+        with self._lock:
+            if self.instruments is not None:
+                return
+            if path is None:
+                self.instruments = _defaultInstruments()
+            else:
+                fd = open(path)
+                first = fd.readline()
+                try:
+                    self.instruments = json.loads(first + fd.read())
+                except ValueError:
+                    #instruments.dat首行为缓存日期
+                    fd.seek(0)
+                    fd.readline()
+                    self.instruments = json.load(fd)
+                fd.close()
+            rng = random.Random(seed)
+            for (code, instrument) in self.instruments.items():
+                self.prices[code] = self._startPrice(code, instrument, rng)
+
+    def _startPrice(self, code, instrument, rng):
+        tick = instrument["price_tick"] or 0.01
+        underlying = code.split("-")[0]
+        for prefix in sorted(_START_PRICES, key=len, reverse=True):
+            if code.startswith(prefix):
+                underlying = prefix
+                break
+        base = _START_PRICES.get(underlying, 1000 * tick * rng.randint(1, 10))
+        if instrument.get("option_type"):
+            expire = instrument.get("expire_date")
+            years = 60 / 365 if not expire else                             \
+                    max(time.mktime(time.strptime(expire, "%Y-%m-%d")) - time.time(), 0) / 365 / 86400
+            price = _black76(base, instrument["strike_price"], years, 0.25, instrument["option_type"] == "call")
+            return max(tick, round(price / tick) * tick)
+        return base
+
+    def move(self, code, rng):
+        '''
+        随机游走一个最小变动价位，返回新价格
+        '''
+        instrument = self.instruments[code]
+        tick = instrument["price_tick"] or 0.01
+        with self._lock:
+            price = self.prices[code] + rng.choice((-1, 0, 0, 1)) * tick
+            price = max(tick, round(price / tick) * tick)
+            self.setPrice(code, price)
+            return price
+
+    def setPrice(self, code, price):
+        with self._lock:
+            self.prices[code] = price
+            crossed = [(trader, order) for (trader, order) in self._resting
+                    if order.InstrumentID == code and self.marketable(order, price)]
+            for item in crossed:
+                self._resting.remove(item)
+        for (trader, order) in crossed:
+            trader._simFill(order, order.LimitPrice)
+
+    def marketable(self, order, price):
+        if order.Direction == '0':
+            return order.LimitPrice >= price
+        return order.LimitPrice <= price
+
+    def rest(self, trader, order):
+        with self._lock:
+            self._resting.append((trader, order))
+
+    def cancel(self, order):
+        with self._lock:
+            for item in self._resting:
+                if item[1] is order:
+                    self._resting.remove(item)
+                    return True
+        return False
+
+EXCHANGE = SimExchange()
+
+class _Front:
+    '''
+    模拟前置的回调线程：按到期时间依次执行回调，与真实CTP一样在独立线程中调用Spi
+    '''
+    def __init__(self, name):
+        self._queue = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def post(self, delay, func, *args):
+        with self._cond:
+            heapq.heappush(self._queue, (time.monotonic() + delay, next(self._counter), func, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (not self._queue or self._queue[0][0] > time.monotonic()):
+                    self._cond.wait(None if not self._queue else self._queue[0][0] - time.monotonic())
+                if not self._running:
+                    return
+                (_, _, func, args) = heapq.heappop(self._queue)
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception("模拟前置回调异常：%s" % e)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+class SimMdApi:
+    '''
+    模拟行情前置，实现QuoteImpl用到的MdApiPy接口
+    '''
+    def Create(self, flow_dir=""):
+        self._sim_front = None
+        self._sim_codes = set()
+
+    def RegisterFront(self, front):
+        self._sim_params = parseFront(front)
+        self._sim_rng = random.Random(self._sim_params["seed"])
+
+    def Init(self):
+        EXCHANGE.load(self._sim_params["instruments"], self._sim_params["seed"])
+        self._sim_replay = None
+        if self._sim_params["replay"]:
+            self._sim_replay = open(self._sim_params["replay"], encoding="utf-8")
+        self._sim_front = _Front("sim_md")
+        self._sim_front.post(0, self.OnFrontConnected)
+
+    def Release(self):
+        if getattr(self, "_sim_front", None) is not None:
+            self._sim_front.stop()
+            self._sim_front = None
+
+    def Join(self):
+        return 0
+
+    def ReqUserLogin(self, field, req_id):
+        self._sim_front.post(0, self.OnRspUserLogin, _Field(
+                TradingDay=time.strftime("%Y%m%d")), _OK, req_id, True)
+        self._sim_front.post(0, self._simTickLoop)
+        return 0
+
+    def SubscribeMarketData(self, codes):
+        self._sim_front.post(0, self._simSubscribe, list(codes), True)
+        return 0
+
+    def UnSubscribeMarketData(self, codes):
+        self._sim_front.post(0, self._simSubscribe, list(codes), False)
+        return 0
+
+    def _simSubscribe(self, codes, subscribe):
+        callback = self.OnRspSubMarketData if subscribe else self.OnRspUnSubMarketData
+        for (i, code) in enumerate(codes):
+            if subscribe:
+                self._sim_codes.add(code)
+            else:
+                self._sim_codes.discard(code)
+            callback(_Field(InstrumentID=code), _OK, 0, i == len(codes) - 1)
+
+    def _simTickLoop(self):
+        if self._sim_front is None:
+            return
+        emitted = False
+        if self._sim_replay is not None:
+            emitted = self._simReplay()
+        else:
+            #按合约代码排序，随机数序列与集合的哈希顺序无关
+            for code in sorted(self._sim_codes):
+                if code in EXCHANGE.instruments:
+                    self._simTick(code, EXCHANGE.move(code, self._sim_rng))
+                    emitted = True
+        rate = self._sim_params["tick_rate"]
+        delay = 1 / rate if rate > 0 else 0
+        if not emitted:
+            #没有订阅的合约时不空转
+            delay = max(delay, _IDLE_DELAY)
+        self._sim_front.post(delay, self._simTickLoop)
+
+    def _simReplay(self):
+        #每轮按文件顺序发出一个已订阅合约的tick，读完后从头循环，返回是否发出了tick
+        for _ in range(1000):
+            line = self._sim_replay.readline()
+            if not line:
+                self._sim_replay.seek(0)
+                return False
+            tick = json.loads(line)
+            if tick["code"] in self._sim_codes:
+                EXCHANGE.setPrice(tick["code"], tick["price"])
+                self.OnRtnDepthMarketData(self._simField(tick))
+                return True
+        return False
+
+    def _simTick(self, code, price):
+        instrument = EXCHANGE.instruments[code]
+        tick = instrument["price_tick"] or 0.01
+        now = time.time()
+        rng = self._sim_rng
+        data = {"code": code, "price": price, "trade_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+                "update_sec": int(now * 1000) % 1000, "volume": rng.randint(1, 100000),
+                "open_interest": rng.randint(1, 100000)}
+        for level in range(1, 6):
+            data["ask%d" % level] = (price + level * tick, rng.randint(1, 500))
+            data["bid%d" % level] = (max(tick, price - level * tick), rng.randint(1, 500))
+        self.OnRtnDepthMarketData(self._simField(data))
+
+    def _simField(self, tick):
+        '''
+        将服务自身的tick格式转换为DepthMarketDataField
+        '''
+        (day, update_time) = tick.get("trade_time", time.strftime("%Y-%m-%d %H:%M:%S")).split(" ")
+        price = tick["price"]
+        none = lambda x: 1.7976931348623157e+308 if x is None else x
+        kwargs = {"TradingDay": day.replace("-", ""), "ActionDay": day.replace("-", ""),
+                "UpdateTime": update_time, "UpdateMillisec": tick.get("update_sec", 0),
+                "InstrumentID": tick["code"], "LastPrice": price,
+                "OpenPrice": none(tick.get("open", price)), "ClosePrice": none(tick.get("close")),
+                "HighestPrice": none(tick.get("highest", price)), "LowestPrice": none(tick.get("lowest", price)),
+                "UpperLimitPrice": none(tick.get("upper_limit", price * 1.1)),
+                "LowerLimitPrice": none(tick.get("lower_limit", price * 0.9)),
+                "SettlementPrice": none(tick.get("settlement")), "Volume": tick.get("volume", 0),
+                "Turnover": tick.get("turnover", 0.0), "OpenInterest": tick.get("open_interest", 0),
+                "PreClosePrice": none(tick.get("pre_close", price)),
+                "PreSettlementPrice": none(tick.get("pre_settlement", price)),
+                "PreOpenInterest": tick.get("pre_open_interest", 0)}
+        for level in range(1, 6):
+            (ask, ask_volume) = tick.get("ask%d" % level) or (None, 0)
+            (bid, bid_volume) = tick.get("bid%d" % level) or (None, 0)
+            kwargs["AskPrice%d" % level] = none(ask)
+            kwargs["AskVolume%d" % level] = ask_volume
+            kwargs["BidPrice%d" % level] = none(bid)
+            kwargs["BidVolume%d" % level] = bid_volume
+        return _Field(**kwargs)
+
+class SimTraderApi:
+    '''
+    模拟交易前置，实现TraderImpl用到的TraderApiPy接口：按配置的延迟确认、成交或拒绝报单
+    '''
+    def Create(self, flow_dir=""):
+        self._sim_front = None
+
+    def RegisterFront(self, front):
+        self._sim_params = parseFront(front)
+        self._sim_rng = random.Random(self._sim_params["seed"])
+
+    def SubscribePrivateTopic(self, resume_type):
+        pass
+
+    def SubscribePublicTopic(self, resume_type):
+        pass
+
+    def Init(self):
+        EXCHANGE.load(self._sim_params["instruments"], self._sim_params["seed"])
+        self._sim_lock = threading.RLock()
+        self._sim_session = self._sim_rng.randint(1, 2 ** 31 - 1)
+        self._sim_orders = {}           #OrderSysID -> OrderField
+        self._sim_positions = {}        #(code, "2"/"3") -> [volume, cost]
+        self._sim_balance = self._sim_params["balance"]
+        self._sim_sys_id = itertools.count(1)
+        self._sim_trade_id = itertools.count(1)
+        self._sim_trades = []
+        self._sim_front = _Front("sim_td")
+        self._sim_front.post(0, self.OnFrontConnected)
+
+    def Release(self):
+        if getattr(self, "_sim_front", None) is not None:
+            self._sim_front.stop()
+            self._sim_front = None
+
+    def Join(self):
+        return 0
+
+    def ReqAuthenticate(self, field, req_id):
+        self._sim_front.post(0, self.OnRspAuthenticate, _Field(), _OK, req_id, True)
+        return 0
+
+    def ReqUserLogin(self, field, req_id):
+        self._sim_front.post(0, self.OnRspUserLogin, _Field(
+                TradingDay=time.strftime("%Y%m%d"), FrontID=1, SessionID=self._sim_session,
+                MaxOrderRef="0"), _OK, req_id, True)
+        return 0
+
+    def ReqSettlementInfoConfirm(self, field, req_id):
+        self._sim_front.post(0, self.OnRspSettlementInfoConfirm, _Field(),
+                _OK, req_id, True)
+        return 0
+
+    def ReqQryInstrument(self, field, req_id):
+        self._sim_front.post(0, self._simQryInstrument, req_id)
+        return 0
+
+    def _simQryInstrument(self, req_id):
+        items = list(EXCHANGE.instruments.items())
+        for (i, (code, instrument)) in enumerate(items):
+            expire = (instrument.get("expire_date") or "").replace("-", "")
+            option_type = {"call": '1', "put": '2'}.get(instrument.get("option_type"), '')
+            field = _Field(InstrumentID=code, InstrumentName=instrument["name"],
+                    ExchangeID=instrument["exchange"], VolumeMultiple=instrument["multiple"],
+                    PriceTick=instrument["price_tick"], ExpireDate=expire,
+                    LongMarginRatio=instrument.get("long_margin_ratio") or 1.7976931348623157e+308,
+                    ShortMarginRatio=instrument.get("short_margin_ratio") or 1.7976931348623157e+308,
+                    OptionsType=option_type, StrikePrice=instrument.get("strike_price") or 0.0,
+                    IsTrading=int(instrument.get("is_trading", True)),
+                    MaxLimitOrderVolume=instrument.get("max_limit_volume") or 500,
+                    MinLimitOrderVolume=instrument.get("min_limit_volume") or 1,
+                    ProductID=instrument.get("product") or re.match(r"[A-Za-z]*", code).group())
+            self.OnRspQryInstrument(field, _OK, req_id, i == len(items) - 1)
+
+    def ReqQryInstrumentMarginRate(self, field, req_id):
+        instrument = EXCHANGE.instruments.get(field.InstrumentID)
+        if instrument is None or instrument.get("option_type"):
+            rate = None
+        else:
+            rate = _Field(InstrumentID=field.InstrumentID, HedgeFlag=field.HedgeFlag,
+                    LongMarginRatioByMoney=instrument.get("long_margin_ratio") or 0.0, LongMarginRatioByVolume=0.0,
+                    ShortMarginRatioByMoney=instrument.get("short_margin_ratio") or 0.0, ShortMarginRatioByVolume=0.0,
+                    IsRelative=0)
+        self._sim_front.post(0, self.OnRspQryInstrumentMarginRate, rate, _OK, req_id, True)
+        return 0
+
+    def _simCommissionRate(self, code, is_option):
+        #与多数柜台一致，按品种返回手续费率：期货按成交金额万分之一，期权每手2元；期货、期权分别查询
+        instrument = EXCHANGE.instruments.get(code)
+        if instrument is None or bool(instrument.get("option_type")) != is_option:
+            return None
+        (by_money, by_volume) = (0.0, 2.0) if is_option else (0.0001, 0.0)
+        return _Field(InstrumentID=re.match(r"[A-Za-z]*", code).group(),
+                OpenRatioByMoney=by_money, OpenRatioByVolume=by_volume,
+                CloseRatioByMoney=by_money, CloseRatioByVolume=by_volume,
+                CloseTodayRatioByMoney=by_money, CloseTodayRatioByVolume=by_volume)
+
+    def ReqQryInstrumentCommissionRate(self, field, req_id):
+        rate = self._simCommissionRate(field.InstrumentID, False)
+        self._sim_front.post(0, self.OnRspQryInstrumentCommissionRate, rate, _OK, req_id, True)
+        return 0
+
+    def ReqQryOptionInstrCommRate(self, field, req_id):
+        rate = self._simCommissionRate(field.InstrumentID, True)
+        self._sim_front.post(0, self.OnRspQryOptionInstrCommRate, rate, _OK, req_id, True)
+        return 0
+
+    def _simMargin(self, code, volume, price):
+        instrument = EXCHANGE.instruments[code]
+        ratio = instrument.get("long_margin_ratio") or 1.0
+        return price * volume * instrument["multiple"] * ratio
+
+    def ReqQryTradingAccount(self, field, req_id):
+        with self._sim_lock:
+            margin = sum(self._simMargin(code, volume, EXCHANGE.prices[code])
+                    for ((code, _), (volume, _)) in self._sim_positions.items())
+            account = _Field(Balance=self._sim_balance, CurrMargin=margin,
+                    Available=self._sim_balance - margin)
+        self._sim_front.post(0, self.OnRspQryTradingAccount, account, _OK, req_id, True)
+        return 0
+
+    def ReqQryOrder(self, field, req_id):
+        with self._sim_lock:
+            orders = [self._simCopy(order) for order in self._sim_orders.values()]
+        self._sim_front.post(0, self._simRspList, self.OnRspQryOrder, orders, req_id)
+        return 0
+
+    def ReqQryInvestorPosition(self, field, req_id):
+        with self._sim_lock:
+            positions = [_Field(InstrumentID=code, PosiDirection=direction,
+                    Position=volume, OpenCost=cost,
+                    UseMargin=self._simMargin(code, volume, EXCHANGE.prices[code]))
+                    for ((code, direction), (volume, cost)) in self._sim_positions.items() if volume > 0]
+        self._sim_front.post(0, self._simRspList, self.OnRspQryInvestorPosition, positions, req_id)
+        return 0
+
+    def ReqQryTrade(self, field, req_id):
+        with self._sim_lock:
+            trades = [self._simCopy(trade) for trade in self._sim_trades]
+        self._sim_front.post(0, self._simRspList, self.OnRspQryTrade, trades, req_id)
+        return 0
+
+    def _simRspList(self, callback, fields, req_id):
+        if not fields:
+            callback(None, _OK, req_id, True)
+        for (i, field) in enumerate(fields):
+            callback(field, _OK, req_id, i == len(fields) - 1)
+
+    def _simCopy(self, order):
+        return _Field(**vars(order))
+
+    def _simReturn(self, order, delay, **changes):
+        '''
+        修改报单状态并推送OnRtnOrder
+        '''
+        with self._sim_lock:
+            for (key, value) in changes.items():
+                setattr(order, key, value)
+            snapshot = self._simCopy(order)
+        self._sim_front.post(delay, self.OnRtnOrder, snapshot)
+
+    def ReqOrderInsert(self, field, req_id):
+        params = self._sim_params
+        code = field.InstrumentID
+        if code not in EXCHANGE.instruments:
+            self._sim_front.post(0, self.OnRspOrderInsert, field, _error(16, "找不到合约"), req_id, True)
+            return 0
+        with self._sim_lock:
+            sys_id = "%12d" % next(self._sim_sys_id)
+            order = _Field(BrokerID=field.BrokerID, InvestorID=field.InvestorID,
+                    ExchangeID=field.ExchangeID, InstrumentID=code, OrderRef=field.OrderRef,
+                    Direction=field.Direction, CombOffsetFlag=field.CombOffsetFlag,
+                    CombHedgeFlag=field.CombHedgeFlag, OrderPriceType=field.OrderPriceType,
+                    LimitPrice=field.LimitPrice, VolumeTotalOriginal=field.VolumeTotalOriginal,
+                    TimeCondition=field.TimeCondition, VolumeCondition=field.VolumeCondition,
+                    MinVolume=field.MinVolume, ContingentCondition=field.ContingentCondition,
+                    FrontID=1, SessionID=self._sim_session, OrderSysID="", OrderSubmitStatus='0',
+                    OrderStatus='a', VolumeTraded=0, StatusMsg="已提交",
+                    InsertDate=time.strftime("%Y%m%d"), InsertTime=time.strftime("%H:%M:%S"))
+        #CTP确认收到报单
+        self._simReturn(order, 0)
+        if self._sim_rng.random() < params["reject_rate"]:
+            self._simReturn(order, params["ack_latency"], OrderSubmitStatus='4', OrderStatus='5',
+                    StatusMsg="模拟拒单")
+            return 0
+        if field.CombOffsetFlag != '0' and not self._simCanClose(order):
+            self._simReturn(order, params["ack_latency"], OrderSubmitStatus='4', OrderStatus='5',
+                    StatusMsg="平仓量超过持仓量")
+            return 0
+        with self._sim_lock:
+            self._sim_orders[sys_id] = order
+        self._simReturn(order, params["ack_latency"], OrderSysID=sys_id, OrderSubmitStatus='3',
+                OrderStatus='3', StatusMsg="未成交")
+        self._sim_front.post(params["ack_latency"] + params["fill_latency"], self._simMatch, order)
+        return 0
+
+    def _simCanClose(self, order):
+        direction = '3' if order.Direction == '0' else '2'
+        with self._sim_lock:
+            position = self._sim_positions.get((order.InstrumentID, direction), [0, 0])
+        return position[0] >= order.VolumeTotalOriginal
+
+    def _simMatch(self, order):
+        if order.OrderStatus == '5':
+            return
+        price = EXCHANGE.prices[order.InstrumentID]
+        if order.OrderPriceType != '2':
+            #市价单以最新价全部成交
+            self._simFill(order, price)
+        elif EXCHANGE.marketable(order, price):
+            self._simFill(order, price)
+        elif order.TimeCondition == '1':
+            #FAK/FOK未能成交，撤销
+            self._simReturn(order, 0, OrderStatus='5', StatusMsg="已撤单")
+        else:
+            EXCHANGE.rest(self, order)
+
+    def _simFill(self, order, price):
+        volume = order.VolumeTotalOriginal - order.VolumeTraded
+        code = order.InstrumentID
+        multiple = EXCHANGE.instruments[code]["multiple"]
+        with self._sim_lock:
+            if order.CombOffsetFlag == '0':
+                key = (code, '2' if order.Direction == '0' else '3')
+                position = self._sim_positions.setdefault(key, [0, 0.0])
+                position[0] += volume
+                position[1] += price * volume * multiple
+            else:
+                key = (code, '3' if order.Direction == '0' else '2')
+                position = self._sim_positions.setdefault(key, [0, 0.0])
+                cost = position[1] / position[0] * volume if position[0] else 0.0
+                pnl = price * volume * multiple - cost
+                self._sim_balance += pnl if key[1] == '2' else -pnl
+                position[0] -= volume
+                position[1] -= cost
+            trade = _Field(BrokerID=order.BrokerID, InvestorID=order.InvestorID,
+                    InstrumentID=code, ExchangeID=order.ExchangeID, OrderRef=order.OrderRef,
+                    OrderSysID=order.OrderSysID, TradeID="%12d" % next(self._sim_trade_id),
+                    Direction=order.Direction, OffsetFlag=order.CombOffsetFlag, Price=price,
+                    Volume=volume, TradeDate=time.strftime("%Y%m%d"), TradeTime=time.strftime("%H:%M:%S"))
+            self._sim_trades.append(trade)
+        self._simReturn(order, 0, VolumeTraded=order.VolumeTotalOriginal, OrderStatus='0', StatusMsg="全部成交")
+        self._sim_front.post(0, self.OnRtnTrade, trade)
+
+    def ReqOrderAction(self, field, req_id):
+        with self._sim_lock:
+            if field.OrderSysID:
+                order = self._sim_orders.get(field.OrderSysID)
+            else:
+                #按FrontID、SessionID、OrderRef撤单
+                order = next((order for order in self._sim_orders.values() if order.FrontID == field.FrontID
+                        and order.SessionID == field.SessionID
+                        and order.OrderRef.strip() == field.OrderRef.strip()), None)
+        if order is None or order.OrderStatus in ('0', '5'):
+            self._sim_front.post(0, self.OnRspOrderAction, field,
+                    _error(26, "报单已全成交或已撤销，不能再撤"), req_id, True)
+            return 0
+        EXCHANGE.cancel(order)
+        self._simReturn(order, self._sim_params["cancel_latency"], OrderStatus='5', StatusMsg="已撤单")
+        return 0
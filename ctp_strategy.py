@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+'''
+多策略宿主：每个策略运行在独立进程中，经共享内存环形队列接收tick，经网关IPC报单。
+
+策略模块定义on_tick(tick, context)处理tick，可选定义init(context)、stop(context)；
+只定义parse_hq(tick)的模块（如hq_func）也可直接作为策略运行。
+context.trader为网关代理，可调用orderLimit、orderMarket、orderFAK、deleteOrder、getPositions等Client方法。
+'''
+
+import importlib, json, time, logging, fnmatch, subprocess, threading, os, signal, sys
+from ctp_gateway import TickRing, GatewayClient
+from ctp_codec import dumps
+from ctp_metrics import STRATEGY_DROPPED
+
+logger = logging.getLogger()
+
+class StrategyContext:
+    '''
+    策略运行环境：name、params为配置中的策略名称与参数，trader为网关代理
+    '''
+    def __init__(self, name, params, trader):
+        self.name = name
+        self.params = params
+        self.trader = trader
+        self.logger = logging.getLogger(name)
+
+def run_strategy(name, module, params, ring_name, gateway_address, authkey):
+    '''
+    策略进程：从tick队列依次取出tick调用策略，空闲时先自旋再逐步退避到1毫秒轮询，网关进程退出后随之退出
+    '''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parent = os.getppid()
+    strategy = importlib.import_module(module)
+    on_tick = getattr(strategy, "on_tick", None)
+    if on_tick is None:
+        parse_hq = strategy.parse_hq
+        on_tick = lambda tick, context: parse_hq(tick)
+    trader = GatewayClient(gateway_address, authkey)
+    context = StrategyContext(name, params, trader)
+    ring = TickRing(ring_name)
+    if hasattr(strategy, "init"):
+        strategy.init(context)
+    logger.info("策略<%s>已启动..." % name)
+    idle = 0
+    try:
+        while True:
+            data = ring.get()
+            if data is None:
+                idle += 1
+                if idle > 100:
+                    time.sleep(min(0.001, 0.00001 * (idle - 100)))
+                    if idle % 1000 == 0 and os.getppid() != parent:
+                        logger.warning("网关进程已退出，策略<%s>停止..." % name)
+                        break
+                continue
+            idle = 0
+            tick = json.loads(data)
+            #报单附带网关交给策略的时刻，网关据此记录handler_to_order
+            trader.setTrace(tick["code"], tick.get("trace_ns"))
+            try:
+                on_tick(tick, context)
+            except Exception as e:
+                logger.exception("策略<%s>处理tick异常：%s" % (name, e))
+            finally:
+                trader.setTrace()
+    finally:
+        if hasattr(strategy, "stop"):
+            strategy.stop(context)
+        ring.close()
+        trader.close()
+
+class StrategyHost:
+    '''
+    网关进程中的策略宿主：按各策略的合约过滤条件（合约代码或MA*等通配符）分发tick，
+    重载策略只重启该策略进程，不影响CTP行情会话
+    '''
+    def __init__(self, strategies, prefix, gateway_address, authkey, ring_slots=1024):
+        self._configs = {}
+        for config in strategies:
+            if config["name"] in self._configs:
+                raise ValueError("策略<%s>重复" % config["name"])
+            self._configs[config["name"]] = config
+        self._prefix = prefix
+        self._gateway_address = gateway_address
+        self._authkey = authkey
+        self._ring_slots = ring_slots
+        self._processes = {}
+        self._rings = {}
+        self._routes = {}
+        self._lock = threading.Lock()
+
+    def subscriptions(self):
+        '''
+        各策略过滤条件中的确切合约代码，登录后以"strategy:策略名"为订阅方自动订阅
+        '''
+        return {name: [code for code in config["codes"] if not any(c in code for c in "*?[")]
+                for (name, config) in self._configs.items()}
+
+    def start(self):
+        with self._lock:
+            for name in self._configs:
+                self._start(name)
+            self._routes = {}
+
+    def _start(self, name):
+        config = self._configs[name]
+        ring = self._rings.get(name)
+        if ring is None:
+            ring = self._rings[name] = TickRing("%s_%s" % (self._prefix, name), self._ring_slots, create=True)
+        else:
+            ring.reset()
+        #以全新解释器启动策略进程，不继承网关进程的CTP线程与锁，也不重新执行启动脚本
+        arguments = {"name": name, "module": config["module"], "params": config.get("params", {}),
+                "ring_name": ring.name, "gateway_address": self._gateway_address}
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path),
+                CTP_GATEWAY_AUTHKEY=self._authkey.decode())
+        process = subprocess.Popen([sys.executable, "-m", "ctp_strategy", json.dumps(arguments)], env=env)
+        self._processes[name] = process
+        logger.info("已启动策略<%s>，进程%d..." % (name, process.pid))
+
+    def _stop(self, name):
+        process = self._processes.pop(name, None)
+        if process is None:
+            return
+        process.terminate()
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+        logger.info("已停止策略<%s>..." % name)
+
+    def reload(self, name):
+        '''
+        重启策略进程，重新导入策略模块
+        '''
+        with self._lock:
+            if name not in self._configs:
+                raise ValueError("策略<%s>不存在" % name)
+            self._stop(name)
+            self._start(name)
+
+    def stop(self):
+        with self._lock:
+            for name in list(self._processes):
+                self._stop(name)
+            for ring in self._rings.values():
+                ring.close(unlink=True)
+            self._rings = {}
+            self._routes = {}
+
+    def _route(self, code):
+        routes = [(name, self._rings[name]) for (name, config) in self._configs.items()
+                if name in self._rings and any(fnmatch.fnmatchcase(code, pattern) for pattern in config["codes"])]
+        self._routes[code] = routes
+        return routes
+
+    def onTick(self, tick):
+        '''
+        分发线程中调用：tick编码一次后写入所有匹配策略的队列
+        '''
+        routes = self._routes.get(tick["code"])
+        if routes is None:
+            routes = self._route(tick["code"])
+        if not routes:
+            return
+        data = dumps(tick)
+        for (name, ring) in routes:
+            if not ring.put(data):
+                STRATEGY_DROPPED.labels(name).inc()
+
+    def status(self):
+        data = []
+        for (name, config) in self._configs.items():
+            process = self._processes.get(name)
+            ring = self._rings.get(name)
+            data.append({"name": name, "module": config["module"], "codes": config["codes"],
+                    "pid": process.pid if process else None, "alive": bool(process and process.poll() is None),
+                    "pending": ring.pending() if ring else 0, "dropped": ring.dropped if ring else 0})
+        return data
+
+if __name__ == "__main__":
+    run_strategy(authkey=os.environ["CTP_GATEWAY_AUTHKEY"].encode(), **json.loads(sys.argv[1]))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import re, threading
+
+def product_of(code):
+    match = re.match(r"[A-Za-z]+", code)
+    return match.group() if match else ""
+
+def select(instruments, instruments_option, exchange=None, product=None, chain=None, all=False):
+    '''
+    按选择条件从合约索引中选出合约代码：交易所的全部合约、品种的全部期货、标的的期权链或全部在交易合约
+    '''
+    codes = []
+    if exchange:
+        selected = [code for (code, instrument) in instruments.items()
+                if instrument["exchange"] == exchange and instrument["is_trading"]]
+        if not selected:
+            raise ValueError("交易所<%s>没有合约" % exchange)
+        codes.extend(selected)
+    if product:
+        selected = [code for (code, instrument) in instruments.items()
+                if instrument["option_type"] is None and instrument["is_trading"] and product_of(code) == product]
+        if not selected:
+            raise ValueError("品种<%s>没有期货合约" % product)
+        codes.extend(selected)
+    if chain:
+        options = instruments_option.get(chain)
+        if not options:
+            raise ValueError("标的<%s>没有期权" % chain)
+        codes.extend(option["symbol"] for option in options if option["is_trading"])
+    if all:
+        codes.extend(code for (code, instrument) in instruments.items() if instrument["is_trading"])
+    return codes
+
+class SubscriptionRegistry:
+    '''
+    行情订阅引用计数：记录每个合约被哪些订阅方订阅及各自的引用数，
+    只有合约的首个订阅方需要向CTP订阅，最后一个订阅方退订后才向CTP退订
+    '''
+    def __init__(self):
+        #合约 -> {订阅方: 引用数}
+        self._consumers = {}
+        self._lock = threading.Lock()
+
+    def add(self, consumer, codes, counted=False):
+        '''
+        登记订阅，返回此前无人订阅、需要向CTP订阅的合约。counted为真时同一订阅方每次订阅各计一次引用，
+        需同样次数的退订才注销；否则重复订阅只算一次
+        '''
+        added = []
+        with self._lock:
+            for code in codes:
+                consumers = self._consumers.setdefault(code, {})
+                if not consumers:
+                    added.append(code)
+                consumers[consumer] = consumers.get(consumer, 0) + 1 if counted else 1
+        return added
+
+    def remove(self, consumer, codes=None, counted=False):
+        '''
+        注销订阅（codes为None时注销该订阅方的全部合约），counted为真时每个合约只减少一次引用，
+        返回已无人订阅、需要向CTP退订的合约
+        '''
+        removed = []
+        with self._lock:
+            if codes is None:
+                codes = [code for (code, consumers) in self._consumers.items() if consumer in consumers]
+            for code in codes:
+                consumers = self._consumers.get(code)
+                if not consumers or consumer not in consumers:
+                    continue
+                if counted and consumers[consumer] > 1:
+                    consumers[consumer] -= 1
+                    continue
+                del consumers[consumer]
+                if not consumers:
+                    del self._consumers[code]
+                    removed.append(code)
+        return removed
+
+    def codes(self):
+        with self._lock:
+            return sorted(self._consumers)
+
+    def consumers(self):
+        '''
+        各订阅方订阅的合约
+        '''
+        data = {}
+        with self._lock:
+            for (code, consumers) in self._consumers.items():
+                for consumer in consumers:
+                    data.setdefault(consumer, []).append(code)
+        for codes in data.values():
+            codes.sort()
+        return data
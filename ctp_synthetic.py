@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+_EMPTY_TICK = {"open": None, "close": None, "highest": None, "lowest": None, "upper_limit": None,
+        "lower_limit": None, "settlement": None, "volume": 0, "turnover": 0, "open_interest": 0,
+        "pre_close": None, "pre_settlement": None, "pre_open_interest": 0,
+        "ask2": (None, 0), "bid2": (None, 0), "ask3": (None, 0), "bid3": (None, 0),
+        "ask4": (None, 0), "bid4": (None, 0), "ask5": (None, 0), "bid5": (None, 0)}
+
+def parse_legs(text):
+    '''
+    解析"MA301:1,MA305:-1"格式的腿定义，比例缺省为1
+    '''
+    legs = []
+    for item in text.split(","):
+        (code, _, ratio) = item.partition(":")
+        legs.append({"code": code.strip(), "ratio": float(ratio) if ratio else 1})
+    return legs
+
+class Synthetic:
+    '''
+    价差或篮子合约：价格为各腿价格×比例×乘数之和。
+    买入合成合约即买入正比例腿、卖出负比例腿，因此隐含卖价取正比例腿的卖价与负比例腿的买价，隐含买价反之；
+    隐含挂单量为各腿对应一侧挂单量除以比例后的最小值
+    '''
+    def __init__(self, name, legs, notional, instruments):
+        if len(name.encode()) > 32:
+            raise ValueError("合成合约名称<%s>过长" % name)
+        if name in instruments:
+            raise ValueError("合成合约名称<%s>与已有合约重复" % name)
+        if not legs:
+            raise ValueError("合成合约<%s>没有腿" % name)
+        self.name = name
+        self.notional = notional
+        self.legs = []
+        for leg in legs:
+            code = leg["code"]
+            ratio = float(leg.get("ratio", 1))
+            if code == name:
+                raise ValueError("合成合约<%s>不能以自身为腿" % name)
+            if ratio == 0:
+                raise ValueError("腿<%s>的比例不能为0" % code)
+            if "multiplier" in leg:
+                multiplier = float(leg["multiplier"])
+            elif notional:
+                if code not in instruments:
+                    raise ValueError("合约<%s>不存在" % code)
+                multiplier = instruments[code]["multiple"]
+            else:
+                multiplier = 1
+            self.legs.append((code, ratio, multiplier))
+
+    def definition(self):
+        return {"name": self.name, "notional": self.notional,
+                "legs": [{"code": code, "ratio": ratio, "multiplier": multiplier}
+                for (code, ratio, multiplier) in self.legs]}
+
+    def compute(self, quotes, trigger):
+        '''
+        由各腿最新报价计算合成tick，有腿尚无报价时返回None
+        '''
+        (last, bid, ask) = (0, 0, 0)
+        (bid_volume, ask_volume) = (None, None)
+        for (code, ratio, multiplier) in self.legs:
+            quote = quotes.get(code)
+            if quote is None:
+                return None
+            (leg_last, leg_bid, leg_bid_volume, leg_ask, leg_ask_volume) = quote
+            weight = ratio * multiplier
+            if ratio < 0:
+                (leg_bid, leg_bid_volume, leg_ask, leg_ask_volume) = (leg_ask, leg_ask_volume, leg_bid, leg_bid_volume)
+            last = None if last is None or leg_last is None else last + weight * leg_last
+            bid = None if bid is None or leg_bid is None else bid + weight * leg_bid
+            ask = None if ask is None or leg_ask is None else ask + weight * leg_ask
+            (bid_volume, ask_volume) = (_min(bid_volume, leg_bid_volume // abs(ratio)),
+                    _min(ask_volume, leg_ask_volume // abs(ratio)))
+        tick = dict(_EMPTY_TICK, trade_time=trigger["trade_time"], update_sec=trigger["update_sec"],
+                code=self.name, price=_round(last), ask1=(_round(ask), int(ask_volume) if ask is not None else 0),
+                bid1=(_round(bid), int(bid_volume) if bid is not None else 0))
+        if "recv_ns" in trigger:
+            tick["recv_ns"] = trigger["recv_ns"]
+        return tick
+
+def _min(current, value):
+    return value if current is None else min(current, value)
+
+def _round(value):
+    #消除浮点累加误差
+    return None if value is None else round(value, 8)
+
+class SyntheticEngine:
+    '''
+    合成合约引擎：按腿到合成合约的依赖索引，在腿tick到达时只重算依赖该腿的合成合约。
+    合成tick可作为其它合成合约的腿
+    '''
+    def __init__(self):
+        self._synthetics = {}
+        self._dependents = {}
+        self._quotes = {}
+        self._lock = threading.Lock()
+
+    def _rebuild(self):
+        dependents = {}
+        for synthetic in self._synthetics.values():
+            for (code, _, _) in synthetic.legs:
+                dependents.setdefault(code, []).append(synthetic)
+        #整体替换，CTP回调线程无锁读取
+        self._dependents = dependents
+
+    def define(self, name, legs, instruments, notional=False):
+        '''
+        定义或替换合成合约，腿必须是已有合约或其它合成合约
+        '''
+        with self._lock:
+            for leg in legs:
+                if leg["code"] not in instruments and leg["code"] not in self._synthetics:
+                    raise ValueError("合约<%s>不存在" % leg["code"])
+            synthetic = Synthetic(name, legs, notional, instruments)
+            old = self._synthetics.get(name)
+            self._synthetics[name] = synthetic
+            if self._dependsOn(name, name, set()):
+                if old is None:
+                    del self._synthetics[name]
+                else:
+                    self._synthetics[name] = old
+                raise ValueError("合成合约<%s>存在循环依赖" % name)
+            self._rebuild()
+            return synthetic.definition()
+
+    def _dependsOn(self, name, target, visited):
+        synthetic = self._synthetics.get(name)
+        if synthetic is None or name in visited:
+            return False
+        visited.add(name)
+        for (code, _, _) in synthetic.legs:
+            if code == target or self._dependsOn(code, target, visited):
+                return True
+        return False
+
+    def remove(self, name):
+        with self._lock:
+            if name not in self._synthetics:
+                raise ValueError("合成合约<%s>不存在" % name)
+            for synthetic in self._synthetics.values():
+                if any(code == name for (code, _, _) in synthetic.legs):
+                    raise ValueError("合成合约<%s>被<%s>引用" % (name, synthetic.name))
+            del self._synthetics[name]
+            self._rebuild()
+
+    def definitions(self):
+        return [synthetic.definition() for synthetic in list(self._synthetics.values())]
+
+    def has(self, name):
+        return name in self._synthetics
+
+    def legs(self, name=None):
+        '''
+        需要订阅的真实合约代码
+        '''
+        names = list(self._synthetics) if name is None else [name]
+        codes = set()
+        for name in names:
+            for (code, _, _) in self._synthetics[name].legs:
+                if code in self._synthetics:
+                    codes.update(self.legs(code))
+                else:
+                    codes.add(code)
+        return sorted(codes)
+
+    def onTick(self, tick):
+        '''
+        CTP回调线程中调用：更新腿的报价，返回依赖该腿且各腿均已有报价的合成tick
+        '''
+        synthetics = self._dependents.get(tick["code"])
+        if not synthetics:
+            return ()
+        (ask, ask_volume) = tick["ask1"]
+        (bid, bid_volume) = tick["bid1"]
+        self._quotes[tick["code"]] = (tick["price"], bid, bid_volume, ask, ask_volume)
+        ticks = []
+        for synthetic in synthetics:
+            synthetic_tick = synthetic.compute(self._quotes, tick)
+            if synthetic_tick is not None:
+                ticks.append(synthetic_tick)
+        return ticks
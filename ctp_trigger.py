@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import bisect, itertools, threading, time, queue, logging
+from ctp_metrics import TRIGGER_FIRE
+
+logger = logging.getLogger()
+
+#触发价格取自tick的字段
+_SOURCES = {"last": lambda tick: tick["price"], "bid": lambda tick: tick["bid1"][0],
+        "ask": lambda tick: tick["ask1"][0]}
+
+class _Book:
+    '''
+    单个合约、单个价格来源的待触发条件单：ge为价格上涨到触发价时触发（买入止损、空头止损等），
+    le为价格下跌到触发价时触发（卖出止损、多头止损等），各按(触发价, 序号)排序
+    '''
+    __slots__ = ("ge", "le")
+
+    def __init__(self):
+        self.ge = []
+        self.le = []
+
+    def crossed(self, price):
+        '''
+        取出已被价格穿越的条件单：ge中触发价不高于price的前缀，le中触发价不低于price的后缀
+        '''
+        fired = []
+        if self.ge and self.ge[0][0] <= price:
+            index = bisect.bisect_right(self.ge, (price, float("inf")))
+            fired.extend(self.ge[:index])
+            del self.ge[:index]
+        if self.le and self.le[-1][0] >= price:
+            index = bisect.bisect_left(self.le, (price, -1))
+            fired.extend(self.le[index:])
+            del self.le[index:]
+        return fired
+
+class TriggerEngine:
+    '''
+    本地条件单引擎：按合约与价格来源保存有序的触发价，CTP回调线程中每个tick只需二分查找被穿越的条件单，
+    触发的条件单交给报单线程调用fire(trigger)，不阻塞行情回调
+    '''
+    def __init__(self, fire):
+        self._fire = fire
+        self._triggers = {}
+        self._books = {}
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+        self._pending = queue.SimpleQueue()
+        threading.Thread(target=self._fireLoop, name="trigger_fire", daemon=True).start()
+
+    def add(self, code, direction, volume, condition, trigger_price, order_type="market", price=0, source="last"):
+        if direction not in ("long", "short"):
+            raise ValueError("错误的买卖方向<%s>" % direction)
+        if volume != int(volume) or volume == 0:
+            raise ValueError("交易数量<%s>必须是非零整数" % volume)
+        if condition not in ("ge", "le"):
+            raise ValueError("错误的触发条件<%s>" % condition)
+        if not trigger_price > 0:
+            raise ValueError("触发价<%s>必须大于0" % trigger_price)
+        if order_type not in ("market", "limit", "fak"):
+            raise ValueError("错误的报单类型<%s>" % order_type)
+        if order_type != "market" and not price > 0:
+            raise ValueError("%s单的价格<%s>必须大于0" % (order_type, price))
+        if source not in _SOURCES:
+            raise ValueError("错误的价格来源<%s>" % source)
+        seq = next(self._seq)
+        trigger = {"id": "T%d" % seq, "code": code, "direction": direction, "volume": int(volume),
+                "condition": condition, "trigger_price": float(trigger_price), "source": source,
+                "order_type": order_type, "price": float(price) if order_type != "market" else 0.0,
+                "status": "pending", "create_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "trigger_time": None, "tick_price": None, "result": None, "error": None}
+        with self._lock:
+            self._triggers[trigger["id"]] = trigger
+            book = self._books.setdefault(code, {}).setdefault(source, _Book())
+            bisect.insort(book.ge if condition == "ge" else book.le, (trigger["trigger_price"], seq))
+        return dict(trigger)
+
+    def cancel(self, trigger_id):
+        '''
+        撤销尚未触发的条件单
+        '''
+        with self._lock:
+            trigger = self._triggers.get(trigger_id)
+            if trigger is None:
+                raise ValueError("条件单<%s>不存在" % trigger_id)
+            if trigger["status"] != "pending":
+                raise ValueError("条件单<%s>已%s" % (trigger_id, "撤销" if trigger["status"] == "canceled" else "触发"))
+            book = self._books[trigger["code"]][trigger["source"]]
+            entries = book.ge if trigger["condition"] == "ge" else book.le
+            entry = (trigger["trigger_price"], int(trigger_id[1:]))
+            del entries[bisect.bisect_left(entries, entry)]
+            self._prune(trigger["code"], trigger["source"])
+            trigger["status"] = "canceled"
+            return dict(trigger)
+
+    def _prune(self, code, source):
+        books = self._books[code]
+        if not books[source].ge and not books[source].le:
+            del books[source]
+            if not books:
+                del self._books[code]
+
+    def triggers(self, code=None, active=False):
+        with self._lock:
+            return [dict(trigger) for trigger in self._triggers.values()
+                    if (code is None or trigger["code"] == code) and (not active or trigger["status"] == "pending")]
+
+    def active(self):
+        '''
+        尚未触发的条件单数量
+        '''
+        with self._lock:
+            return sum(trigger["status"] == "pending" for trigger in self._triggers.values())
+
+    def onTick(self, tick):
+        '''
+        CTP回调线程中调用：没有条件单的合约只做一次字典查找
+        '''
+        books = self._books.get(tick["code"])
+        if not books:
+            return
+        with self._lock:
+            for (source, book) in list(books.items()):
+                price = _SOURCES[source](tick)
+                if price is None:
+                    continue
+                fired = book.crossed(price)
+                if not fired:
+                    continue
+                self._prune(tick["code"], source)
+                for (_, seq) in fired:
+                    trigger = self._triggers["T%d" % seq]
+                    trigger["status"] = "triggered"
+                    trigger["trigger_time"] = tick["trade_time"]
+                    trigger["tick_price"] = price
+                    self._pending.put((trigger, time.perf_counter()))
+
+    def _fireLoop(self):
+        '''
+        报单线程：按触发顺序依次报单，TraderImpl的报单调用会阻塞到报单被接受或成交
+        '''
+        while True:
+            (trigger, triggered_at) = self._pending.get()
+            logger.info("条件单<%s>已触发：%s %s %s，价格%s" % (trigger["id"], trigger["code"],
+                    trigger["condition"], trigger["trigger_price"], trigger["tick_price"]))
+            try:
+                trigger["result"] = self._fire(dict(trigger))
+                trigger["status"] = "done"
+                TRIGGER_FIRE.labels("ok").observe(time.perf_counter() - triggered_at)
+            except Exception as e:
+                logger.error("条件单<%s>报单失败：%s" % (trigger["id"], e))
+                trigger["error"] = str(e)
+                trigger["status"] = "error"
+                TRIGGER_FIRE.labels("error").observe(time.perf_counter() - triggered_at)
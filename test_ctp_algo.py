@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import pytest
+from ctp_algo import ExecutionEngine, Twap
+
+class FakeTrader:
+    def __init__(self, **instrument):
+        self.instrument = dict({"price_tick": 1.0}, **instrument)
+        self.inserts = []
+        self.cancels = []
+        self._refs = itertools.count(1)
+
+    def getInstrument(self, code):
+        return self.instrument
+
+    def insertOrder(self, code, direction, volume, price):
+        key = "1:1:%d" % next(self._refs)
+        self.inserts.append((key, direction, volume, price))
+        return key
+
+    def cancelOrder(self, key, code):
+        self.cancels.append(key)
+
+def tick(bid, ask, code="MA301"):
+    return {"code": code, "bid1": (bid, 1), "ask1": (ask, 1), "upper_limit": 2800.0, "lower_limit": 2400.0}
+
+def engine(**instrument):
+    trader = FakeTrader(**instrument)
+    finished = []
+    #执行线程的定时推进间隔足够长，测试中直接调用_handle按顺序推进
+    return (ExecutionEngine(trader, finished.append, interval=3600), trader, finished)
+
+def test_released_only_after_trades_arrive():
+    (algos, trader, finished) = engine()
+    algo_id = algos.create("chase", "MA301", "long", 5, {})["id"]
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    ((key, direction, volume, price), ) = trader.inserts
+    assert (direction, volume, price) == ("long", 5, 2600.0)
+    #CTP先推送全部成交的报单回报，再推送成交回报
+    algos._handle(("order", key, "1@MA301", 5, False, None), 0)
+    assert algos.get(algo_id)["status"] == "done"
+    assert algos.running("MA301") and not finished
+    algos._handle(("trade", "1@MA301", 2600.0, 2), 0)
+    assert not finished
+    algos._handle(("trade", "1@MA301", 2599.0, 3), 0)
+    assert [algo.id for algo in finished] == [algo_id]
+    assert not algos.running("MA301")
+    snapshot = algos.get(algo_id)
+    assert (snapshot["filled"], snapshot["working"]) == (5, 0)
+    assert snapshot["avg_price"] == pytest.approx((2600.0 * 2 + 2599.0 * 3) / 5)
+
+def test_chase_cancels_and_replaces_remainder_after_cancel_ack():
+    (algos, trader, _) = engine()
+    algos.create("chase", "MA301", "short", 5, {"offset": 1})
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    (first, _, _, price) = trader.inserts[0]
+    assert price == 2600.0
+    algos._handle(("order", first, "1@MA301", 2, True, None), 0)
+    algos._handle(("tick", tick(2598.0, 2599.0)), 0)
+    assert trader.cancels == [first]
+    #撤单回报到达前不补单
+    assert len(trader.inserts) == 1
+    algos._handle(("order", first, "1@MA301", 2, False, None), 0)
+    ((_, _, volume, price), ) = trader.inserts[1:]
+    assert (volume, price) == (3, 2598.0)
+
+def test_children_split_by_max_volume_and_close_sells_at_ask():
+    (algos, trader, _) = engine(max_limit_volume=3)
+    #平多为卖出，数量为负
+    algos.create("chase", "MA301", "long", -7, {})
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    assert [(direction, volume, price) for (_, direction, volume, price) in trader.inserts] ==         \
+            [("long", -3, 2601.0), ("long", -3, 2601.0), ("long", -1, 2601.0)]
+
+def test_remainder_below_min_volume_ends_algo():
+    (algos, trader, finished) = engine(min_limit_volume=2)
+    algo_id = algos.create("chase", "MA301", "long", 5, {})["id"]
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    key = trader.inserts[0][0]
+    algos._handle(("order", key, "1@MA301", 4, True, None), 0)
+    algos._handle(("tick", tick(2601.0, 2602.0)), 0)
+    algos._handle(("order", key, "1@MA301", 4, False, None), 0)
+    snapshot = algos.get(algo_id)
+    assert (snapshot["status"], snapshot["filled"]) == ("canceled", 4)
+    assert len(trader.inserts) == 1
+    algos._handle(("trade", "1@MA301", 2600.0, 4), 0)
+    assert finished
+
+def test_rejected_child_ends_algo_with_error():
+    (algos, trader, finished) = engine(max_limit_volume=2)
+    algo_id = algos.create("chase", "MA301", "long", 4, {})["id"]
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    (rejected, working) = [insert[0] for insert in trader.inserts]
+    algos._handle(("order", rejected, None, 0, False, "资金不足"), 0)
+    snapshot = algos.get(algo_id)
+    assert (snapshot["status"], snapshot["message"]) == ("error", "资金不足")
+    #其余子单被撤销，撤单回报到达后才释放
+    assert trader.cancels == [working]
+    assert not finished
+    algos._handle(("order", working, "2@MA301", 0, False, None), 0)
+    assert finished and len(trader.inserts) == 2
+
+def test_cancel():
+    (algos, trader, finished) = engine()
+    algo_id = algos.create("chase", "MA301", "long", 5, {})["id"]
+    algos._handle(("tick", tick(2600.0, 2601.0)), 0)
+    algos._handle(("cancel", algo_id), 0)
+    assert trader.cancels == [trader.inserts[0][0]]
+    assert algos.get(algo_id)["status"] == "canceled"
+    algos._handle(("order", trader.inserts[0][0], "1@MA301", 0, False, None), 0)
+    assert finished
+    with pytest.raises(ValueError):
+        algos.cancel(algo_id)
+
+def test_twap_schedule():
+    trader = FakeTrader()
+    algo = Twap("A1", "MA301", "long", 10, trader.instrument, {"duration": 10, "slices": 5})
+    algo.tick = tick(2600.0, 2601.0)
+    algo.step(trader, 100.0)
+    assert [volume for (_, _, volume, _) in trader.inserts] == [2]
+    algo.step(trader, 104.0)
+    assert [volume for (_, _, volume, _) in trader.inserts] == [2, 4]
+    #到时改挂对手价
+    algo.step(trader, 110.0)
+    assert trader.cancels == [key for (key, _, _, _) in trader.inserts]
+
+def test_invalid_arguments():
+    (algos, _, _) = engine(min_limit_volume=2)
+    with pytest.raises(ValueError):
+        algos.create("vwap", "MA301", "long", 5, {})
+    with pytest.raises(ValueError):
+        algos.create("chase", "MA301", "buy", 5, {})
+    with pytest.raises(ValueError):
+        algos.create("chase", "MA301", "long", 1, {})
+    with pytest.raises(ValueError):
+        algos.create("twap", "MA301", "long", 5, {"slices": 0})
+    assert algos.algos() == []
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import io, json
+import numpy as np
+import pytest
+import ctp_codec
+from ctp_codec import JSON, MSGPACK, ARROW, NUMPY, negotiate, encode, columns, join_object, EncodedCache
+
+ORDERS = [{"code": "MA301", "price": 2600.0, "volume": 2, "is_active": True, "bid1": (2599.0, 5)},
+        {"code": "rb2305", "price": None, "volume": -1, "is_active": False, "bid1": (4000.0, 1)}]
+
+def test_negotiate_orders_by_quality_and_falls_back_to_json():
+    assert negotiate(None) == (JSON, )
+    assert negotiate("text/html") == (JSON, )
+    assert negotiate("*/*") == (JSON, )
+    assert negotiate("application/x-numpy;q=0.5, application/json") == (JSON, NUMPY)
+    assert negotiate("application/x-numpy, application/json;q=0") == (NUMPY, JSON)
+
+def test_negotiate_optional_formats():
+    if ctp_codec.msgpack is not None:
+        assert negotiate("application/x-msgpack;q=0.9, application/x-numpy") == (NUMPY, MSGPACK, JSON)
+    else:
+        assert negotiate("application/x-msgpack") == (JSON, )
+
+def test_json_round_trip():
+    (body, media) = encode({"MA301": {"price": 2600.5, "名称": "甲醇"}}, (JSON, ))
+    assert media == JSON
+    assert json.loads(body) == {"MA301": {"price": 2600.5, "名称": "甲醇"}}
+
+def test_join_object():
+    body = join_object([("a", ctp_codec.dumps([1, 2])), ("合约", b'"MA301"')])
+    assert json.loads(body) == {"a": [1, 2], "合约": "MA301"}
+
+def test_columns_expand_nested_values_and_nulls():
+    table = columns({"x": ORDERS[0], "y": ORDERS[1]})
+    assert list(table) == ["key", "code", "price", "volume", "is_active", "bid1_0", "bid1_1"]
+    assert table["volume"].dtype == np.int64
+    assert np.isnan(table["price"][1])
+    assert table["is_active"].tolist() == [True, False]
+    assert table["bid1_1"].tolist() == [5, 1]
+    assert columns({"price": 1}) is None
+    assert columns([]) is None
+
+def test_numpy_round_trip():
+    (body, media) = encode(ORDERS, (NUMPY, JSON))
+    assert media == NUMPY
+    array = np.load(io.BytesIO(body), allow_pickle=False)
+    assert array["code"].tolist() == ["MA301", "rb2305"]
+    assert array["volume"].tolist() == [2, -1]
+    assert array["bid1_0"].tolist() == [2599.0, 4000.0]
+
+def test_scalar_data_skips_columnar_formats():
+    assert encode({"balance": 1.5}, (NUMPY, JSON))[1] == JSON
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip("msgpack")
+    (body, media) = encode({"code": "MA301", "volume": 2}, (MSGPACK, JSON))
+    assert media == MSGPACK
+    assert msgpack.unpackb(body) == {"code": "MA301", "volume": 2}
+
+def test_arrow_round_trip():
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.ipc
+    (body, media) = encode(ORDERS, (ARROW, JSON))
+    assert media == ARROW
+    table = pyarrow.ipc.open_stream(body).read_all()
+    assert table.column("code").to_pylist() == ["MA301", "rb2305"]
+    assert table.column("is_active").to_pylist() == [True, False]
+
+def test_encoded_cache_reloads_only_on_version_change():
+    cache = EncodedCache(size=2)
+    loads = []
+    def load():
+        loads.append(1)
+        return {"n": len(loads)}
+    assert json.loads(cache.get("a", 1, (JSON, ), load)[0]) == {"n": 1}
+    assert json.loads(cache.get("a", 1, (JSON, ), load)[0]) == {"n": 1}
+    assert json.loads(cache.get("a", 2, (JSON, ), load)[0]) == {"n": 2}
+    #不可缓存的数据每次都重新取数
+    cache.get("a", None, (JSON, ), load)
+    cache.get("a", None, (JSON, ), load)
+    assert len(loads) == 4
+
+def test_encoded_cache_evicts_least_recently_used():
+    cache = EncodedCache(size=2)
+    for key in ("a", "b"):
+        cache.put(key, 1, (JSON, ), {"key": key})
+    cache.find("a", 1, (JSON, ))
+    cache.put("c", 1, (JSON, ), {"key": "c"})
+    assert cache.find("b", 1, (JSON, )) is None
+    assert cache.find("a", 1, (JSON, )) is not None
+    #不同协商结果分别缓存
+    assert cache.find("a", 1, (NUMPY, JSON)) is None
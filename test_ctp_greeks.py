@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import time
+import numpy as np
+import pytest
+from ctp_greeks import black76, implied_vol, OptionAnalytics
+
+def test_implied_vol_round_trip():
+    strike = np.array([80.0, 95.0, 100.0, 105.0, 120.0, 80.0, 100.0, 120.0])
+    is_call = np.array([True, True, True, True, True, False, False, False])
+    vol = np.array([0.15, 0.2, 0.25, 0.3, 0.6, 0.45, 0.1, 0.35])
+    years = np.full(len(strike), 0.25)
+    forward = np.full(len(strike), 100.0)
+    discount = np.exp(-0.02 * years)
+    (price, _, _) = black76(forward, strike, years, vol, is_call, discount)
+    assert np.allclose(implied_vol(price, forward, strike, years, is_call, discount), vol, atol=1e-6)
+
+def test_put_call_parity():
+    (call, _, _) = black76(100.0, 90.0, 0.5, 0.3, True, 0.99)
+    (put, _, _) = black76(100.0, 90.0, 0.5, 0.3, False, 0.99)
+    assert call - put == pytest.approx(0.99 * (100 - 90), abs=1e-5)
+
+def test_implied_vol_is_nan_outside_arbitrage_bounds():
+    #低于内在价值、不低于上限、无价格、已到期
+    price = np.array([5.0, 100.0, np.nan, 3.0])
+    strike = np.full(4, 90.0)
+    years = np.array([0.25, 0.25, 0.25, 0.0])
+    ones = np.ones(4)
+    vol = implied_vol(price, ones * 100, strike, years, np.ones(4, dtype=bool), ones)
+    assert np.isnan(vol).all()
+
+def tick(code, price):
+    return {"code": code, "price": price, "bid1": (None, None), "ask1": (None, None)}
+
+def test_analytics_recompute_on_analytics_thread():
+    expire = time.strftime("%Y-%m-%d", time.localtime(time.time() + 90 * 86400))
+    options = {"IO2306": [{"symbol": "IO2306-C-4000", "strike_price": 4000, "option_type": "call", "expire_date": expire},
+            {"symbol": "IO2306-P-4000", "strike_price": 4000, "option_type": "put", "expire_date": expire}]}
+    analytics = OptionAnalytics(options, interval=0.05)
+    try:
+        assert analytics.underlying("IO2306-C-4000") == "IF2306"
+        assert analytics.underlying("IF2306") is None
+        with pytest.raises(ValueError):
+            analytics.greeks("MA301")
+        years = 90 / 365
+        (call, _, _) = black76(4000.0, 4000.0, years, 0.2, True, 1.0)
+        (put, _, _) = black76(4000.0, 4000.0, years, 0.2, False, 1.0)
+        analytics.onTick(tick("IF2306", 4000.0))
+        analytics.onTick(tick("IO2306-C-4000", float(call)))
+        analytics.onTick(tick("IO2306-P-4000", float(put)))
+        deadline = time.time() + 2
+        while time.time() < deadline:
+            chain = analytics.greeks("IO2306")
+            if all(option.get("iv") is not None for option in chain["options"]):
+                break
+            time.sleep(0.01)
+        (call_greeks, put_greeks) = chain["options"]
+        #到期时间按到期日15:00计算，与90天略有差异
+        assert call_greeks["iv"] == pytest.approx(0.2, abs=0.005)
+        assert put_greeks["iv"] == pytest.approx(0.2, abs=0.005)
+        assert call_greeks["delta"] - put_greeks["delta"] == pytest.approx(1.0)
+        annotated = tick("IO2306-C-4000", float(call))
+        analytics.annotate(annotated)
+        assert annotated["greeks"]["iv"] == call_greeks["iv"]
+    finally:
+        analytics.close()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+from types import SimpleNamespace
+from ctp_journal import Journal, JournalState, trade_key, order_key
+
+def trade(trade_id, code="MA301", direction='0', offset='0', volume=1, price=2600):
+    return SimpleNamespace(ExchangeID="CZCE", TradeID="%12s" % trade_id, Direction=direction, OffsetFlag=offset,
+            Volume=volume, OrderSysID="1", InstrumentID=code, Price=price, TradeTime="09:00:00")
+
+def request(ref, code="MA301", direction='0', offset='0', volume=2, price=2600):
+    return SimpleNamespace(OrderRef="%12d" % ref, InstrumentID=code, Direction=direction, CombOffsetFlag=offset,
+            VolumeTotalOriginal=volume, LimitPrice=price)
+
+def test_keys():
+    assert trade_key(trade(7)) == "CZCE:7:0"
+    assert order_key(1, 2, "          12") == "1:2:12"
+    assert order_key(1, 2, "            ") == "1:2:0"
+
+def test_replay_is_idempotent():
+    records = [{"type": "day", "trading_day": "20230103"},
+            {"type": "request", "key": "1:2:1", "ref": 1, "code": "MA301", "direction": "long", "price": 2600,
+                    "volume": 2},
+            {"type": "order", "key": "1:2:1", "order_id": "1@MA301", "volume_traded": 1, "is_active": True},
+            {"type": "trade", "key": "CZCE:7:0", "code": "MA301", "position": "long", "delta": 1}]
+    once = JournalState()
+    for record in records:
+        once.apply(record)
+    twice = JournalState()
+    for record in records + records:
+        twice.apply(record)
+    assert twice.toDict() == once.toDict()
+    assert once.positions == {"MA301@long": 1}
+    assert once.order_ref == 1
+
+def test_new_day_clears_orders_and_trades():
+    state = JournalState()
+    state.apply({"type": "day", "trading_day": "20230103"})
+    state.apply({"type": "request", "key": "1:2:5", "ref": 5, "code": "MA301", "direction": "long", "price": 2600,
+            "volume": 1})
+    state.apply({"type": "day", "trading_day": "20230104"})
+    assert (state.orders, state.order_ref) == ({}, 0)
+
+def test_positions_baseline_sums_rows_and_skips_counted_trades(tmp_path):
+    journal = Journal(str(tmp_path))
+    try:
+        journal.beginDay("20230103")
+        assert journal.needPositions()
+        journal.setPositions([{"code": "rb2305", "direction": "long", "volume": 3},
+                {"code": "rb2305", "direction": "long", "volume": 2}], [trade_key(trade(7))])
+        assert not journal.needPositions()
+        #查询持仓之前的成交已计入基准，续传时不再计入
+        journal.onEvent("trade", trade(7, code="rb2305"), (1, 2))
+        #卖平多头
+        journal.onEvent("trade", trade(8, code="rb2305", direction='1', offset='3'), (1, 2))
+        assert journal.positions() == [{"code": "rb2305", "direction": "long", "volume": 4}]
+    finally:
+        journal.close()
+
+def test_reopen_after_compaction(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.beginDay("20230103")
+    journal.onEvent("request", request(1), (1, 2))
+    journal.onEvent("trade", trade(7), (1, 2))
+    journal.compact()
+    journal.onEvent("request", request(2), (1, 2))
+    journal.onEvent("trade", trade(8, direction='1'), (1, 2))
+    expected = journal.state.toDict()
+    journal.close()
+    assert sorted(os.listdir(str(tmp_path))) == ["journal.log", "snapshot.json"]
+    reopened = Journal(str(tmp_path))
+    try:
+        assert reopened.state.toDict() == expected
+        assert reopened.beginDay("20230103") == 2
+    finally:
+        reopened.close()
+
+def test_recover_rotated_log_without_snapshot(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.beginDay("20230103")
+    journal.onEvent("trade", trade(7), (1, 2))
+    journal.compact()
+    journal.onEvent("request", request(3), (1, 2))
+    journal.onEvent("trade", trade(8), (1, 2))
+    expected = journal.state.toDict()
+    journal.close()
+    #模拟压缩过程中崩溃：当前日志已轮换为第2代，快照仍为第1代，另有写完快照后未删除的第1代日志
+    os.replace(str(tmp_path / "journal.log"), str(tmp_path / "journal.2.log"))
+    (tmp_path / "journal.log").write_text("")
+    (tmp_path / "journal.1.log").write_text('{"type": "trade", "key": "CZCE:7:0", "code": "MA301", '
+            '"position": "long", "delta": 1}\n')
+    recovered = Journal(str(tmp_path))
+    try:
+        assert recovered.state.toDict() == expected
+        assert recovered.state.positions == {"MA301@long": 2}
+        assert not os.path.exists(str(tmp_path / "journal.1.log"))
+    finally:
+        recovered.close()
+
+def test_truncated_last_line_is_ignored(tmp_path):
+    journal = Journal(str(tmp_path))
+    journal.beginDay("20230103")
+    journal.onEvent("request", request(4), (1, 2))
+    journal.close()
+    with open(str(tmp_path / "journal.log"), "a", encoding="utf-8") as fd:
+        fd.write('{"type": "request", "key": "1:2:5", "ref": 5')
+    recovered = Journal(str(tmp_path))
+    try:
+        assert recovered.state.order_ref == 4
+    finally:
+        recovered.close()
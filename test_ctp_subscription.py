@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from ctp_subscription import SubscriptionRegistry, select, product_of
+
+def test_only_first_subscriber_and_last_unsubscriber_reach_ctp():
+    registry = SubscriptionRegistry()
+    assert registry.add("a", ["MA301", "rb2305"]) == ["MA301", "rb2305"]
+    assert registry.add("b", ["MA301"]) == []
+    assert registry.remove("a", ["MA301"]) == []
+    assert registry.remove("b", ["MA301"]) == ["MA301"]
+    assert registry.codes() == ["rb2305"]
+
+def test_named_consumer_subscribes_once():
+    registry = SubscriptionRegistry()
+    registry.add("a", ["MA301"])
+    registry.add("a", ["MA301"])
+    assert registry.remove("a", ["MA301"]) == ["MA301"]
+
+def test_counted_consumer_needs_one_unsubscribe_per_subscribe():
+    registry = SubscriptionRegistry()
+    assert registry.add("default", ["MA301"], counted=True) == ["MA301"]
+    assert registry.add("default", ["MA301"], counted=True) == []
+    assert registry.remove("default", ["MA301"], counted=True) == []
+    assert registry.codes() == ["MA301"]
+    assert registry.remove("default", ["MA301"], counted=True) == ["MA301"]
+    assert registry.codes() == []
+
+def test_remove_all_and_unknown_codes():
+    registry = SubscriptionRegistry()
+    registry.add("a", ["MA301", "rb2305"])
+    registry.add("b", ["rb2305"])
+    assert registry.remove("a", ["XX999"]) == []
+    assert registry.remove("a") == ["MA301"]
+    assert registry.consumers() == {"b": ["rb2305"]}
+
+INSTRUMENTS = {
+    "MA301": {"exchange": "CZCE", "option_type": None, "is_trading": True},
+    "MA305": {"exchange": "CZCE", "option_type": None, "is_trading": False},
+    "rb2305": {"exchange": "SHFE", "option_type": None, "is_trading": True},
+    "MA301C2600": {"exchange": "CZCE", "option_type": "call", "is_trading": True},
+}
+OPTIONS = {"MA301": [{"symbol": "MA301C2600", "is_trading": True}, {"symbol": "MA301P2600", "is_trading": False}]}
+
+def test_select():
+    assert product_of("MA301") == "MA"
+    assert select(INSTRUMENTS, OPTIONS, exchange="CZCE") == ["MA301", "MA301C2600"]
+    assert select(INSTRUMENTS, OPTIONS, product="MA") == ["MA301"]
+    assert select(INSTRUMENTS, OPTIONS, chain="MA301") == ["MA301C2600"]
+    assert sorted(select(INSTRUMENTS, OPTIONS, all=True)) == ["MA301", "MA301C2600", "rb2305"]
+    with pytest.raises(ValueError):
+        select(INSTRUMENTS, OPTIONS, product="ag")
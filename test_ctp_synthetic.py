@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from ctp_synthetic import SyntheticEngine, parse_legs
+
+INSTRUMENTS = {"MA301": {"multiple": 10}, "MA305": {"multiple": 10}, "rb2305": {"multiple": 10},
+        "hc2305": {"multiple": 10}}
+
+def tick(code, price, bid, ask, bid_volume=10, ask_volume=10):
+    return {"code": code, "price": price, "bid1": (bid, bid_volume), "ask1": (ask, ask_volume),
+            "trade_time": "2023-01-03 09:00:00", "update_sec": 0}
+
+def test_parse_legs():
+    assert parse_legs("MA301:1, MA305:-1,rb2305") == [{"code": "MA301", "ratio": 1.0},
+            {"code": "MA305", "ratio": -1.0}, {"code": "rb2305", "ratio": 1}]
+
+def test_spread_swaps_bid_and_ask_of_negative_leg():
+    engine = SyntheticEngine()
+    engine.define("MA1-5", parse_legs("MA301:1,MA305:-1"), INSTRUMENTS)
+    #腿尚无报价时不产生合成tick
+    assert engine.onTick(tick("MA301", 2600, 2599, 2601, 7, 8)) == []
+    (synthetic, ) = engine.onTick(tick("MA305", 2550, 2549, 2552, 3, 20))
+    assert synthetic["code"] == "MA1-5"
+    assert synthetic["price"] == 50
+    #买价差 = 买近月（卖价）+ 卖远月（买价）
+    assert synthetic["ask1"] == (2601 - 2549, 3)
+    assert synthetic["bid1"] == (2599 - 2552, 7)
+
+def test_ratios_divide_volume_and_notional_uses_multiple():
+    engine = SyntheticEngine()
+    engine.define("steel", parse_legs("rb2305:2,hc2305:-1"), INSTRUMENTS, notional=True)
+    engine.onTick(tick("rb2305", 4000, 3999, 4001, 9, 5))
+    (synthetic, ) = engine.onTick(tick("hc2305", 4100, 4099, 4102, 4, 6))
+    assert synthetic["price"] == (2 * 4000 - 4100) * 10
+    assert synthetic["ask1"] == ((2 * 4001 - 4099) * 10, 2)
+    assert synthetic["bid1"] == ((2 * 3999 - 4102) * 10, 4)
+
+def test_nested_synthetic_and_legs():
+    engine = SyntheticEngine()
+    engine.define("MA1-5", parse_legs("MA301:1,MA305:-1"), INSTRUMENTS)
+    engine.define("fly", parse_legs("MA1-5:1,rb2305:-1"), INSTRUMENTS)
+    assert engine.legs("fly") == ["MA301", "MA305", "rb2305"]
+    with pytest.raises(ValueError):
+        engine.remove("MA1-5")
+
+def test_cycle_is_rejected_and_old_definition_kept():
+    engine = SyntheticEngine()
+    engine.define("a", parse_legs("MA301:1"), INSTRUMENTS)
+    engine.define("b", parse_legs("a:1,MA305:1"), INSTRUMENTS)
+    with pytest.raises(ValueError):
+        engine.define("a", parse_legs("b:1"), INSTRUMENTS)
+    assert engine.legs("a") == ["MA301"]
+
+def test_unknown_leg_and_zero_ratio():
+    engine = SyntheticEngine()
+    with pytest.raises(ValueError):
+        engine.define("x", parse_legs("XX999:1"), INSTRUMENTS)
+    with pytest.raises(ValueError):
+        engine.define("x", parse_legs("MA301:0"), INSTRUMENTS)
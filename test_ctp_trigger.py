@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import pytest
+from ctp_trigger import TriggerEngine
+
+def tick(code, price, bid=None, ask=None):
+    return {"code": code, "price": price, "bid1": (bid, 1), "ask1": (ask, 1), "trade_time": "2023-01-03 09:00:00"}
+
+def engine():
+    fired = queue.SimpleQueue()
+    return (TriggerEngine(lambda trigger: fired.put(trigger) or trigger["id"]), fired)
+
+def drain(fired, count):
+    return [fired.get(timeout=1)["id"] for _ in range(count)]
+
+def test_ge_fires_when_price_reaches_trigger_in_price_order():
+    (triggers, fired) = engine()
+    high = triggers.add("MA301", "long", 1, "ge", 2620)
+    low = triggers.add("MA301", "long", 1, "ge", 2610)
+    triggers.add("MA301", "long", 1, "ge", 2630)
+    triggers.onTick(tick("MA301", 2609))
+    assert triggers.active() == 3
+    triggers.onTick(tick("MA301", 2620))
+    assert drain(fired, 2) == [low["id"], high["id"]]
+    assert triggers.active() == 1
+
+def test_le_fires_when_price_falls_to_trigger():
+    (triggers, fired) = engine()
+    first = triggers.add("MA301", "short", 1, "le", 2590)
+    second = triggers.add("MA301", "short", 1, "le", 2580)
+    triggers.onTick(tick("MA301", 2591))
+    assert triggers.active() == 2
+    triggers.onTick(tick("MA301", 2580))
+    assert sorted(drain(fired, 2)) == [first["id"], second["id"]]
+    (done, ) = [trigger for trigger in triggers.triggers() if trigger["id"] == first["id"]]
+    assert done["tick_price"] == 2580
+
+def test_equal_trigger_prices_fire_in_creation_order():
+    (triggers, fired) = engine()
+    ids = [triggers.add("MA301", "long", 1, "ge", 2600)["id"] for _ in range(3)]
+    triggers.onTick(tick("MA301", 2600))
+    assert drain(fired, 3) == ids
+
+def test_price_source():
+    (triggers, fired) = engine()
+    trigger = triggers.add("MA301", "short", 1, "le", 2590, source="bid")
+    triggers.onTick(tick("MA301", 2580, bid=2595, ask=2596))
+    assert triggers.active() == 1
+    #没有买价时不触发
+    triggers.onTick(tick("MA301", 2580, bid=None, ask=2596))
+    assert triggers.active() == 1
+    triggers.onTick(tick("MA301", 2600, bid=2590, ask=2596))
+    assert drain(fired, 1) == [trigger["id"]]
+
+def test_cancel():
+    (triggers, fired) = engine()
+    canceled = triggers.add("MA301", "long", 1, "ge", 2600)
+    kept = triggers.add("MA301", "long", 1, "ge", 2600)
+    assert triggers.cancel(canceled["id"])["status"] == "canceled"
+    with pytest.raises(ValueError):
+        triggers.cancel(canceled["id"])
+    with pytest.raises(ValueError):
+        triggers.cancel("T999")
+    triggers.onTick(tick("MA301", 2600))
+    assert drain(fired, 1) == [kept["id"]]
+    assert [trigger["id"] for trigger in triggers.triggers(active=True)] == []
+
+def test_rejects_invalid_arguments():
+    (triggers, _) = engine()
+    for args in [("MA301", "buy", 1, "ge", 2600), ("MA301", "long", 0, "ge", 2600),
+            ("MA301", "long", 1, "gt", 2600), ("MA301", "long", 1, "ge", 0)]:
+        with pytest.raises(ValueError):
+            triggers.add(*args)
+    with pytest.raises(ValueError):
+        triggers.add("MA301", "long", 1, "ge", 2600, order_type="limit")
+    with pytest.raises(ValueError):
+        triggers.add("MA301", "long", 1, "ge", 2600, source="mid")
+    assert triggers.active() == 0